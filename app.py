@@ -2,11 +2,63 @@
 import streamlit as st
 from dotenv import load_dotenv
 import os
+import math
+import json
+import time
 
 import prompts
 import gemini_utils
+import pipeline
+import log_buffer
+import metrics
+import replay
+import jobs
+import results_store
 
 load_dotenv()
+# GEMINIJUDGE_REPLAY=record|replay|strict — запись или воспроизведение ответов API (см. replay.py)
+replay.install_from_env()
+
+# Режимы Этапа 1 и максимальное кол-во 'неправильных' ответов для каждого
+GENERATION_MODES = {
+    "single": "Один запрос на все ответы",
+    "fanout": "Отдельный запрос на каждый ответ",
+}
+MAX_INCORRECT_SAMPLES = {"single": 4, "fanout": 12}
+# Режимы Этапа 2; турнир позволяет оценивать большие пулы (до 64 кандидатов вместе с ответом модели А)
+EVALUATION_MODES = {
+    "single": "Все кандидаты в одном запросе",
+    "tournament": "Турнир: группы с выбыванием",
+    "self_consistency": "Самосогласованность: несколько голосов",
+    "cascade": "Каскад: сначала дешевая модель",
+}
+TOURNAMENT_MAX_INCORRECT_SAMPLES = 63
+# Модели, из которых можно выбрать судью (вместе с моделью из GEMINI_MODEL_EVALUATION)
+EVALUATION_MODEL_CHOICES = (
+    gemini_utils.MODEL_NAME_FOR_EVALUATION_DEFAULT, "gemini-2.0-flash", gemini_utils.MODEL_NAME_FOR_GENERATION_DEFAULT,
+)
+# Сколько записей журнала рисовать за раз: стоимость перерисовки не растет с длиной сессии
+LOG_PAGE_SIZE = 20
+# Как документы попадают в запросы к моделям
+CONTEXT_MODES = {
+    "attach": "Прикреплять файлы целиком",
+    "retrieval": "Только релевантные фрагменты (локальный поиск)",
+}
+# Запуск идет фоновой задачей (jobs.py): она получает снимок этих ключей сессии...
+JOB_INPUT_KEYS = (
+    "api_key_input", "gemini_configured", "uploaded_st_files", "context_mode_input", "user_prompt_input",
+    "model_a_response_input", "num_incorrect_samples_input", "generation_mode_input", "evaluation_mode_input",
+    "structured_output_input", "stream_generation_input", "resume_from_checkpoints_input", "self_consistency_votes_input",
+    "cascade_threshold_input", "evaluation_model_input", "stage_memo", "app_run_id",
+)
+# ...и по завершении возвращает в сессию эти
+JOB_RESULT_KEYS = (
+    "processed_gemini_files", "retrieval_context", "generated_incorrect_responses", "time_to_first_distractor_s",
+    "evaluation_result_id", "evaluation_rationale", "evaluation_rounds", "evaluation_votes", "all_responses_for_evaluation",
+    "run_metrics",
+)
+# Как часто UI опрашивает задачу, с
+JOB_POLL_INTERVAL_S = 1.0
 
 def initialize_session_state():
     defaults = {
@@ -14,20 +66,50 @@ def initialize_session_state():
         "gemini_configured": False,
         "uploaded_st_files": [],
         "processed_gemini_files": [],
+        "context_mode_input": "attach",
+        "retrieval_context": None,
         "user_prompt_input": "",
         "model_a_response_input": "",
         "num_incorrect_samples_input": 2, # Уменьшим по умолчанию, т.к. оценка сложнее
+        "generation_mode_input": "single",
+        "evaluation_mode_input": "single",
+        "self_consistency_votes_input": pipeline.SELF_CONSISTENCY_VOTES_DEFAULT,
+        "cascade_threshold_input": pipeline.CASCADE_CONFIDENCE_THRESHOLD_DEFAULT,
+        "evaluation_model_input": gemini_utils.get_model_name("evaluation"),
+        # Последний результат каждого этапа и входы, из которых он получен (pipeline.StageCheckpoints.memo):
+        # повторный запуск пересчитывает только этапы, чьи входы изменились
+        "stage_memo": {},
+        "structured_output_input": False,
+        "stream_generation_input": True,
+        "resume_from_checkpoints_input": True,
         "generated_incorrect_responses": [],
+        "time_to_first_distractor_s": None,
+        "run_metrics": None, # Разбивка последнего запуска по этапам и токенам (metrics.RunRecorder.breakdown)
         "evaluation_result_id": None,
         "evaluation_rationale": "", # Для хранения обоснования
+        "evaluation_rounds": [], # Раунды турнира (pipeline.EvaluationResult.rounds)
+        "evaluation_votes": None, # Голоса самосогласованности или каскада: {"votes", "confidence", "calls", "escalated"}
         "all_responses_for_evaluation": {},
-        "log_messages": [],
+        "log_messages": log_buffer.LogBuffer(),
         "app_run_id": 0,
-        "processing_complete": False
+        "processing_complete": False,
+        "active_job_id": None, # Фоновая задача последнего запуска (jobs.JobRegistry)
+        "applied_job_id": None # Задача, результаты которой уже перенесены в сессию
     }
     for key, value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = value
+
+    # После перезагрузки страницы сессия новая: подключаемся к задаче по ID из URL. ID — неугадываемая ссылка-доступ
+    # (см. jobs.py): владельца, переживающего перезагрузку, у сессии нет, поэтому доступ дает сама ссылка
+    job = jobs.get_job_registry().get(st.query_params.get("job"))
+    if job is not None and st.session_state.active_job_id is None:
+        st.session_state.active_job_id = job.id
+        st.session_state.log_messages = job.state["log_messages"]
+        for key in JOB_INPUT_KEYS:
+            # Ключ API из чужой ссылки в сессию не переносим
+            if key.endswith("_input") and key != "api_key_input":
+                st.session_state[key] = job.state[key]
     
     if st.session_state.api_key_input and not st.session_state.gemini_configured:
         gemini_utils.configure_gemini_api()
@@ -35,117 +117,205 @@ def initialize_session_state():
 initialize_session_state()
 
 # --- Логика Приложения ---
-def handle_file_uploads_and_processing(uploaded_st_files_list: list) -> bool:
-    st.session_state.processed_gemini_files = []
-    if not uploaded_st_files_list:
-        gemini_utils.log_info("Контекстные файлы не предоставлены.")
-        return True
-    all_successful = True
-    for i, st_file in enumerate(uploaded_st_files_list):
-        gemini_utils.log_info(f"Обработка файла {i+1}/{len(uploaded_st_files_list)}: {st_file.name}")
-        gemini_file_obj = gemini_utils.upload_file_to_gemini(st_file, display_name_prefix=f"doc{i+1}")
-        if gemini_file_obj and hasattr(gemini_file_obj, 'state') and gemini_file_obj.state.name == "ACTIVE":
-            st.session_state.processed_gemini_files.append(gemini_file_obj)
-        elif gemini_file_obj:
-            gemini_utils.log_warning(f"Файл {st_file.name} загружен, но не активен (состояние: {gemini_file_obj.state.name}).")
-            all_successful = False 
-        else:
-            gemini_utils.log_error(f"Не удалось обработать файл {st_file.name}.")
-            all_successful = False
-    if all_successful and st.session_state.processed_gemini_files:
-        gemini_utils.log_success(f"{len(st.session_state.processed_gemini_files)} файлов успешно подготовлены.")
-    elif st.session_state.processed_gemini_files:
-         gemini_utils.log_warning(f"Подготовлено {len(st.session_state.processed_gemini_files)} из {len(uploaded_st_files_list)} файлов.")
-    elif uploaded_st_files_list:
-        gemini_utils.log_error("Ни один из файлов не был успешно обработан.")
-        all_successful = False
+# Сами этапы живут в pipeline.py; здесь только связь с состоянием. Функции ниже выполняются в фоновой задаче,
+# поэтому работают со снимком сессии через gemini_utils.get_state(), а не с st.session_state
+FILE_STATE_LABELS = {
+    "QUEUED": "⏸️ в очереди (лимит памяти загрузок)",
+    "UPLOADING": "⏫ загрузка",
+    "CACHED": "♻️ из кэша",
+    "PROCESSING": "⏳ обработка",
+    "ACTIVE": "✅ активен",
+    "FAILED": "❌ ошибка обработки",
+    "ERROR": "❌ ошибка",
+}
+STAGE_LABELS = {
+    pipeline.STAGE_FILES: "Этап 0: файлы",
+    pipeline.STAGE_GENERATION: "Этап 1: генерация",
+    pipeline.STAGE_EVALUATION: "Этап 2: оценка",
+}
+
+def handle_file_uploads_and_processing(uploaded_st_files_list: list, stage_checkpoints: pipeline.StageCheckpoints, on_file_progress=None) -> bool:
+    state = gemini_utils.get_state()
+    state["processed_gemini_files"] = []
+    state["retrieval_context"] = None
+    if state["context_mode_input"] == "retrieval":
+        state["retrieval_context"], all_successful = pipeline.prepare_retrieval_context(uploaded_st_files_list)
+        return all_successful or state["retrieval_context"] is not None
+
+    processed_files, all_successful = pipeline.upload_documents_resumable(
+        uploaded_st_files_list, stage_checkpoints, on_progress=on_file_progress
+    )
+    state["processed_gemini_files"] = processed_files
     return all_successful
 
-def generate_and_parse_incorrect_responses_logic(user_prompt: str, model_a_response: str, num_samples: int) -> bool:
-    st.session_state.generated_incorrect_responses = []
-    prompt_text = prompts.get_generate_incorrect_answers_prompt(user_prompt, model_a_response, num_samples)
-    
-    raw_response = gemini_utils.generate_text_from_model(
-        prompt_text, model_type="generation", # Используем модель для генерации
-        files_for_context=st.session_state.processed_gemini_files
+def generate_and_parse_incorrect_responses_logic(user_prompt: str, model_a_response: str, num_samples: int, stage_checkpoints: pipeline.StageCheckpoints, on_distractor=None, fanout: bool = False) -> bool:
+    state = gemini_utils.get_state()
+    state["generated_incorrect_responses"] = []
+    state["time_to_first_distractor_s"] = None
+
+    def record_distractor(index: int, resp_text: str, elapsed_s: float):
+        if state["time_to_first_distractor_s"] is None:
+            state["time_to_first_distractor_s"] = elapsed_s
+        if on_distractor:
+            on_distractor(index, resp_text, elapsed_s)
+
+    def generate(existing_responses: list, num_missing: int) -> list:
+        if fanout:
+            return pipeline.generate_incorrect_responses_fanout(
+                user_prompt, model_a_response, num_missing,
+                files_for_context=state["processed_gemini_files"],
+                on_distractor=record_distractor,
+                retrieval_context=state["retrieval_context"],
+                structured_output=state["structured_output_input"],
+                existing_responses=existing_responses
+            )
+        return pipeline.generate_incorrect_responses(
+            user_prompt, model_a_response, num_missing,
+            files_for_context=state["processed_gemini_files"],
+            on_distractor=record_distractor if on_distractor else None,
+            retrieval_context=state["retrieval_context"],
+            structured_output=state["structured_output_input"],
+            existing_responses=existing_responses
+        )
+
+    # Кол-во ответов не входит в ключ: при его увеличении догенерируются только недостающие, при уменьшении берется часть
+    state["generated_incorrect_responses"] = stage_checkpoints.run_distractors(generate, {
+        "prompt": user_prompt, "model_a_response": model_a_response,
+        "generation_mode": state["generation_mode_input"], "context_mode": state["context_mode_input"],
+        "structured_output": state["structured_output_input"],
+    }, num_samples)
+    return bool(state["generated_incorrect_responses"])
+
+def evaluate_all_responses_logic(user_prompt: str, model_a_response: str, stage_checkpoints: pipeline.StageCheckpoints, evaluation_mode: str = "single") -> bool:
+    state = gemini_utils.get_state()
+    state["evaluation_result_id"] = None
+    state["evaluation_rationale"] = "" # Сброс обоснования
+    state["evaluation_rounds"] = []
+    state["evaluation_votes"] = None
+    state["all_responses_for_evaluation"] = {}
+
+    num_votes = state["self_consistency_votes_input"]
+    cascade_threshold = state["cascade_threshold_input"]
+    result = stage_checkpoints.run(
+        pipeline.STAGE_EVALUATION,
+        lambda: pipeline.evaluate_responses_by_mode(
+            evaluation_mode, user_prompt, model_a_response, state["generated_incorrect_responses"],
+            files_for_context=state["processed_gemini_files"],
+            retrieval_context=state["retrieval_context"],
+            structured_output=state["structured_output_input"],
+            num_votes=num_votes,
+            cascade_threshold=cascade_threshold
+        ),
+        {
+            "prompt": user_prompt, "model_a_response": model_a_response,
+            "incorrect_responses": state["generated_incorrect_responses"],
+            "evaluation_mode": evaluation_mode, "context_mode": state["context_mode_input"],
+            "structured_output": state["structured_output_input"],
+            **({"num_votes": num_votes} if evaluation_mode == "self_consistency" else {}),
+            **({"cascade_threshold": cascade_threshold, "screening_model": gemini_utils.get_model_name("screening")}
+               if evaluation_mode == "cascade" else {}),
+        },
+        is_complete=lambda evaluation: evaluation.chosen_id is not None,
+        encode=pipeline.encode_evaluation_result, decode=pipeline.decode_evaluation_result
     )
-    if not raw_response:
-        gemini_utils.log_error("Не получены 'неправильные' ответы от модели генерации.")
-        return False
-
-    parsed_responses = []
-    current_answer_accumulator = []
-    for line in raw_response.splitlines():
-        if line.startswith(prompts.INCORRECT_ANSWER_PARSING_PREFIX):
-            if current_answer_accumulator:
-                parsed_responses.append("\n".join(current_answer_accumulator).strip())
-            current_answer_accumulator = [line.replace(prompts.INCORRECT_ANSWER_PARSING_PREFIX, "", 1).strip()]
-        elif current_answer_accumulator:
-            current_answer_accumulator.append(line.strip())
-    if current_answer_accumulator:
-        parsed_responses.append("\n".join(current_answer_accumulator).strip())
-    st.session_state.generated_incorrect_responses = [resp for resp in parsed_responses if resp]
-
-    if not st.session_state.generated_incorrect_responses:
-        gemini_utils.log_warning("Не удалось извлечь 'неправильные' ответы.")
-        return False
-    gemini_utils.log_success(f"Извлечено {len(st.session_state.generated_incorrect_responses)} 'неправильных' ответов.")
-    return True
-
-def evaluate_all_responses_logic(user_prompt: str, model_a_response: str) -> bool:
-    st.session_state.evaluation_result_id = None
-    st.session_state.evaluation_rationale = "" # Сброс обоснования
-    st.session_state.all_responses_for_evaluation = {}
-
-    all_responses_dict = {prompts.MODEL_A_ANSWER_ID: model_a_response}
-    for i, resp_text in enumerate(st.session_state.generated_incorrect_responses):
-        all_responses_dict[prompts.get_incorrect_answer_id(i)] = resp_text
-    st.session_state.all_responses_for_evaluation = all_responses_dict
-
-    text_block_for_prompt = ""
-    for identifier, text in all_responses_dict.items():
-        text_block_for_prompt += f"{identifier}:\n{text}\n---\n"
-    
-    prompt_text = prompts.get_evaluate_responses_prompt(user_prompt, text_block_for_prompt)
-    
-    full_evaluation_response = gemini_utils.generate_text_from_model(
-        prompt_text, model_type="evaluation", # Используем модель для оценки
-        files_for_context=st.session_state.processed_gemini_files
+    state["all_responses_for_evaluation"] = result.all_responses
+    state["evaluation_result_id"] = result.chosen_id
+    state["evaluation_rationale"] = result.rationale
+    state["evaluation_rounds"] = result.rounds
+    if result.votes or result.escalated is not None:
+        state["evaluation_votes"] = {"votes": result.votes, "confidence": result.confidence, "calls": result.calls,
+                                     "escalated": result.escalated}
+    return result.chosen_id is not None
+
+def run_judgment_job(job: jobs.Job) -> bool:
+    """
+    Этапы 0–2 в фоновой задаче. Виджетов не трогает: ход работы пишется в job.progress (stages, files, distractors),
+    результаты — в job.state, UI опрашивает их (show_job_progress).
+    """
+    state = job.state
+    stages: dict = {}
+    file_lines: dict = {}
+    distractors: list = []
+
+    def set_stage(stage: str, label: str, stage_state: str):
+        stages[stage] = {"label": label, "state": stage_state}
+        job.update_progress(stages=dict(stages))
+
+    def show_file_progress(index: int, file_name: str, file_state: str):
+        file_lines[index] = f"{file_name}: {FILE_STATE_LABELS.get(file_state, file_state)}"
+        job.update_progress(files=[file_lines[i] for i in sorted(file_lines)])
+
+    def show_distractor(index: int, resp_text: str, elapsed_s: float):
+        distractors.append({"index": index, "text": resp_text, "elapsed_s": elapsed_s})
+        job.update_progress(distractors=list(distractors))
+        job.check_cancelled()
+
+    state.update(
+        processed_gemini_files=[], retrieval_context=None, generated_incorrect_responses=[], time_to_first_distractor_s=None,
+        evaluation_result_id=None, evaluation_rationale="", evaluation_rounds=[], evaluation_votes=None,
+        all_responses_for_evaluation={}, run_metrics=None,
+    )
+    stage_checkpoints = pipeline.StageCheckpoints(
+        pipeline.document_digests(state["uploaded_st_files"] or []), resume=state["resume_from_checkpoints_input"],
+        memo=state["stage_memo"]
     )
+    overall_success = True
+    started = time.perf_counter()
+    try:
+        set_stage(pipeline.STAGE_FILES, "Этап 0: Подготовка файлов...", "running")
+        if not handle_file_uploads_and_processing(state["uploaded_st_files"], stage_checkpoints, on_file_progress=show_file_progress):
+            set_stage(pipeline.STAGE_FILES, "Ошибка подготовки файлов!", "error")
+            overall_success = False
+        elif not state["processed_gemini_files"] and state["retrieval_context"] is None and state["uploaded_st_files"]:
+            set_stage(pipeline.STAGE_FILES, "Файлы были предоставлены, но ни один не активен!", "warning")
+        else:
+            set_stage(pipeline.STAGE_FILES, "Файлы подготовлены/пропущены.", "complete")
+        job.check_cancelled()
+
+        if overall_success:
+            set_stage(pipeline.STAGE_GENERATION, f"Этап 1: Генерация {state['num_incorrect_samples_input']} 'неправильных' ответов (модель: {gemini_utils.get_model_name('generation')})...", "running")
+            fanout = state["generation_mode_input"] == "fanout"
+            streamed = state["stream_generation_input"] or fanout
+            if not generate_and_parse_incorrect_responses_logic(state["user_prompt_input"], state["model_a_response_input"], state["num_incorrect_samples_input"], stage_checkpoints, on_distractor=show_distractor if streamed else None, fanout=fanout):
+                set_stage(pipeline.STAGE_GENERATION, "Ошибка генерации 'неправильных'!", "warning")
+            else:
+                set_stage(pipeline.STAGE_GENERATION, "'Неправильные' ответы сгенерированы!", "complete")
+            job.check_cancelled()
+
+        if overall_success:
+            evaluation_models = gemini_utils.get_model_name('evaluation')
+            if state["evaluation_mode_input"] == "cascade":
+                evaluation_models = f"{gemini_utils.get_model_name('screening')}, при низком согласии — {evaluation_models}"
+            set_stage(pipeline.STAGE_EVALUATION, f"Этап 2: Оценка всех ответов (модель: {evaluation_models})...", "running")
+            if not evaluate_all_responses_logic(state["user_prompt_input"], state["model_a_response_input"], stage_checkpoints, evaluation_mode=state["evaluation_mode_input"]):
+                set_stage(pipeline.STAGE_EVALUATION, "Ошибка оценки!", "error")
+                overall_success = False
+            else:
+                set_stage(pipeline.STAGE_EVALUATION, "Ответы оценены!", "complete")
+    finally:
+        state["run_metrics"] = job.recorder.breakdown()
+
+    if results_store.is_enabled():
+        # Отмененные запуски в историю не попадают: сюда доходят только завершенные
+        results_store.get_results_store().append(results_store.build_record(
+            "ui", job.id, "ok" if state["evaluation_result_id"] else "error",
+            state["user_prompt_input"], state["model_a_response_input"], state["generated_incorrect_responses"],
+            state["evaluation_result_id"], rationale=state["evaluation_rationale"],
+            generation_mode=state["generation_mode_input"], evaluation_mode=state["evaluation_mode_input"],
+            generation_model=gemini_utils.get_model_name("generation"),
+            evaluation_model=gemini_utils.get_model_name("evaluation"),
+            elapsed_s=round(time.perf_counter() - started, 3), run_metrics=state["run_metrics"]
+        ), flush=True)
 
-    if not full_evaluation_response:
-        gemini_utils.log_error("Не получен ответ от оценочной модели.")
-        return False
-    
-    parts = full_evaluation_response.split(prompts.EVALUATION_SECTION_DELIMITER, 1)
-    chosen_id_raw = parts[0].strip()
-    rationale_text = parts[1].strip() if len(parts) > 1 else ""
-
-    chosen_id = chosen_id_raw.split()[0] if chosen_id_raw else ""
-
-    if chosen_id in all_responses_dict:
-        st.session_state.evaluation_result_id = chosen_id
-        st.session_state.evaluation_rationale = rationale_text
-        gemini_utils.log_success(f"Оценочная модель выбрала ID: '{chosen_id}'. Обоснование получено.")
-        if not rationale_text:
-            gemini_utils.log_warning("Обоснование от оценочной модели пустое, хотя ID выбран.")
+    if overall_success:
+        gemini_utils.log_success("=== Сеанс GeminiJudge завершен успешно! ===")
     else:
-        gemini_utils.log_warning(f"Оценочная модель вернула '{chosen_id_raw}', ID не распознан.")
-        # Попытка найти по тексту (менее надежно, но как запасной вариант)
-        found_by_text = False
-        for id_key, text_val in all_responses_dict.items():
-            # Сравниваем только первую часть ответа модели (до разделителя) с текстами кандидатов
-            if chosen_id_raw.strip() == text_val.strip(): 
-                st.session_state.evaluation_result_id = id_key
-                st.session_state.evaluation_rationale = rationale_text # Все равно сохраняем обоснование, если есть
-                gemini_utils.log_warning(f"ID '{id_key}' определен по совпадению текста ответа (опасно).")
-                found_by_text = True
-                break
-        if not found_by_text:
-            st.session_state.evaluation_rationale = full_evaluation_response # Сохраняем весь ответ как "обоснование" для отладки
-            return False
-            
-    return True
+        gemini_utils.log_error("=== Сеанс GeminiJudge завершен с ошибками/предупреждениями. ===")
+    return overall_success
+
+job_registry = jobs.get_job_registry()
+active_job = job_registry.get(st.session_state.active_job_id)
+job_running = active_job is not None and not active_job.finished
 
 # --- UI: Боковая Панель (Конфигурация и Ввод) ---
 with st.sidebar:
@@ -168,7 +338,13 @@ with st.sidebar:
 
 
     st.session_state.uploaded_st_files = st.file_uploader(
-        "1. Контекстные документы:", accept_multiple_files=True, key=f"file_uploader_{st.session_state.app_run_id}"
+        "1. Контекстные документы:", accept_multiple_files=True, key="file_uploader" # Документы остаются между запусками
+    )
+    st.session_state.context_mode_input = st.selectbox(
+        "Передача документов моделям:", options=list(CONTEXT_MODES), format_func=CONTEXT_MODES.get,
+        index=list(CONTEXT_MODES).index(st.session_state.context_mode_input),
+        key=f"context_mode_{st.session_state.app_run_id}",
+        help="Локальный поиск извлекает текст из PDF/DOCX/TXT и отправляет только подходящие фрагменты — меньше входных токенов."
     )
     
     st.session_state.user_prompt_input = st.text_area(
@@ -177,35 +353,108 @@ with st.sidebar:
     st.session_state.model_a_response_input = st.text_area(
         "3. Ответ 'Модели А':", value=st.session_state.model_a_response_input, height=100, key=f"model_a_response_area_{st.session_state.app_run_id}"
     )
+    st.session_state.generation_mode_input = st.selectbox(
+        "Режим генерации:", options=list(GENERATION_MODES), format_func=GENERATION_MODES.get,
+        index=list(GENERATION_MODES).index(st.session_state.generation_mode_input),
+        key=f"generation_mode_{st.session_state.app_run_id}",
+        help="Отдельные запросы идут параллельно: задержка почти не растет с кол-вом ответов, а сбой одного ответа не теряет остальные."
+    )
+    st.session_state.evaluation_mode_input = st.selectbox(
+        "Режим оценки:", options=list(EVALUATION_MODES), format_func=EVALUATION_MODES.get,
+        index=list(EVALUATION_MODES).index(st.session_state.evaluation_mode_input),
+        key=f"evaluation_mode_{st.session_state.app_run_id}",
+        help=f"Турнир: судья сравнивает не больше {pipeline.TOURNAMENT_GROUP_SIZE_DEFAULT} кандидатов за запрос, "
+             "группы оцениваются параллельно, победители выходят в следующий раунд. "
+             "Самосогласованность: несколько оценок с разным порядком кандидатов отправляются сразу, итог — по большинству голосов. "
+             "Каскад: сначала голосует дешевая модель, оценочная модель вызывается, только если ее голоса не согласны."
+    )
+    if st.session_state.evaluation_mode_input == "self_consistency":
+        st.session_state.self_consistency_votes_input = st.number_input(
+            "Голосов судьи:", min_value=2, max_value=15, value=st.session_state.self_consistency_votes_input, step=1,
+            key=f"self_consistency_votes_{st.session_state.app_run_id}",
+            help="Оставшиеся запросы отменяются, как только большинство голосов совпало."
+        )
+    evaluation_models = list(dict.fromkeys((st.session_state.evaluation_model_input, *EVALUATION_MODEL_CHOICES)))
+    st.session_state.evaluation_model_input = st.selectbox(
+        "Модель оценки:", options=evaluation_models,
+        index=evaluation_models.index(st.session_state.evaluation_model_input),
+        key=f"evaluation_model_{st.session_state.app_run_id}",
+        help="При смене только модели оценки файлы и 'неправильные' ответы берутся из прошлого запуска."
+    )
+    if st.session_state.evaluation_mode_input == "cascade":
+        st.session_state.cascade_threshold_input = st.slider(
+            "Порог согласия дешевой модели:", min_value=0.0, max_value=1.0,
+            value=float(st.session_state.cascade_threshold_input), step=0.05,
+            key=f"cascade_threshold_{st.session_state.app_run_id}",
+            help=f"Дешевая модель голосует {pipeline.CASCADE_SCREEN_VOTES_DEFAULT} раза с разным порядком кандидатов. "
+                 "Если доля голосов за лидера ниже порога, кейс оценивает оценочная модель."
+        )
+    max_incorrect_samples = MAX_INCORRECT_SAMPLES[st.session_state.generation_mode_input]
+    if st.session_state.generation_mode_input == "fanout" and st.session_state.evaluation_mode_input == "tournament":
+        max_incorrect_samples = TOURNAMENT_MAX_INCORRECT_SAMPLES
     st.session_state.num_incorrect_samples_input = st.number_input(
-        "4. Кол-во 'неправильных' примеров:", min_value=1, max_value=4, # Макс 4 для компактности UI
-        value=st.session_state.num_incorrect_samples_input, step=1, key=f"num_incorrect_{st.session_state.app_run_id}"
+        "4. Кол-во 'неправильных' примеров:", min_value=1, max_value=max_incorrect_samples,
+        value=min(st.session_state.num_incorrect_samples_input, max_incorrect_samples), step=1,
+        key=f"num_incorrect_{st.session_state.app_run_id}_{st.session_state.generation_mode_input}_{max_incorrect_samples}"
+    )
+    st.session_state.structured_output_input = st.checkbox(
+        "Структурированный вывод (JSON)", value=st.session_state.structured_output_input,
+        key=f"structured_output_{st.session_state.app_run_id}",
+        help="Модели отвечают JSON по схеме. Невалидный ответ исправляется небольшим запросом без повтора полного."
+    )
+    if st.session_state.generation_mode_input == "single" and not st.session_state.structured_output_input:
+        st.session_state.stream_generation_input = st.checkbox(
+            "Потоковая генерация", value=st.session_state.stream_generation_input,
+            key=f"stream_generation_{st.session_state.app_run_id}", help="'Неправильные' ответы появляются по мере готовности."
+        )
+    st.session_state.resume_from_checkpoints_input = st.checkbox(
+        "Продолжить с сохраненных этапов", value=st.session_state.resume_from_checkpoints_input,
+        key=f"resume_from_checkpoints_{st.session_state.app_run_id}",
+        help="Этапы, уже выполненные с теми же входами (файлы, промпт, настройки), берутся из чекпоинтов без запросов к API."
     )
 
     run_button_disabled = not st.session_state.gemini_configured or \
                           not st.session_state.user_prompt_input.strip() or \
-                          not st.session_state.model_a_response_input.strip()
+                          not st.session_state.model_a_response_input.strip() or \
+                          job_running
 
     if st.button("🚀 Запустить Оценку", type="primary", use_container_width=True, disabled=run_button_disabled, key=f"run_button_{st.session_state.app_run_id}"):
         st.session_state.app_run_id += 1
-        st.session_state.log_messages = [] 
+        gemini_utils.get_log_buffer().clear()
         st.session_state.processing_complete = False
         gemini_utils.log_info("=== Новый сеанс GeminiJudge ===")
-        # Флаг для запуска обработки в основном потоке
-        st.session_state.processing_initiate = True 
-        st.rerun() # Перезапускаем, чтобы основной поток увидел флаг
+        # Этапы выполняются в общем пуле фоновых задач; скрипт только опрашивает задачу и не блокируется
+        job_state = {key: st.session_state[key] for key in JOB_INPUT_KEYS}
+        job_state["log_messages"] = gemini_utils.get_log_buffer()
+        job = job_registry.submit("judgment", run_judgment_job, job_state)
+        st.session_state.active_job_id = job.id
+        st.query_params["job"] = job.id
+        st.rerun()
 
     st.divider()
     st.subheader("Журнал операций")
-    # ... (код для журнала без изменений) ...
-    if st.session_state.log_messages:
-        for level, message in reversed(st.session_state.log_messages):
-            if level == "info": st.sidebar.info(message)
-            elif level == "success": st.sidebar.success(message)
-            elif level == "warning": st.sidebar.warning(message)
-            elif level == "error": st.sidebar.error(message)
+    log_records = gemini_utils.get_log_buffer()
+    if log_records:
+        num_log_pages = math.ceil(len(log_records) / LOG_PAGE_SIZE)
+        log_page = 1
+        if num_log_pages > 1:
+            log_page = st.sidebar.number_input(
+                f"Страница журнала (1 — новые, всего {num_log_pages}):", min_value=1, max_value=num_log_pages, value=1,
+                key=f"log_page_{st.session_state.app_run_id}"
+            )
+        for record in log_records.latest(LOG_PAGE_SIZE, offset=(log_page - 1) * LOG_PAGE_SIZE):
+            message = f"`{time.strftime('%H:%M:%S', time.localtime(record.timestamp))}`"
+            if record.stage: message += f" `{record.stage}`"
+            message += f" {record.message}"
+            if record.duration_s is not None: message += f" _({record.duration_s:.2f} с)_"
+            if record.level == "info": st.sidebar.info(message)
+            elif record.level == "success": st.sidebar.success(message)
+            elif record.level == "warning": st.sidebar.warning(message)
+            elif record.level == "error": st.sidebar.error(message)
+        if log_records.dropped:
+            st.sidebar.caption(f"Самые старые записи ({log_records.dropped}) вытеснены из журнала.")
         if st.sidebar.button("Очистить журнал", key=f"clear_log_{st.session_state.app_run_id}", use_container_width=True):
-            st.session_state.log_messages = []
+            log_records.clear()
             st.rerun()
     else:
         st.sidebar.caption("Журнал пуст.")
@@ -214,58 +463,53 @@ with st.sidebar:
 # --- UI: Основная Область (Результаты и Статус) ---
 st.title("Результаты Оценки GeminiJudge")
 
-if "processing_initiate" not in st.session_state:
-    st.session_state.processing_initiate = False
-
-if st.session_state.processing_initiate:
-    overall_success = True
-    st.session_state.generated_incorrect_responses = []
-    st.session_state.evaluation_result_id = None
-    st.session_state.evaluation_rationale = ""
-    st.session_state.all_responses_for_evaluation = {}
-
-    with st.status("Этап 0: Подготовка файлов...", expanded=True) as status_files:
-        # ... (логика обработки файлов без изменений) ...
-        if not handle_file_uploads_and_processing(st.session_state.uploaded_st_files):
-            st.error("Проблема с подготовкой файлов.")
-            status_files.update(label="Ошибка подготовки файлов!", state="error", expanded=True)
-            overall_success = False
-        elif not st.session_state.processed_gemini_files and st.session_state.uploaded_st_files:
-             st.warning("Файлы были предоставлены, но ни один не активен.")
-             status_files.update(label="Файлы не активны!", state="warning", expanded=True)
-        else:
-            status_files.update(label="Файлы подготовлены/пропущены.", state="complete", expanded=False)
-
-
-    if overall_success:
-        with st.status(f"Этап 1: Генерация {st.session_state.num_incorrect_samples_input} 'неправильных' ответов (модель: {os.getenv('GEMINI_MODEL_GENERATION', gemini_utils.MODEL_NAME_FOR_GENERATION_DEFAULT)})...", expanded=True) as status_gen:
-            # ... (логика генерации неправильных ответов без изменений) ...
-            if not generate_and_parse_incorrect_responses_logic(st.session_state.user_prompt_input, st.session_state.model_a_response_input, st.session_state.num_incorrect_samples_input):
-                st.warning("Проблема с генерацией 'неправильных' ответов.")
-                status_gen.update(label="Ошибка генерации 'неправильных'!", state="warning", expanded=True)
-            else:
-                status_gen.update(label="'Неправильные' ответы сгенерированы!", state="complete", expanded=False)
-    
-    if overall_success: 
-        with st.status(f"Этап 2: Оценка всех ответов (модель: {os.getenv('GEMINI_MODEL_EVALUATION', gemini_utils.MODEL_NAME_FOR_EVALUATION_DEFAULT)})...", expanded=True) as status_eval:
-            # ... (логика оценки ответов без изменений) ...
-            if not evaluate_all_responses_logic(st.session_state.user_prompt_input, st.session_state.model_a_response_input):
-                st.error("Не удалось получить оценку от Gemini.")
-                status_eval.update(label="Ошибка оценки!", state="error", expanded=True)
-                overall_success = False
-            else:
-                status_eval.update(label="Ответы оценены!", state="complete", expanded=False)
-
-    
-    if overall_success:
-        gemini_utils.log_success("=== Сеанс GeminiJudge завершен успешно! ===")
-        st.balloons()
-    else:
-        gemini_utils.log_error("=== Сеанс GeminiJudge завершен с ошибками/предупреждениями. ===")
-    
+@st.fragment(run_every=JOB_POLL_INTERVAL_S)
+def show_job_progress(job_id: str):
+    """Ход фоновой задачи. Перерисовывается только этот фрагмент; когда задача завершится — весь скрипт."""
+    job = job_registry.get(job_id)
+    if job is None or job.finished:
+        st.rerun()
+    progress = job.progress()
+    if job.status == "queued":
+        st.info("Запуск в очереди: все рабочие потоки заняты другими запусками.")
+    for stage, stage_progress in progress.get("stages", {}).items():
+        # У st.status нет состояния 'warning' — показываем как ошибку, текст метки уточняет
+        status_state = "error" if stage_progress["state"] == "warning" else stage_progress["state"]
+        with st.status(stage_progress["label"], state=status_state, expanded=status_state != "complete"):
+            if stage == pipeline.STAGE_FILES:
+                for file_line in progress.get("files", []):
+                    st.caption(file_line)
+            elif stage == pipeline.STAGE_GENERATION and progress.get("distractors"):
+                # Колонки заполняются по мере того, как приходит очередной ответ
+                stream_cols = st.columns(min(job.state["num_incorrect_samples_input"], 3))
+                for distractor in progress["distractors"]:
+                    with stream_cols[distractor["index"] % len(stream_cols)]:
+                        with st.container(border=True):
+                            st.markdown(f"**Плохой ответ #{distractor['index'] + 1}** · {distractor['elapsed_s']:.1f} с")
+                            st.caption(distractor["text"])
+    latest_records = job.state["log_messages"].latest(1)
+    if latest_records:
+        st.caption(f"{job.elapsed_s() or 0:.1f} с · {latest_records[0].message}")
+    if st.button("⏹️ Отменить запуск", key=f"cancel_job_{job_id}", disabled=job.cancel_event.is_set()):
+        job_registry.cancel(job_id)
+        gemini_utils.log_warning("Запрошена отмена: текущие запросы к моделям будут завершены, новые не начнутся.")
+
+
+if job_running:
+    show_job_progress(active_job.id)
+elif active_job is not None and st.session_state.applied_job_id != active_job.id:
+    for key in JOB_RESULT_KEYS:
+        if key in active_job.state:
+            st.session_state[key] = active_job.state[key]
+    st.session_state.applied_job_id = active_job.id
     st.session_state.processing_complete = True
-    st.session_state.processing_initiate = False 
-    st.rerun() 
+    if active_job.status == "done" and active_job.result:
+        st.balloons()
+
+if active_job is not None and active_job.status == "cancelled":
+    st.warning("Запуск отменен. Показаны результаты завершенных этапов.")
+elif active_job is not None and active_job.status == "error":
+    st.error(f"Запуск завершился ошибкой: {active_job.error}")
 
 # Отображение результатов
 if st.session_state.processing_complete:
@@ -283,6 +527,19 @@ if st.session_state.processing_complete:
             st.warning(f"**Выбран: {chosen_id_display} (Один из 'неправильных' вариантов!)**")
         else: 
             st.info(f"**Выбран: {chosen_id_display}**")
+        if st.session_state.evaluation_votes:
+            voting = st.session_state.evaluation_votes
+            votes_text = ' · '.join(f'{candidate_id}: {count}' for candidate_id, count in voting['votes'].items())
+            if voting.get("escalated") is None:
+                st.caption(
+                    f"Согласие судей: {voting['confidence']:.0%} ({votes_text}); "
+                    f"запросов отправлено {voting['calls']['requested']}, отменено досрочно {voting['calls']['cancelled']}."
+                )
+            else:
+                st.caption(
+                    f"Каскад: согласие дешевой модели {voting['confidence']:.0%} ({votes_text or 'голосов нет'}); "
+                    + ("выбор сделала оценочная модель." if voting["escalated"] else "оценочная модель не понадобилась.")
+                )
 
         chosen_text = st.session_state.all_responses_for_evaluation.get(st.session_state.evaluation_result_id)
         if chosen_text:
@@ -297,9 +554,26 @@ if st.session_state.processing_complete:
             st.caption("Обоснование не было предоставлено или не удалось извлечь.")
         st.divider()
 
+    # Обоснования всех групп турнира, по раундам
+    if st.session_state.evaluation_rounds:
+        with st.expander(f"🏟️ Раунды турнира ({len(st.session_state.evaluation_rounds)})", expanded=False):
+            for round_number, round_groups in enumerate(st.session_state.evaluation_rounds, start=1):
+                st.markdown(f"**Раунд {round_number}** · групп: {len(round_groups)}")
+                for group in round_groups:
+                    with st.container(border=True):
+                        st.markdown(f"{', '.join(group['candidates'])} → **{group['winner'] or 'не оценено'}**")
+                        if group["rationale"]:
+                            st.caption(group["rationale"])
+
     # Затем отображение всех ответов (включая "неправильные")
     if st.session_state.all_responses_for_evaluation:
         st.header("🗂️ Все Рассмотренные Ответы")
+        if st.session_state.retrieval_context is not None:
+            savings = st.session_state.retrieval_context.savings_report()
+            st.caption(
+                f"Локальный контекст: отправлено ~{savings['context_tokens_sent']} токенов документов за {savings['calls']} запрос(а) "
+                f"вместо ~{savings['tokens_if_attached']} при прикреплении файлов (экономия {savings['savings_ratio']:.0%})."
+            )
         
         # Ответ Модели А
         with st.expander(f"Ответ 'Модели А' ({prompts.MODEL_A_ANSWER_ID})", expanded=False):
@@ -308,6 +582,8 @@ if st.session_state.processing_complete:
         # Сгенерированные "неправильные" ответы
         if st.session_state.generated_incorrect_responses:
             st.subheader("Сгенерированные 'Неправильные' Ответы:")
+            if st.session_state.time_to_first_distractor_s is not None:
+                st.caption(f"Время до первого 'неправильного' ответа: {st.session_state.time_to_first_distractor_s:.2f} с")
             num_cols = min(len(st.session_state.generated_incorrect_responses), 3) # Максимум 3 колонки
             cols_incorrect = st.columns(num_cols) 
             
@@ -322,6 +598,40 @@ if st.session_state.processing_complete:
                     with st.container(border=True, height=250): # Ограничим высоту для компактности
                         st.markdown(f"**{exp_title} ({incorrect_id})**")
                         st.caption(resp_text)
+
+    # Время этапов и расход токенов последнего запуска
+    if st.session_state.run_metrics:
+        run_metrics = st.session_state.run_metrics
+        with st.expander("⏱️ Время и токены запуска", expanded=False):
+            st.dataframe(
+                [{"Этап": STAGE_LABELS.get(stage, stage), "Длительность, с": duration}
+                 for stage, duration in run_metrics["stages"].items()],
+                hide_index=True, use_container_width=True
+            )
+            if run_metrics["tokens_by_model_type"]:
+                st.dataframe(
+                    [{"Модель": model_type, "Запросов": totals["requests"], "Токены промпта": totals["prompt_tokens"],
+                      "Токены ответа": totals["candidates_tokens"], "Всего токенов": totals["total_tokens"]}
+                     for model_type, totals in run_metrics["tokens_by_model_type"].items()],
+                    hide_index=True, use_container_width=True
+                )
+            if run_metrics["uploads"]:
+                st.caption(" · ".join(
+                    f"{upload['file']}: {upload['duration_s']:.2f} с ({upload['status']})" for upload in run_metrics["uploads"]
+                ))
+            for stage, outcomes in run_metrics.get("structured_outputs", {}).items():
+                st.caption(
+                    f"{STAGE_LABELS.get(stage, stage)}, JSON-ответы: валидных {outcomes['valid']}, исправлено {outcomes['repaired']} "
+                    f"(сэкономлено полных запросов: {outcomes['repaired']}), не исправлено {outcomes['failed']}."
+                )
+            # Накопленные метрики процесса (все сессии) — для выгрузки во внешний мониторинг
+            col_prom, col_json = st.columns(2)
+            with col_prom:
+                st.download_button("Метрики процесса (Prometheus)", metrics.REGISTRY.to_prometheus(),
+                                   file_name="geminijudge_metrics.prom", mime="text/plain", use_container_width=True)
+            with col_json:
+                st.download_button("Метрики процесса (JSON)", json.dumps(metrics.REGISTRY.snapshot(), ensure_ascii=False, indent=2),
+                                   file_name="geminijudge_metrics.json", mime="application/json", use_container_width=True)
 else:
-    if not any(st.session_state.log_messages):
+    if not st.session_state.log_messages:
          st.info("Настройте параметры в боковой панели слева и запустите оценку.")
\ No newline at end of file
@@ -0,0 +1,472 @@
+# geminijudge/batch_judge.py
+# Пакетная оценка без UI: читает кейсы из JSONL, обрабатывает их параллельно и пишет результаты в JSONL по мере готовности.
+#
+# Формат строки входного файла:
+#   {"case_id": "c1", "prompt": "...", "model_a_response": "...", "documents": ["docs/a.pdf"], "num_incorrect_samples": 2}
+# Необязательные поля "generation_mode" ("single" | "fanout"), "context_mode" ("attach" | "retrieval")
+# "evaluation_mode" ("single" | "tournament" | "self_consistency" | "cascade"), "num_votes", "cascade_threshold"
+# и "structured_output" (true | false) переопределяют одноименные параметры командной строки.
+# Необязательное "prompt_family" задает группу кейса в хранилище результатов (по умолчанию — первые слова промпта).
+# Пути документов считаются относительно каталога входного файла.
+#
+# Пример: python batch_judge.py cases.jsonl results.jsonl --concurrency 8
+# Регрессионный прогон без сети: один раз с --replay record, затем с --replay strict.
+# После падения: тот же запуск с --resume пропускает готовые кейсы, а в недоделанных берет завершенные этапы из чекпоинтов.
+import argparse
+import dataclasses
+import json
+import logging
+import mimetypes
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, Optional, Set, TextIO
+
+from dotenv import load_dotenv
+
+import prompts
+import gemini_utils
+import pipeline
+import log_buffer
+import upload_cache
+import response_cache
+import metrics
+import replay
+import results_store as results_store_module
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_NUM_INCORRECT_SAMPLES = 2
+
+
+@dataclass(frozen=True)
+class BatchOptions:
+    """Параметры прогона по умолчанию; одноименные поля кейса (num_samples — "num_incorrect_samples") их переопределяют."""
+    num_samples: int = DEFAULT_NUM_INCORRECT_SAMPLES
+    stream: bool = False
+    generation_mode: str = "single"
+    context_mode: str = "attach"
+    evaluation_mode: str = "single"
+    structured_output: bool = False
+    resume: bool = False
+    num_votes: int = pipeline.SELF_CONSISTENCY_VOTES_DEFAULT
+    cascade_threshold: float = pipeline.CASCADE_CONFIDENCE_THRESHOLD_DEFAULT
+
+    def for_case(self, case: Dict[str, Any]) -> "BatchOptions":
+        return dataclasses.replace(
+            self,
+            num_samples=int(case.get("num_incorrect_samples", self.num_samples)),
+            generation_mode=case.get("generation_mode", self.generation_mode),
+            context_mode=case.get("context_mode", self.context_mode),
+            evaluation_mode=case.get("evaluation_mode", self.evaluation_mode),
+            structured_output=bool(case.get("structured_output", self.structured_output)),
+            num_votes=int(case.get("num_votes", self.num_votes)),
+            cascade_threshold=float(case.get("cascade_threshold", self.cascade_threshold)),
+        )
+
+
+class LocalDocument:
+    """Локальный файл с тем же интерфейсом, что и UploadedFile из Streamlit (name, type, getvalue)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    def getvalue(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+def iter_cases(input_stream: TextIO, base_dir: str = ".") -> Iterator[Dict[str, Any]]:
+    """Построчно читает кейсы, не загружая весь файл в память. Битые строки отдаются как кейсы с ошибкой."""
+    for line_no, line in enumerate(input_stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            case = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield {"case_id": f"line_{line_no}", "_error": f"Некорректный JSON: {e}"}
+            continue
+        case.setdefault("case_id", f"line_{line_no}")
+        case["documents"] = [
+            doc if os.path.isabs(doc) else os.path.join(base_dir, doc)
+            for doc in case.get("documents", [])
+        ]
+        yield case
+
+
+def judge_case(
+    case: Dict[str, Any],
+    options: Optional[BatchOptions] = None,
+    results_store: Optional[results_store_module.ResultsStore] = None
+) -> Dict[str, Any]:
+    """
+    Прогоняет один кейс через все этапы пайплайна. Никогда не бросает исключений — ошибка попадает в результат.
+    options.resume=True: завершенные ранее этапы кейса (с теми же входами) берутся из чекпоинтов.
+    results_store: оцененный кейс добавляется в хранилище результатов (запись пачками).
+    """
+    options = options or BatchOptions()
+    with gemini_utils.log_context(run_id=case.get("case_id")), metrics.recording_run(metrics.RunRecorder()) as recorder:
+        result = _judge_case(case, options)
+    result["metrics"] = recorder.breakdown()
+    if results_store is not None and not case.get("_error"):
+        results_store.append(results_store_module.build_record(
+            "batch", case.get("case_id"), result["status"], case.get("prompt", ""), case.get("model_a_response", ""),
+            result.get("incorrect_responses", []), result.get("evaluation_result_id"),
+            rationale=result.get("evaluation_rationale", ""), prompt_family=case.get("prompt_family"),
+            generation_mode=case.get("generation_mode", options.generation_mode),
+            evaluation_mode=case.get("evaluation_mode", options.evaluation_mode),
+            generation_model=gemini_utils.get_model_name("generation"),
+            evaluation_model=gemini_utils.get_model_name("evaluation"),
+            elapsed_s=result.get("elapsed_s"), run_metrics=result["metrics"]
+        ))
+    return result
+
+
+def _judge_case(case: Dict[str, Any], options: BatchOptions) -> Dict[str, Any]:
+    started = time.perf_counter()
+    result: Dict[str, Any] = {"case_id": case.get("case_id"), "status": "error"}
+    try:
+        if case.get("_error"):
+            result["error"] = case["_error"]
+            return result
+        user_prompt = case.get("prompt", "")
+        model_a_response = case.get("model_a_response", "")
+        if not user_prompt.strip() or not model_a_response.strip():
+            result["error"] = "Кейс должен содержать непустые 'prompt' и 'model_a_response'."
+            return result
+
+        documents = [LocalDocument(path) for path in case.get("documents", [])]
+        missing = [doc.path for doc in documents if not os.path.isfile(doc.path)]
+        if missing:
+            result["error"] = f"Документы не найдены: {', '.join(missing)}"
+            return result
+
+        options = options.for_case(case)
+        stage_checkpoints = pipeline.StageCheckpoints(pipeline.document_digests(documents), resume=options.resume)
+        processed_files: list = []
+        retrieval_context = None
+        if options.context_mode == "retrieval":
+            retrieval_context, _ = pipeline.prepare_retrieval_context(documents)
+            if documents and retrieval_context is None:
+                result["error"] = "Ни из одного документа не удалось извлечь текст."
+                return result
+        else:
+            processed_files, _ = pipeline.upload_documents_resumable(documents, stage_checkpoints)
+            if documents and not processed_files:
+                result["error"] = "Ни один из документов не был успешно обработан."
+                return result
+
+        structured_output = options.structured_output
+        evaluation_mode = options.evaluation_mode
+
+        def record_first_distractor(index: int, resp_text: str, elapsed_s: float):
+            result.setdefault("time_to_first_distractor_s", round(elapsed_s, 3))
+
+        def generate(existing_responses: list, num_missing: int) -> list:
+            if options.generation_mode == "fanout":
+                return pipeline.generate_incorrect_responses_fanout(
+                    user_prompt, model_a_response, num_missing, files_for_context=processed_files,
+                    on_distractor=record_first_distractor, retrieval_context=retrieval_context,
+                    structured_output=structured_output, existing_responses=existing_responses
+                )
+            return pipeline.generate_incorrect_responses(
+                user_prompt, model_a_response, num_missing, files_for_context=processed_files,
+                on_distractor=record_first_distractor if options.stream else None, retrieval_context=retrieval_context,
+                structured_output=structured_output, existing_responses=existing_responses
+            )
+
+        incorrect_responses = stage_checkpoints.run_distractors(generate, {
+            "prompt": user_prompt, "model_a_response": model_a_response,
+            "generation_mode": options.generation_mode, "context_mode": options.context_mode,
+            "structured_output": structured_output,
+        }, options.num_samples)
+        result["incorrect_responses"] = incorrect_responses
+        if not incorrect_responses:
+            result["error"] = "Не удалось получить 'неправильные' ответы."
+            return result
+
+        evaluation = stage_checkpoints.run(
+            pipeline.STAGE_EVALUATION,
+            lambda: pipeline.evaluate_responses_by_mode(
+                evaluation_mode, user_prompt, model_a_response, incorrect_responses, files_for_context=processed_files,
+                retrieval_context=retrieval_context, structured_output=structured_output, num_votes=options.num_votes,
+                cascade_threshold=options.cascade_threshold
+            ),
+            {
+                "prompt": user_prompt, "model_a_response": model_a_response, "incorrect_responses": incorrect_responses,
+                "evaluation_mode": evaluation_mode, "context_mode": options.context_mode, "structured_output": structured_output,
+                **({"num_votes": options.num_votes} if evaluation_mode == "self_consistency" else {}),
+                **({"cascade_threshold": options.cascade_threshold, "screening_model": gemini_utils.get_model_name("screening")}
+                   if evaluation_mode == "cascade" else {}),
+            },
+            is_complete=lambda evaluation: evaluation.chosen_id is not None,
+            encode=pipeline.encode_evaluation_result, decode=pipeline.decode_evaluation_result
+        )
+        if evaluation_mode == "tournament":
+            result["evaluation_rounds"] = evaluation.rounds
+        elif evaluation_mode == "self_consistency":
+            result["votes"] = evaluation.votes
+            result["confidence"] = evaluation.confidence
+            result["vote_calls"] = evaluation.calls
+        elif evaluation_mode == "cascade":
+            result["votes"] = evaluation.votes
+            result["confidence"] = evaluation.confidence
+            result["escalated"] = evaluation.escalated
+            result["cascade_calls"] = evaluation.calls
+        if retrieval_context is not None:
+            result["token_savings"] = retrieval_context.savings_report()
+        result["evaluation_result_id"] = evaluation.chosen_id
+        result["evaluation_rationale"] = evaluation.rationale
+        if evaluation.chosen_id is None:
+            result["error"] = "Оценочная модель не вернула распознаваемый ID."
+            return result
+        result["model_a_won"] = evaluation.chosen_id == prompts.MODEL_A_ANSWER_ID
+        if stage_checkpoints.restored_stages:
+            result["restored_stages"] = stage_checkpoints.restored_stages
+        result["status"] = "ok"
+        return result
+    except Exception as e:
+        result["error"] = f"{type(e).__name__} - {e}"
+        return result
+    finally:
+        result["elapsed_s"] = round(time.perf_counter() - started, 3)
+
+
+def run_batch(
+    cases: Iterator[Dict[str, Any]],
+    output_stream: TextIO,
+    options: Optional[BatchOptions] = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    completed_case_ids: Optional[Set[Any]] = None,
+    results_store: Optional[results_store_module.ResultsStore] = None
+) -> Dict[str, Any]:
+    """
+    Обрабатывает кейсы с ограничением параллелизма и пишет каждый результат сразу после его готовности.
+    options — общие параметры кейсов (None — BatchOptions() по умолчанию).
+    В работе одновременно не больше 2 * concurrency кейсов, поэтому входной файл может быть любого размера.
+    Кейсы из completed_case_ids пропускаются (их результаты уже есть в выходном файле).
+    results_store: куда добавлять оцененные кейсы для истории (None — не сохранять).
+    """
+    concurrency = max(1, concurrency)
+    completed_case_ids = completed_case_ids or set()
+    summary = {"total": 0, "ok": 0, "error": 0, "model_a_won": 0, "skipped": 0}
+    structured_outcomes = dict.fromkeys(metrics.STRUCTURED_OUTCOMES, 0)
+    vote_calls = {"cases": 0, "requested": 0, "voted": 0, "failed": 0, "cancelled": 0, "confidence_sum": 0.0}
+    cascade = {"cases": 0, "escalated": 0, "screening": 0, "evaluation": 0}
+    started = time.perf_counter()
+
+    def write_result(result: Dict[str, Any]):
+        output_stream.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output_stream.flush()
+        summary["total"] += 1
+        summary[result["status"]] += 1
+        if result.get("model_a_won"):
+            summary["model_a_won"] += 1
+        if result.get("vote_calls"):
+            vote_calls["cases"] += 1
+            vote_calls["confidence_sum"] += result.get("confidence") or 0.0
+            for kind, count in result["vote_calls"].items():
+                vote_calls[kind] += count
+        if result.get("cascade_calls"):
+            cascade["cases"] += 1
+            cascade["escalated"] += bool(result.get("escalated"))
+            for model_type, count in result["cascade_calls"].items():
+                cascade[model_type] += count
+        for outcomes in result.get("metrics", {}).get("structured_outputs", {}).values():
+            for outcome, count in outcomes.items():
+                structured_outcomes[outcome] += count
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="judge") as executor:
+        pending = set()
+        for case in cases:
+            if case.get("case_id") is not None and case.get("case_id") in completed_case_ids:
+                summary["skipped"] += 1
+                continue
+            pending.add(executor.submit(judge_case, case, options, results_store))
+            if len(pending) >= 2 * concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write_result(future.result())
+        for future in wait(pending).done:
+            write_result(future.result())
+
+    elapsed = time.perf_counter() - started
+    summary["elapsed_s"] = round(elapsed, 3)
+    summary["cases_per_minute"] = round(summary["total"] / elapsed * 60, 2) if elapsed > 0 else 0.0
+    summary["upload_cache"] = upload_cache.get_upload_cache().stats()
+    if response_cache.is_enabled():
+        summary["response_cache"] = response_cache.get_response_cache().stats()
+    structured_total = sum(structured_outcomes.values())
+    if structured_total:
+        # Каждый исправленный ответ — сэкономленный повтор полного запроса с документами
+        summary["structured_output"] = {
+            "responses": structured_total, **structured_outcomes,
+            "parse_failure_rate": round((structured_outcomes["repaired"] + structured_outcomes["failed"]) / structured_total, 4),
+            "full_calls_saved": structured_outcomes["repaired"],
+        }
+    if vote_calls["cases"]:
+        # Голоса сверх кворума отправляются только при расхождении; calls_per_case — все отправленные запросы,
+        # включая отмененные в полете досрочной остановкой
+        summary["self_consistency"] = {
+            "cases": vote_calls["cases"],
+            "mean_confidence": round(vote_calls["confidence_sum"] / vote_calls["cases"], 4),
+            "calls_per_case": round(vote_calls["requested"] / vote_calls["cases"], 3),
+            "cancelled_calls": vote_calls["cancelled"],
+            "requested_calls": vote_calls["requested"],
+        }
+    if cascade["cases"]:
+        # Кейсы без эскалации обошлись без запросов к дорогой оценочной модели
+        summary["cascade"] = {
+            "cases": cascade["cases"],
+            "escalated": cascade["escalated"],
+            "escalation_rate": round(cascade["escalated"] / cascade["cases"], 4),
+            "screening_calls": cascade["screening"],
+            "evaluation_calls": cascade["evaluation"],
+        }
+    if results_store is not None:
+        results_store.flush()
+        summary["results_store"] = results_store.stats()
+    if replay.get_store():
+        summary["replay"] = replay.get_store().stats()
+    return summary
+
+
+def load_completed_results(path: str) -> Set[Any]:
+    """
+    Для --resume: оставляет в выходном файле только успешные результаты (ошибочные кейсы будут пересчитаны,
+    недописанная строка после падения отбрасывается) и возвращает их case_id.
+    """
+    if not os.path.exists(path):
+        return set()
+    completed_case_ids = set()
+    kept_lines = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get("status") == "ok" and result.get("case_id") is not None:
+                completed_case_ids.add(result["case_id"])
+                kept_lines.append(json.dumps(result, ensure_ascii=False) + "\n")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(kept_lines)
+    os.replace(tmp_path, path)
+    return completed_case_ids
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="GeminiJudge: пакетная оценка кейсов из JSONL.")
+    parser.add_argument("input", help="JSONL-файл с кейсами ('-' для stdin).")
+    parser.add_argument("output", help="JSONL-файл для результатов ('-' для stdout).")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Сколько кейсов обрабатывать одновременно.")
+    parser.add_argument("--num-samples", type=int, default=DEFAULT_NUM_INCORRECT_SAMPLES,
+                        help="Кол-во 'неправильных' ответов, если в кейсе не указано num_incorrect_samples.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Потоковая генерация: в результат пишется time_to_first_distractor_s.")
+    parser.add_argument("--generation-mode", choices=["single", "fanout"], default="single",
+                        help="single — один запрос на все 'неправильные' ответы, fanout — параллельный запрос на каждый.")
+    parser.add_argument("--context-mode", choices=["attach", "retrieval"], default="attach",
+                        help="attach — прикреплять файлы целиком, retrieval — только релевантные фрагменты (локальный BM25).")
+    parser.add_argument("--evaluation-mode", choices=["single", "tournament", "self_consistency", "cascade"], default="single",
+                        help="single — все кандидаты в одном запросе, tournament — по группам с выбыванием (для больших пулов), "
+                             "self_consistency — несколько параллельных голосов с досрочной остановкой, "
+                             "cascade — сначала дешевая модель, дорогая только при низком согласии.")
+    parser.add_argument("--votes", type=int, default=pipeline.SELF_CONSISTENCY_VOTES_DEFAULT,
+                        help="Сколько голосов в режиме self_consistency.")
+    parser.add_argument("--cascade-threshold", type=float, default=pipeline.CASCADE_CONFIDENCE_THRESHOLD_DEFAULT,
+                        help="Режим cascade: минимальная доля согласных голосов дешевой модели, при которой "
+                             "дорогая модель не вызывается (0..1).")
+    parser.add_argument("--structured-output", action="store_true",
+                        help="Запрашивать ответы JSON по схеме; невалидный JSON исправляется небольшим запросом.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Продолжить прерванный прогон: пропустить кейсы, успешные в выходном файле, и взять готовые этапы из чекпоинтов.")
+    parser.add_argument("--api-key", default=None, help="API ключ Google AI (по умолчанию GOOGLE_API_KEY).")
+    parser.add_argument("--fake-backend", action="store_true", help="Использовать локальную заглушку вместо Gemini API.")
+    parser.add_argument("--fake-latency", type=float, default=0.0, help="Задержка ответа заглушки, сек.")
+    parser.add_argument("--replay", choices=replay.MODES, default=None,
+                        help="Запись/воспроизведение ответов API: record, replay или strict (по умолчанию GEMINIJUDGE_REPLAY).")
+    parser.add_argument("--replay-path", default=None,
+                        help="Файл записи ответов (по умолчанию GEMINIJUDGE_REPLAY_PATH или кэш-каталог/replay.jsonl.gz).")
+    parser.add_argument("--no-results-store", action="store_true",
+                        help="Не добавлять результаты прогона в хранилище истории (GEMINIJUDGE_RESULTS_STORE=0 — то же для всех запусков).")
+    parser.add_argument("--log-jsonl", default=None, help="Писать журнал операций (структурированные записи) в этот JSONL-файл.")
+    parser.add_argument("--metrics-out", default=None,
+                        help="Сохранить метрики процесса после прогона: *.json — снимок JSON, иначе текстовый формат Prometheus.")
+    parser.add_argument("--log-level", default="WARNING", help="Уровень логирования (INFO, WARNING, ...).")
+    return parser
+
+
+def main(argv: Optional[list] = None) -> int:
+    load_dotenv()
+    args = build_arg_parser().parse_args(argv)
+    if args.resume and args.output == "-":
+        print("--resume требует выходной файл (не stdout).", file=sys.stderr)
+        return 2
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s [%(threadName)s] %(message)s")
+
+    if args.fake_backend:
+        import fake_gemini
+        fake_gemini.install(latency_s=args.fake_latency)
+    replay_mode = args.replay or replay.get_mode()
+    # Слой записи ставится поверх заглушки, чтобы можно было записать и прогон на --fake-backend
+    replay.install(replay_mode, args.replay_path)
+    api_key = args.api_key or os.getenv("GOOGLE_API_KEY", "")
+    if args.fake_backend and not api_key:
+        api_key = "fake"
+    elif replay_mode == "strict" and not api_key:
+        # В строгом режиме сеть не используется, ключ нужен только для конфигурации
+        api_key = "replay"
+    if not gemini_utils.configure_gemini_api(api_key=api_key):
+        print("Gemini API не сконфигурирован: укажите --api-key или GOOGLE_API_KEY.", file=sys.stderr)
+        return 2
+
+    log_sink = None
+    if args.log_jsonl:
+        log_sink = log_buffer.JsonlLogSink(args.log_jsonl)
+        gemini_utils.add_log_sink(log_sink)
+
+    completed_case_ids = load_completed_results(args.output) if args.resume else set()
+    input_stream = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    output_stream = sys.stdout if args.output == "-" else open(args.output, "a" if args.resume else "w", encoding="utf-8")
+    base_dir = "." if args.input == "-" else os.path.dirname(os.path.abspath(args.input))
+    results_store = None
+    if results_store_module.is_enabled() and not args.no_results_store:
+        results_store = results_store_module.get_results_store()
+    try:
+        options = BatchOptions(
+            num_samples=args.num_samples, stream=args.stream, generation_mode=args.generation_mode,
+            context_mode=args.context_mode, evaluation_mode=args.evaluation_mode,
+            structured_output=args.structured_output, resume=args.resume, num_votes=args.votes,
+            cascade_threshold=args.cascade_threshold,
+        )
+        summary = run_batch(
+            iter_cases(input_stream, base_dir), output_stream, options, concurrency=args.concurrency,
+            completed_case_ids=completed_case_ids, results_store=results_store
+        )
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+        if log_sink:
+            gemini_utils.remove_log_sink(log_sink)
+            log_sink.close()
+
+    if args.metrics_out:
+        if args.metrics_out.endswith(".json"):
+            metrics.REGISTRY.write_json(args.metrics_out)
+        else:
+            metrics.REGISTRY.write_prometheus(args.metrics_out)
+
+    print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
+    return 0 if summary["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
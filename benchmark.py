@@ -0,0 +1,514 @@
+# geminijudge/benchmark.py
+# Бенчмарк пайплайна на локальной заглушке Gemini (fake_gemini.py): без сети и без расхода квоты.
+# Каждый сценарий задает распределение задержек, ошибки и размер ответов; измеряются кейсы/с,
+# перцентили длительности этапов и запросов, доля ошибок, размеры ответов и пик памяти.
+# Отдельно меряется пропускная способность парсеров (ответы генерации и оценки) и хранилища результатов
+# (запись пачками и агрегаты истории по миллиону строк), а также пик RSS при загрузке больших документов
+# в заглушку File API (каждый замер — в отдельном процессе, чтобы пик не наследовался от прошлых).
+# Результат — JSON, который можно сравнить с сохраненным прогоном другого коммита (--compare).
+#
+# Пример: python benchmark.py --out bench.json
+#         python benchmark.py --quick --compare bench.json
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+from googleapiclient.http import DEFAULT_CHUNK_SIZE
+
+import prompts
+import metrics
+import pipeline
+import results_store
+
+# Сценарий: параметры заглушки (fake_gemini.install) и прогона (batch_judge.run_batch)
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "baseline": {"latency": ("fixed", 0.05), "cases": 48, "concurrency": 8, "num_samples": 3},
+    "streaming": {"latency": ("fixed", 0.05), "cases": 48, "concurrency": 8, "num_samples": 3, "stream": True},
+    "fanout": {"latency": ("fixed", 0.05), "cases": 24, "concurrency": 4, "num_samples": 8, "generation_mode": "fanout"},
+    "tail_latency": {"latency": ("lognormal", 0.05, 0.8), "cases": 96, "concurrency": 8, "num_samples": 3},
+    # То же распределение с дублированием запросов после p90 (включается после HEDGE_MIN_SAMPLES замеров)
+    "tail_latency_hedged": {"latency": ("lognormal", 0.05, 0.8), "cases": 96, "concurrency": 8, "num_samples": 3,
+                            "env": {"GEMINIJUDGE_HEDGE_PERCENTILE": "90"}},
+    # Очень тяжелый хвост и жесткий срок: зависшие запросы заканчиваются таймаутом, а не ожиданием
+    "deadline": {"latency": ("lognormal", 0.05, 1.5), "cases": 48, "concurrency": 8, "num_samples": 3,
+                 "env": {"GEMINIJUDGE_DEADLINE_S_GENERATION": "0.3", "GEMINIJUDGE_DEADLINE_S_EVALUATION": "0.3"}},
+    "errors": {"latency": ("uniform", 0.05, 0.5), "cases": 48, "concurrency": 8, "num_samples": 3,
+               "error_rate": 0.05, "processing_failure_rate": 0.05, "env": {"GEMINIJUDGE_RETRY_BASE_DELAY_S": "0.05"}},
+    "large_responses": {"latency": ("fixed", 0.05), "cases": 24, "concurrency": 8, "num_samples": 4,
+                        "response_padding_chars": 4000},
+    # Длинный ответ модели А и такие же длинные 'неправильные' ответы: 8 штук не помещаются в max_output_tokens
+    # по умолчанию, бюджет ответа поднимается заранее (token_budget.plan_output_tokens), а не после обрыва
+    "long_answers": {"latency": ("fixed", 0.05), "cases": 24, "concurrency": 8, "num_samples": 8,
+                     "response_padding_chars": 2400, "model_a_response_chars": 2400},
+    "retrieval": {"latency": ("fixed", 0.05), "cases": 48, "concurrency": 8, "num_samples": 3, "context_mode": "retrieval"},
+    # Большой пул: 32 кандидата на кейс, судья видит не больше 4 за запрос (3 раунда вместо одного огромного промпта)
+    "tournament": {"latency": ("fixed", 0.05), "cases": 12, "concurrency": 4, "num_samples": 31,
+                   "generation_mode": "fanout", "evaluation_mode": "tournament"},
+    # JSON по схеме; 10% ответов приходят оборванными и исправляются небольшим запросом без документов
+    "structured": {"latency": ("fixed", 0.05), "cases": 48, "concurrency": 8, "num_samples": 3,
+                   "structured_output": True, "invalid_json_rate": 0.1},
+    # Шумный судья: в 30% оценок выбирает первого кандидата в списке. 5 голосов с разным порядком кандидатов,
+    # голосование останавливается, как только исход ясен
+    "self_consistency": {"latency": ("lognormal", 0.05, 0.5), "cases": 48, "concurrency": 8, "num_samples": 3,
+                         "evaluation_mode": "self_consistency", "position_bias_rate": 0.3},
+    # Медленная оценочная модель (медиана 0.4 с) и шумная дешевая: 15% оценок выбирают первого кандидата.
+    # expensive_judge — каждый кейс оценивает дорогая модель; cascade — сначала 2 голоса дешевой, дорогая только при расхождении
+    "expensive_judge": {"latency": ("fixed", 0.05), "cases": 48, "concurrency": 8, "num_samples": 3,
+                        "model_latency": {"gemini-2.5-flash-preview-04-17": ("lognormal", 0.4, 0.5)},
+                        "position_bias_rate": 0.15},
+    "cascade": {"latency": ("fixed", 0.05), "cases": 48, "concurrency": 8, "num_samples": 3,
+                "model_latency": {"gemini-2.5-flash-preview-04-17": ("lognormal", 0.4, 0.5)},
+                "position_bias_rate": 0.15, "evaluation_mode": "cascade"},
+    # Квота "сервера" 1200 RPM на каждую модель (потолок — 20 кейсов/с: по одному запросу к каждой модели на кейс).
+    # Без клиентских лимитов планировщик подбирает темп по 429, с лимитами сразу держит его чуть ниже квоты
+    "quota_unmanaged": {"latency": ("fixed", 0.05), "cases": 96, "concurrency": 32, "num_samples": 3,
+                        "quota_rpm": 1200, "quota_burst": 4, "env": {"GEMINIJUDGE_RETRY_BASE_DELAY_S": "0.05"}},
+    "quota_managed": {"latency": ("fixed", 0.05), "cases": 96, "concurrency": 32, "num_samples": 3,
+                      "quota_rpm": 1200, "quota_burst": 4,
+                      "env": {"GEMINIJUDGE_RETRY_BASE_DELAY_S": "0.05", "GEMINIJUDGE_RPM": "1140",
+                              "GEMINIJUDGE_RATE_LIMITS": json.dumps({
+                                  "gemini-2.0-flash-lite": {"rpm": 1140, "burst": 4},
+                                  "gemini-2.5-flash-preview-04-17": {"rpm": 1140, "burst": 4},
+                              })}},
+}
+# Для --quick: меньше кейсов, чтобы прогон занимал секунды
+QUICK_CASES = 12
+DOCUMENT_PARAGRAPHS = 200
+PROCESSING_DELAY_S = 0.3
+PARSER_ITERATIONS = 200
+RESULTS_STORE_ROWS = 1_000_000
+QUICK_RESULTS_STORE_ROWS = 100_000
+RESULTS_STORE_DAYS = 90
+RESULTS_STORE_FAMILIES = 200
+# Загрузки: документы в памяти (как UploadedFile из Streamlit) размером UPLOAD_FILE_MB и скорость "сети" заглушки
+UPLOAD_FILE_MB = 200
+QUICK_UPLOAD_FILE_MB = 32
+UPLOAD_BANDWIDTH_MB_S = 400
+UPLOAD_SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "streamed": {"uploads": 4, "concurrency": 4},
+    # Бюджет на два куска клиента File API: одновременно идут две загрузки, остальные ждут в очереди
+    "memory_capped": {"uploads": 4, "concurrency": 4, "budget_uploads": 2},
+}
+# Насколько метрика может ухудшиться относительно базового прогона, прежде чем считаться регрессией
+COMPARE_TOLERANCE_DEFAULT = 0.2
+
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        f"p{int(q * 100)}": round(v, 4) if (v := metrics.quantile(values, q)) is not None else None
+        for q in (0.5, 0.95, 0.99)
+    }
+
+
+def _write_documents(directory: str, scenario_name: str) -> List[str]:
+    """Синтетические документы; имя сценария в тексте дает каждому сценарию свой промах кэша загрузок."""
+    paths = []
+    for doc_index in range(2):
+        path = os.path.join(directory, f"{scenario_name}_{doc_index}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            for i in range(DOCUMENT_PARAGRAPHS):
+                f.write(f"Раздел {i} документа {doc_index} ({scenario_name}): срок поставки {i % 30} дней, "
+                        f"штраф {i * 7 % 100} процентов, ответственный отдел номер {i % 12}.\n\n")
+        paths.append(path)
+    return paths
+
+
+def run_scenario(name: str, config: Dict[str, Any], work_dir: str, num_cases: Optional[int] = None) -> Dict[str, Any]:
+    import fake_gemini
+    import gemini_utils
+    import batch_judge
+    import rate_limiter
+
+    saved_env = {name: os.environ.get(name) for name in config.get("env", {})}
+    os.environ.update(config.get("env", {}))
+    rate_limiter.reset_request_scheduler()
+    latency_kind, *latency_args = config["latency"]
+    fake_gemini.install(
+        latency_s=fake_gemini.latency_distribution(latency_kind, *latency_args),
+        latency_by_model={
+            model_name: fake_gemini.latency_distribution(kind, *args)
+            for model_name, (kind, *args) in config.get("model_latency", {}).items()
+        },
+        processing_delay_s=PROCESSING_DELAY_S,
+        error_rate=config.get("error_rate", 0.0),
+        processing_failure_rate=config.get("processing_failure_rate", 0.0),
+        response_padding_chars=config.get("response_padding_chars", 0),
+        invalid_json_rate=config.get("invalid_json_rate", 0.0),
+        position_bias_rate=config.get("position_bias_rate", 0.0),
+        quota_rpm=config.get("quota_rpm", 0.0),
+        quota_burst=config.get("quota_burst"),
+        seed=config.get("seed", 0),
+    )
+    gemini_utils.clear_model_pool()
+    gemini_utils.configure_gemini_api(api_key="fake")
+    metrics.REGISTRY.reset()
+
+    documents = _write_documents(work_dir, name)
+    num_cases = num_cases or config["cases"]
+    answer_padding = " Подробности условия поставки." * (config.get("model_a_response_chars", 0) // 30)
+    cases = (
+        {"case_id": f"{name}-{i}", "prompt": f"Какой срок поставки указан в разделе {i}?",
+         "model_a_response": f"Срок поставки — {i % 30} дней.{answer_padding}", "documents": documents}
+        for i in range(num_cases)
+    )
+    output = io.StringIO()
+    tracemalloc.start()
+    try:
+        options = batch_judge.BatchOptions(
+            num_samples=config["num_samples"], stream=config.get("stream", False),
+            generation_mode=config.get("generation_mode", "single"), context_mode=config.get("context_mode", "attach"),
+            evaluation_mode=config.get("evaluation_mode", "single"),
+            structured_output=config.get("structured_output", False),
+        )
+        summary = batch_judge.run_batch(cases, output, options, concurrency=config["concurrency"])
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        fake_gemini.uninstall()
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        rate_limiter.reset_request_scheduler()
+
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    case_latencies = [r["elapsed_s"] for r in results]
+    distractor_sizes = [len(text) for r in results for text in r.get("incorrect_responses", [])]
+    rationale_sizes = [len(r["evaluation_rationale"]) for r in results if r.get("evaluation_rationale")]
+    ttfd = [r["time_to_first_distractor_s"] for r in results if r.get("time_to_first_distractor_s") is not None]
+
+    stage_latencies = {
+        stage: _percentiles(metrics.REGISTRY.recent_values(metrics.STAGE_DURATION, stage=stage))
+        for stage in (pipeline.STAGE_FILES, pipeline.STAGE_GENERATION, pipeline.STAGE_EVALUATION)
+    }
+    snapshot = metrics.REGISTRY.snapshot()
+    requests_by_status: Dict[str, float] = {}
+    requests_by_model_type: Dict[str, float] = {}
+    for series in snapshot["counters"].get(metrics.MODEL_REQUESTS, []):
+        status = series["labels"]["status"]
+        requests_by_status[status] = requests_by_status.get(status, 0) + series["value"]
+        model_type = series["labels"]["model_type"]
+        requests_by_model_type[model_type] = requests_by_model_type.get(model_type, 0) + series["value"]
+    total_requests = sum(requests_by_status.values())
+    hedged_requests = sum(series["value"] for series in snapshot["counters"].get(metrics.HEDGED_REQUESTS, []))
+    truncated_responses = sum(series["value"] for series in snapshot["counters"].get(metrics.RESPONSE_TRUNCATIONS, []))
+    retries_by_reason: Dict[str, float] = {}
+    for series in snapshot["counters"].get(metrics.RETRIES, []):
+        reason = series["labels"]["reason"]
+        retries_by_reason[reason] = retries_by_reason.get(reason, 0) + series["value"]
+
+    return {
+        "config": {**config, "cases": num_cases},
+        "cases_per_s": round(summary["total"] / summary["elapsed_s"], 3) if summary["elapsed_s"] else None,
+        "goodput_cases_per_s": round(summary["ok"] / summary["elapsed_s"], 3) if summary["elapsed_s"] else None,
+        "elapsed_s": summary["elapsed_s"],
+        "case_error_rate": round(summary["error"] / summary["total"], 4) if summary["total"] else None,
+        "model_request_error_rate": round(requests_by_status.get("error", 0) / total_requests, 4) if total_requests else None,
+        "requests_by_status": requests_by_status,
+        "requests_by_model_type": requests_by_model_type,
+        "retries": retries_by_reason,
+        "hedged_requests": hedged_requests,
+        "truncated_responses": truncated_responses,
+        "case_latency_s": _percentiles(case_latencies),
+        "stage_latency_s": stage_latencies,
+        "time_to_first_distractor_s": _percentiles(ttfd),
+        "response_chars": {
+            "distractor_mean": round(sum(distractor_sizes) / len(distractor_sizes), 1) if distractor_sizes else None,
+            "rationale_mean": round(sum(rationale_sizes) / len(rationale_sizes), 1) if rationale_sizes else None,
+        },
+        "peak_traced_memory_bytes": peak_bytes,
+        "upload_cache": summary["upload_cache"],
+        "structured_output": summary.get("structured_output"),
+        "self_consistency": summary.get("self_consistency"),
+        "cascade": summary.get("cascade"),
+        "model_a_win_rate": round(summary["model_a_won"] / summary["ok"], 4) if summary["ok"] else None,
+    }
+
+
+def _timed(func, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return time.perf_counter() - started
+
+
+def bench_parsers(iterations: int = PARSER_ITERATIONS) -> Dict[str, Any]:
+    """Пропускная способность парсеров на синтетических ответах (ответов/с и МБ/с)."""
+    distractors = [f"Неправильный ответ {i}: " + "искаженный факт документа, " * 40 for i in range(12)]
+    raw_generation = "Вот ответы:\n" + "\n".join(
+        f"{prompts.INCORRECT_ANSWER_PARSING_PREFIX} {text}\n" for text in distractors
+    )
+    all_responses = pipeline.build_all_responses("ответ модели A", distractors)
+    raw_evaluation = (f"{prompts.get_incorrect_answer_id(3)}\n{prompts.EVALUATION_SECTION_DELIMITER}\n"
+                      + "Обоснование выбора со ссылками на документ. " * 200)
+    json_generation = json.dumps({prompts.DISTRACTORS_JSON_FIELD: distractors}, ensure_ascii=False)
+    json_evaluation = json.dumps({"chosen_id": prompts.get_incorrect_answer_id(3),
+                                  "rationale": "Обоснование выбора со ссылками на документ. " * 200}, ensure_ascii=False)
+    chunk_size = 48
+    generation_chunks = [raw_generation[i:i + chunk_size] for i in range(0, len(raw_generation), chunk_size)]
+
+    def parse_incremental():
+        parser = pipeline.IncrementalDistractorParser()
+        for chunk in generation_chunks:
+            parser.feed(chunk)
+        parser.finish()
+
+    cases = {
+        "parse_incorrect_responses": (lambda: pipeline.parse_incorrect_responses(raw_generation), raw_generation),
+        "incremental_distractor_parser": (parse_incremental, raw_generation),
+        "parse_evaluation_response": (lambda: pipeline.parse_evaluation_response(raw_evaluation, all_responses), raw_evaluation),
+        "parse_structured_distractors": (lambda: pipeline.parse_structured_distractors(json_generation), json_generation),
+        "parse_structured_evaluation": (lambda: pipeline.parse_structured_evaluation(json_evaluation, all_responses), json_evaluation),
+    }
+    report = {}
+    for name, (func, text) in cases.items():
+        elapsed = _timed(func, iterations)
+        size_mb = len(text.encode("utf-8")) / (1024 * 1024)
+        report[name] = {
+            "responses_per_s": round(iterations / elapsed, 1),
+            "mb_per_s": round(size_mb * iterations / elapsed, 2),
+            "input_chars": len(text),
+        }
+    return report
+
+
+def bench_results_store(work_dir: str, rows: int = RESULTS_STORE_ROWS) -> Dict[str, Any]:
+    """
+    Хранилище результатов: скорость записи пачками и время запросов страницы истории
+    на rows синтетических оценок за RESULTS_STORE_DAYS дней.
+    """
+    store = results_store.ResultsStore(os.path.join(work_dir, "results_bench.sqlite3"))
+    now = time.time()
+    models = ("gemini-2.5-flash-preview-04-17", "gemini-2.0-flash-lite")
+    modes = ("single", "self_consistency", "cascade")
+    started = time.perf_counter()
+    for i in range(rows):
+        # Детерминированная "случайность": прогоны разных коммитов пишут одни и те же строки
+        model_a_won = int(i * 7919 % 100 < 70)
+        store.append({
+            "created_at": now - (i * 104729 % (RESULTS_STORE_DAYS * results_store.DAY_S)),
+            "source": "batch" if i % 10 else "ui",
+            "prompt_family": f"семейство {i * 31 % RESULTS_STORE_FAMILIES}",
+            "prompt_hash": f"{i:016x}",
+            "status": "ok" if i % 50 else "error",
+            "evaluation_mode": modes[i % len(modes)],
+            "evaluation_model": models[i % len(models)],
+            "num_candidates": 3,
+            "chosen_id": prompts.MODEL_A_ANSWER_ID if model_a_won else prompts.get_incorrect_answer_id(1),
+            "model_a_won": model_a_won,
+            "fooled": 1 - model_a_won,
+            "elapsed_s": (i * 13 % 500) / 100,
+            "total_tokens": 1000 + i % 3000,
+        })
+    store.flush()
+    insert_s = time.perf_counter() - started
+
+    since_30d = now - 30 * results_store.DAY_S
+    queries = {
+        "summary": lambda: store.summary(),
+        "by_prompt_family": lambda: store.aggregate("prompt_family"),
+        "by_day": lambda: store.aggregate("day"),
+        "by_evaluation_model": lambda: store.aggregate("evaluation_model"),
+        "by_prompt_family_30d": lambda: store.aggregate("prompt_family", since_30d),
+        "by_day_filtered": lambda: store.aggregate("day", since_30d, source="batch", evaluation_model=models[0]),
+        "recent": lambda: store.recent(50),
+    }
+    query_s = {name: round(_timed(query, 3) / 3, 4) for name, query in queries.items()}
+    return {
+        "rows": rows,
+        "insert_rows_per_s": round(rows / insert_s, 1),
+        "write_batches": store.stats()["batches"],
+        "query_s": query_s,
+        # Страница истории выполняет эти запросы вместе
+        "history_page_s": round(sum(query_s[name] for name in ("summary", "by_prompt_family", "by_day", "recent")), 4),
+        "db_mb": round(os.path.getsize(store.path) / (1024 * 1024), 1),
+    }
+
+
+class InMemoryDocument(io.BytesIO):
+    """Документ в памяти с интерфейсом UploadedFile из Streamlit (BytesIO с name и type)."""
+
+    def __init__(self, data: bytes, name: str, mime_type: str):
+        super().__init__(data)
+        self.name = name
+        self.type = mime_type
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS — байты
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def upload_probe(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Замер внутри отдельного процесса: пик RSS до и после параллельной загрузки документов в заглушку."""
+    import fake_gemini
+    import gemini_utils
+    import upload_stream
+
+    fake_gemini.install(upload_bandwidth_mb_s=config["bandwidth_mb_s"])
+    gemini_utils.configure_gemini_api(api_key="fake")
+    block = bytes(range(256)) * 4096
+    # join выделяет память под документ один раз, а BytesIO разделяет ее с bytes без копии
+    documents = [
+        InMemoryDocument(b"".join([f"скан {i}\n".encode("utf-8")] + [block] * config["file_mb"]), f"scan_{i}.pdf", "application/pdf")
+        for i in range(config["uploads"])
+    ]
+    rss_before_mb = _peak_rss_mb()
+    started = time.perf_counter()
+    uploaded, _ = pipeline.upload_documents(documents, max_workers=config["concurrency"])
+    elapsed = time.perf_counter() - started
+    rss_after_mb = _peak_rss_mb()
+    extra_mb = None if rss_before_mb is None else round(rss_after_mb - rss_before_mb, 1)
+    return {
+        "file_mb": config["file_mb"],
+        "uploads": config["uploads"],
+        "uploaded": len(uploaded),
+        "peak_rss_before_mb": rss_before_mb,
+        "peak_rss_mb": rss_after_mb,
+        # Сверх самих документов, которые уже лежат в памяти (как у Streamlit)
+        "extra_peak_rss_mb": extra_mb,
+        "extra_peak_rss_per_upload_mb": None if extra_mb is None else round(extra_mb / config["uploads"], 2),
+        "elapsed_s": round(elapsed, 3),
+        "mb_per_s": round(config["file_mb"] * config["uploads"] / elapsed, 1),
+        "memory_budget": upload_stream.get_upload_memory_budget().stats(),
+    }
+
+
+def bench_uploads(work_dir: str, file_mb: int = UPLOAD_FILE_MB) -> Dict[str, Any]:
+    """Пик RSS на загрузку большого документа: каждый сценарий из UPLOAD_SCENARIOS в отдельном процессе."""
+    report = {}
+    for name, scenario in UPLOAD_SCENARIOS.items():
+        config = {"file_mb": file_mb, "bandwidth_mb_s": UPLOAD_BANDWIDTH_MB_S, **scenario}
+        env = {**os.environ, "GEMINIJUDGE_CACHE_DIR": os.path.join(work_dir, f"upload_{name}")}
+        if "budget_uploads" in scenario:
+            chunk_mb = min(file_mb + 1, DEFAULT_CHUNK_SIZE // (1024 * 1024))
+            env["GEMINIJUDGE_UPLOAD_MEMORY_MB"] = str(scenario["budget_uploads"] * chunk_mb)
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--upload-probe", json.dumps(config)],
+            capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        if completed.returncode != 0:
+            report[name] = {"error": completed.stderr.strip().splitlines()[-1:]}
+            continue
+        report[name] = json.loads(completed.stdout)
+    return report
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Список регрессий: пропускная способность упала или p95 выросла больше чем на tolerance."""
+    regressions = []
+
+    def check(label: str, new: Optional[float], old: Optional[float], higher_is_better: bool):
+        if not new or not old:
+            return
+        change = (old - new) / old if higher_is_better else (new - old) / old
+        if change > tolerance:
+            regressions.append(f"{label}: {old} -> {new} ({change:+.0%})")
+
+    for name, scenario in current["scenarios"].items():
+        old_scenario = baseline.get("scenarios", {}).get(name)
+        if not old_scenario:
+            continue
+        check(f"{name}.cases_per_s", scenario["cases_per_s"], old_scenario["cases_per_s"], True)
+        for stage, percentiles in scenario["stage_latency_s"].items():
+            check(f"{name}.{stage}.p95", percentiles["p95"], old_scenario["stage_latency_s"].get(stage, {}).get("p95"), False)
+    for name, parser_report in current.get("parsers", {}).items():
+        old_parser = baseline.get("parsers", {}).get(name)
+        if old_parser:
+            check(f"parsers.{name}.mb_per_s", parser_report["mb_per_s"], old_parser["mb_per_s"], True)
+    old_store = baseline.get("results_store")
+    if current.get("results_store") and old_store and old_store["rows"] == current["results_store"]["rows"]:
+        check("results_store.insert_rows_per_s", current["results_store"]["insert_rows_per_s"], old_store["insert_rows_per_s"], True)
+        check("results_store.history_page_s", current["results_store"]["history_page_s"], old_store["history_page_s"], False)
+    return regressions
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="GeminiJudge: бенчмарк пайплайна на локальной заглушке Gemini.")
+    parser.add_argument("--out", default="-", help="Куда записать результаты JSON ('-' для stdout).")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Запустить только этот сценарий (можно указать несколько раз).")
+    parser.add_argument("--quick", action="store_true", help=f"По {QUICK_CASES} кейсов на сценарий.")
+    parser.add_argument("--skip-parsers", action="store_true", help="Не мерить пропускную способность парсеров.")
+    parser.add_argument("--skip-results-store", action="store_true", help="Не мерить хранилище результатов.")
+    parser.add_argument("--skip-uploads", action="store_true", help="Не мерить память при загрузке больших документов.")
+    # Служебный: замер загрузок в дочернем процессе (см. bench_uploads)
+    parser.add_argument("--upload-probe", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--compare", default=None, help="JSON предыдущего прогона: вывести регрессии и вернуть код 1.")
+    parser.add_argument("--tolerance", type=float, default=COMPARE_TOLERANCE_DEFAULT,
+                        help="Допустимое ухудшение метрики при сравнении (доля).")
+    return parser
+
+
+def main(argv: Optional[list] = None) -> int:
+    args = build_arg_parser().parse_args(argv)
+    if args.upload_probe:
+        print(json.dumps(upload_probe(json.loads(args.upload_probe)), ensure_ascii=False))
+        return 0
+    with tempfile.TemporaryDirectory(prefix="geminijudge_bench_") as work_dir:
+        # Отдельный каталог кэша и выключенный кэш ответов: прогоны не влияют друг на друга и на рабочий кэш
+        os.environ["GEMINIJUDGE_CACHE_DIR"] = os.path.join(work_dir, "cache")
+        os.environ["GEMINIJUDGE_RESPONSE_CACHE"] = "0"
+
+        report: Dict[str, Any] = {
+            "meta": {
+                "commit": _git_commit(),
+                "timestamp": time.time(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "quick": args.quick,
+            },
+            "scenarios": {},
+        }
+        for name in args.scenario or SCENARIOS:
+            print(f"Сценарий {name}...", file=sys.stderr)
+            report["scenarios"][name] = run_scenario(name, SCENARIOS[name], work_dir, QUICK_CASES if args.quick else None)
+        if not args.skip_parsers:
+            report["parsers"] = bench_parsers()
+        if not args.skip_results_store:
+            print("Хранилище результатов...", file=sys.stderr)
+            report["results_store"] = bench_results_store(work_dir, QUICK_RESULTS_STORE_ROWS if args.quick else RESULTS_STORE_ROWS)
+        if not args.skip_uploads:
+            print("Загрузка больших документов...", file=sys.stderr)
+            report["uploads"] = bench_uploads(work_dir, QUICK_UPLOAD_FILE_MB if args.quick else UPLOAD_FILE_MB)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out == "-":
+        print(text)
+    else:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"РЕГРЕССИЯ {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
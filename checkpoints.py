@@ -0,0 +1,89 @@
+# geminijudge/checkpoints.py
+# Чекпоинты этапов пайплайна (SQLite): результат этапа хранится под хэшем его входов.
+# Повторный запуск берет готовые этапы отсюда и начинает с первого, который упал или входы которого изменились.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import upload_cache
+
+CHECKPOINTS_FILENAME = "checkpoints.sqlite3"
+CHECKPOINT_TTL_S_DEFAULT = 7 * 24 * 3600
+
+
+def is_enabled() -> bool:
+    return os.getenv("GEMINIJUDGE_CHECKPOINTS", "1").lower() in ("1", "true", "yes", "on")
+
+
+def stage_key(stage: str, inputs: Dict[str, Any]) -> str:
+    payload = json.dumps({"stage": stage, "inputs": inputs}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CheckpointStore:
+    def __init__(self, path: str, ttl_s: float):
+        self.path = path
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " key TEXT PRIMARY KEY, stage TEXT NOT NULL, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("DELETE FROM checkpoints WHERE created_at <= ?", (time.time() - ttl_s,))
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM checkpoints WHERE key = ? AND created_at > ?", (key, time.time() - self.ttl_s)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, stage: str, value: Any):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (key, stage, value, created_at) VALUES (?, ?, ?, ?)",
+                (key, stage, json.dumps(value, ensure_ascii=False), time.time()),
+            )
+            self.stores += 1
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM checkpoints").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "stores": self.stores, "entries": entries}
+
+
+_checkpoint_store: Optional[CheckpointStore] = None
+_checkpoint_store_lock = threading.Lock()
+
+
+def get_checkpoint_store() -> CheckpointStore:
+    global _checkpoint_store
+    with _checkpoint_store_lock:
+        if _checkpoint_store is None:
+            _checkpoint_store = CheckpointStore(
+                os.path.join(upload_cache.get_cache_dir(), CHECKPOINTS_FILENAME),
+                ttl_s=float(os.getenv("GEMINIJUDGE_CHECKPOINT_TTL_S", CHECKPOINT_TTL_S_DEFAULT)),
+            )
+        return _checkpoint_store
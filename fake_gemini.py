@@ -0,0 +1,333 @@
+# geminijudge/fake_gemini.py
+# Локальная подмена Gemini API для прогонов без сети и квоты (batch_judge.py --fake-backend)
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from google.api_core import exceptions as google_exceptions
+from googleapiclient.http import DEFAULT_CHUNK_SIZE
+
+import gemini_clients
+import prompts
+import rate_limiter
+
+# Задержка: число секунд или функция без аргументов, возвращающая очередное значение (см. latency_distribution)
+LatencySpec = Union[float, Callable[[], float]]
+
+# Общий генератор случайных чисел заглушки: с одинаковым seed прогоны воспроизводимы
+_rng = random.Random(0)
+_rng_lock = threading.Lock()
+
+
+def _random() -> float:
+    with _rng_lock:
+        return _rng.random()
+
+
+def latency_distribution(kind: str, mean_s: float, spread: float = 0.5) -> Callable[[], float]:
+    """
+    Распределение задержки: "fixed" — всегда mean_s; "uniform" — mean_s * (1 ± spread);
+    "lognormal" — медиана mean_s и sigma=spread, дает редкие длинные хвосты как у настоящего API.
+    """
+    if kind == "fixed":
+        return lambda: mean_s
+    if kind == "uniform":
+        return lambda: max(0.0, mean_s * (1 + spread * (2 * _random() - 1)))
+    if kind == "lognormal":
+        def sample() -> float:
+            with _rng_lock:
+                return _rng.lognormvariate(0.0, spread) * mean_s
+        return sample
+    raise ValueError(f"Неизвестное распределение задержки: {kind}")
+
+
+def _sample_latency(latency: LatencySpec) -> float:
+    return latency() if callable(latency) else latency
+
+
+# Грубая оценка токенов для usage_metadata; прикрепленный файл считаем как одну страницу PDF
+FAKE_CHARS_PER_TOKEN = 4
+FAKE_TOKENS_PER_FILE = 258
+# Кусок, которым клиент File API читает загружаемый файл (resumable-загрузка MediaIoBaseUpload с размером куска
+# по умолчанию): столько памяти одна загрузка держит в худшем случае
+UPLOAD_BLOCK_BYTES = DEFAULT_CHUNK_SIZE
+
+
+def fake_usage(contents: Any, text: str) -> SimpleNamespace:
+    parts = contents if isinstance(contents, list) else [contents]
+    prompt_tokens = sum(
+        len(part) // FAKE_CHARS_PER_TOKEN + 1 if isinstance(part, str) else FAKE_TOKENS_PER_FILE for part in parts
+    )
+    candidates_tokens = len(text) // FAKE_CHARS_PER_TOKEN + 1
+    return SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=candidates_tokens,
+                           total_token_count=prompt_tokens + candidates_tokens)
+
+
+def _sleep_within(delay_s: float, timeout_s: Optional[float], started: float):
+    """Спит delay_s, но не дольше таймаута запроса (request_options["timeout"]) — тогда DeadlineExceeded."""
+    if timeout_s is None or time.monotonic() + delay_s - started <= timeout_s:
+        time.sleep(delay_s)
+        return
+    time.sleep(max(0.0, started + timeout_s - time.monotonic()))
+    raise google_exceptions.DeadlineExceeded("Заглушка: истек таймаут запроса")
+
+
+FakeResponse = gemini_clients.StaticResponse
+
+
+class FakeStreamResponse(gemini_clients.StaticStreamResponse):
+    """Потоковый ответ: итерация отдает фрагменты, равномерно распределяя задержку между ними."""
+
+    def __init__(self, text: str, latency_s: float, usage_metadata: Optional[SimpleNamespace] = None,
+                 timeout_s: Optional[float] = None, finish_reason: str = "STOP"):
+        super().__init__(text, usage_metadata, finish_reason)
+        self._chunk_delay_s = latency_s / max(1, len(self._chunks))
+        self._timeout_s = timeout_s
+
+    def __iter__(self):
+        started = time.monotonic()
+        for chunk in super().__iter__():
+            if self._chunk_delay_s:
+                _sleep_within(self._chunk_delay_s, self._timeout_s, started)
+            yield chunk
+
+
+class FakeGenerativeModel:
+    latency_s: LatencySpec = 0.0
+    # Задержка отдельных моделей (имя без "models/"), например медленной оценочной; остальные — latency_s
+    latency_by_model: Dict[str, LatencySpec] = {}
+    # Доля запросов, которые завершаются ошибкой сервиса (503), как при перегрузке API
+    error_rate: float = 0.0
+    # Сколько символов добавить к каждому ответу/обоснованию, чтобы моделировать большие ответы
+    response_padding_chars: int = 0
+    # Доля JSON-ответов (response_mime_type="application/json"), которые приходят оборванными
+    invalid_json_rate: float = 0.0
+    # Доля оценок, в которых судья выбирает первого кандидата в списке (склонность к позиции), а не ответ модели А
+    position_bias_rate: float = 0.0
+    # Квота "сервера" на модель (0 — без квоты): при превышении запрос получает 429 с подсказкой retry
+    quota_rpm: float = 0.0
+    quota_burst: Optional[float] = None
+    _quota_buckets: Dict[str, rate_limiter.TokenBucket] = {}
+    _quota_lock = threading.Lock()
+
+    def __init__(self, model_name: str, safety_settings: Any = None, generation_config: Any = None,
+                 api_key: Optional[str] = None):
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self.api_key = api_key
+        self._generation_config = generation_config or {}
+
+    def generate_content(self, contents: Any, stream: bool = False, **kwargs) -> FakeResponse:
+        prompt_text = contents[0] if isinstance(contents, list) else str(contents)
+        generation_config = {**self._generation_config, **(kwargs.get("generation_config") or {})}
+        json_output = generation_config.get("response_mime_type") == "application/json"
+        pick_first = bool(self.position_bias_rate) and _random() < self.position_bias_rate
+        text = fake_response_text(prompt_text, self.response_padding_chars, json_output, pick_first)
+        if json_output and self.invalid_json_rate and _random() < self.invalid_json_rate:
+            text = text[:-1]
+        # Как у API: ответ длиннее max_output_tokens обрывается с finish_reason=MAX_TOKENS
+        finish_reason = "STOP"
+        max_output_tokens = generation_config.get("max_output_tokens")
+        if max_output_tokens and len(text) // FAKE_CHARS_PER_TOKEN + 1 > max_output_tokens:
+            text = text[:max_output_tokens * FAKE_CHARS_PER_TOKEN]
+            finish_reason = "MAX_TOKENS"
+        latency_s = _sample_latency(self.latency_by_model.get(self.model_name[len("models/"):], self.latency_s))
+        timeout_s = (kwargs.get("request_options") or {}).get("timeout")
+        started = time.monotonic()
+        self._check_quota()
+        if self.error_rate and _random() < self.error_rate:
+            time.sleep(latency_s)
+            raise google_exceptions.ServiceUnavailable("Заглушка: сервис временно недоступен")
+        if stream:
+            return FakeStreamResponse(text, latency_s, fake_usage(contents, text), timeout_s, finish_reason)
+        if latency_s:
+            _sleep_within(latency_s, timeout_s, started)
+        return FakeResponse(text, fake_usage(contents, text), finish_reason)
+
+    def count_tokens(self, contents: Any) -> SimpleNamespace:
+        return SimpleNamespace(total_tokens=fake_usage(contents, "").prompt_token_count)
+
+    def _check_quota(self):
+        if not self.quota_rpm:
+            return
+        with self._quota_lock:
+            bucket = self._quota_buckets.get(self.model_name)
+            if bucket is None:
+                bucket = self._quota_buckets[self.model_name] = rate_limiter.TokenBucket(self.quota_rpm, self.quota_burst)
+            now = time.monotonic()
+            wait_s = bucket.wait_for(1, now)
+            if wait_s > 0:
+                raise google_exceptions.ResourceExhausted(
+                    f"Заглушка: квота {self.quota_rpm:g} RPM исчерпана. Please retry in {wait_s:.3f}s."
+                )
+            bucket.reserve(1, now)
+
+
+def _close_json(text: str) -> str:
+    """Достраивает оборванный JSON закрывающими скобками — так заглушка "исправляет" ответ по запросу ремонта."""
+    for suffix in ("", "}", "]}", '"}', '"]}'):
+        try:
+            json.loads(text + suffix)
+            return text + suffix
+        except ValueError:
+            continue
+    return text
+
+
+def fake_response_text(prompt_text: str, padding_chars: int = 0, json_output: bool = False, pick_first: bool = False) -> str:
+    """Детерминированный ответ, который понимают парсеры пайплайна."""
+    padding = f" {'подробности ' * (padding_chars // 12 + 1)}"[:padding_chars + 1] if padding_chars else ""
+    if prompts.JSON_REPAIR_INPUT_HEADER in prompt_text:
+        invalid_output = prompt_text.split(prompts.JSON_REPAIR_INPUT_HEADER, 1)[1].split("---\n", 1)[1].rsplit("\n---", 1)[0]
+        return _close_json(invalid_output)
+    if "Варианты ответов для оценки" in prompt_text:
+        # Ответ модели А, если он среди кандидатов (в турнире может и не быть), иначе первый кандидат
+        candidates_block = prompt_text.split("Варианты ответов для оценки", 1)[1]
+        candidate_ids = re.findall(r"^(\S+):$", candidates_block, flags=re.MULTILINE)
+        chosen_id = prompts.MODEL_A_ANSWER_ID if prompts.MODEL_A_ANSWER_ID in candidate_ids or not candidate_ids else candidate_ids[0]
+        if pick_first and candidate_ids:
+            chosen_id = candidate_ids[0]
+        rationale = f"Ответ {chosen_id} подтверждается документами.{padding}"
+        if json_output:
+            return json.dumps({"chosen_id": chosen_id, "rationale": rationale}, ensure_ascii=False)
+        return f"{chosen_id}\n{prompts.EVALUATION_SECTION_DELIMITER}\n{rationale}"
+    match = re.search(r"ровно (\d+)", prompt_text)
+    num_samples = int(match.group(1)) if match else 1
+    # Метка промпта делает ответы на разные промпты (например, с разными подсказками стиля ошибки) различимыми
+    prompt_tag = hashlib.sha1(prompt_text.encode("utf-8")).hexdigest()[:6]
+    answers = [
+        f"Неправильный ответ №{i + 1} [{prompt_tag}], искажающий факты документа.{padding}" for i in range(num_samples)
+    ]
+    if json_output:
+        return json.dumps({prompts.DISTRACTORS_JSON_FIELD: answers}, ensure_ascii=False)
+    return "\n".join(f"{prompts.INCORRECT_ANSWER_PARSING_PREFIX} {answer}" for answer in answers)
+
+
+class FakeFileStore:
+    # Число секунд или функция display_name -> секунды, чтобы задавать разную длительность обработки файлам
+    processing_delay_s: Union[float, Callable[[str], float]] = 0.0
+    # Доля загрузок, которые падают сразу, и доля файлов, которые после обработки переходят в FAILED
+    upload_error_rate: float = 0.0
+    processing_failure_rate: float = 0.0
+    # Скорость "сети" при загрузке, МБ/с (0 — мгновенно)
+    upload_bandwidth_mb_s: float = 0.0
+
+    def __init__(self):
+        self._files: Dict[str, SimpleNamespace] = {}
+        # Файл виден только ключу, с которым загружен (как проекту этого ключа в File API)
+        self._owners: Dict[str, str] = {}
+        self._ready_at: Dict[str, float] = {}
+        self._failing: set = set()
+        self._lock = threading.Lock()
+
+    def _refresh_state(self, name: str) -> SimpleNamespace:
+        gemini_file = self._files[name]
+        if gemini_file.state.name == "PROCESSING" and time.monotonic() >= self._ready_at[name]:
+            gemini_file.state = SimpleNamespace(name="FAILED" if name in self._failing else "ACTIVE")
+        return gemini_file
+
+    def _receive(self, stream: Any) -> int:
+        """Читает загружаемый файл кусками, как клиент настоящего File API, и возвращает его размер."""
+        size = 0
+        while True:
+            block = stream.read(UPLOAD_BLOCK_BYTES)
+            if not block:
+                return size
+            size += len(block)
+            if self.upload_bandwidth_mb_s:
+                time.sleep(len(block) / (self.upload_bandwidth_mb_s * 1024 * 1024))
+            # Кусок отправлен: следующий читается уже без него, как у клиента, который держит один кусок
+            del block
+
+    def upload_file(self, api_key: str, stream: Any, *, mime_type: str, display_name: str) -> SimpleNamespace:
+        size_bytes = self._receive(stream)
+        if self.upload_error_rate and _random() < self.upload_error_rate:
+            raise google_exceptions.ServiceUnavailable("Заглушка: загрузка файла не удалась")
+        file_name = f"files/{uuid.uuid4().hex[:12]}"
+        gemini_file = SimpleNamespace(
+            name=file_name, display_name=display_name or file_name, mime_type=mime_type,
+            state=SimpleNamespace(name="PROCESSING"), error=None, size_bytes=size_bytes,
+            expiration_time=datetime.now(timezone.utc) + timedelta(hours=48),
+        )
+        with self._lock:
+            self._files[file_name] = gemini_file
+            self._owners[file_name] = api_key
+            delay = self.processing_delay_s(gemini_file.display_name) if callable(self.processing_delay_s) else self.processing_delay_s
+            self._ready_at[file_name] = time.monotonic() + delay
+            if self.processing_failure_rate and _random() < self.processing_failure_rate:
+                self._failing.add(file_name)
+            return self._refresh_state(file_name)
+
+    def get_file(self, api_key: str, name: str) -> SimpleNamespace:
+        with self._lock:
+            if name not in self._files or self._owners[name] != api_key:
+                raise KeyError(f"Файл {name} не найден")
+            return self._refresh_state(name)
+
+
+_ORIGINALS: List[tuple] = []
+
+
+def _make_model(api_key: str, model_name: str, **kwargs: Any) -> FakeGenerativeModel:
+    return FakeGenerativeModel(model_name, api_key=api_key, **kwargs)
+
+
+def install(
+    latency_s: LatencySpec = 0.0,
+    latency_by_model: Optional[Dict[str, LatencySpec]] = None,
+    processing_delay_s: Union[float, Callable[[str], float]] = 0.0,
+    error_rate: float = 0.0,
+    upload_error_rate: float = 0.0,
+    processing_failure_rate: float = 0.0,
+    upload_bandwidth_mb_s: float = 0.0,
+    response_padding_chars: int = 0,
+    invalid_json_rate: float = 0.0,
+    position_bias_rate: float = 0.0,
+    quota_rpm: float = 0.0,
+    quota_burst: Optional[float] = None,
+    seed: int = 0
+) -> FakeFileStore:
+    """
+    Подменяет модели и вызовы File API в gemini_clients на локальные заглушки.
+    Повторный вызов перенастраивает задержки, ошибки и seed.
+    """
+    uninstall()
+    with _rng_lock:
+        _rng.seed(seed)
+    # Функцию оборачиваем в staticmethod, иначе через self она станет связанным методом
+    FakeGenerativeModel.latency_s = staticmethod(latency_s) if callable(latency_s) else latency_s
+    # Из словаря функция достается без привязки к self, staticmethod не нужен
+    FakeGenerativeModel.latency_by_model = dict(latency_by_model or {})
+    FakeGenerativeModel.error_rate = error_rate
+    FakeGenerativeModel.response_padding_chars = response_padding_chars
+    FakeGenerativeModel.invalid_json_rate = invalid_json_rate
+    FakeGenerativeModel.position_bias_rate = position_bias_rate
+    FakeGenerativeModel.quota_rpm = quota_rpm
+    FakeGenerativeModel.quota_burst = quota_burst
+    FakeGenerativeModel._quota_buckets = {}
+    store = FakeFileStore()
+    store.processing_delay_s = processing_delay_s
+    store.upload_error_rate = upload_error_rate
+    store.processing_failure_rate = processing_failure_rate
+    store.upload_bandwidth_mb_s = upload_bandwidth_mb_s
+    replacements = [
+        (gemini_clients, "make_model", _make_model),
+        (gemini_clients, "upload_file", store.upload_file),
+        (gemini_clients, "get_file", store.get_file),
+    ]
+    for target, attr, replacement in replacements:
+        _ORIGINALS.append((target, attr, getattr(target, attr)))
+        setattr(target, attr, replacement)
+    return store
+
+
+def uninstall():
+    while _ORIGINALS:
+        target, attr, original = _ORIGINALS.pop()
+        setattr(target, attr, original)
@@ -0,0 +1,76 @@
+# geminijudge/gemini_clients.py
+# Явные клиенты Gemini на каждый API ключ. genai.configure задает один ключ на весь процесс, и модели и функции
+# File API берут клиент из него; здесь каждый запрос идет с клиентом того ключа, который выбрал вызывающий (ключ
+# сессии или дополнительный из GOOGLE_API_KEYS), поэтому сессии с разными ключами не отправляют запросы с чужим
+# ключом. Модели и вызовы File API идут через функции модуля: заглушка (fake_gemini.py) и слой записи (replay.py)
+# подменяют именно их.
+import threading
+from types import SimpleNamespace
+from typing import Any, Dict, Optional, Tuple
+
+import google.ai.generativelanguage as glm
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+
+_clients: Dict[Tuple[str, str], Any] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(kind: str, api_key: str) -> Any:
+    """Клиент API ("generative" или "file") для ключа: создается один раз и дальше общий для всех потоков."""
+    with _clients_lock:
+        client = _clients.get((kind, api_key))
+        if client is None:
+            # FileServiceClient из genai умеет загрузку (create_file), которой нет у клиента glm
+            client_cls = genai_client.FileServiceClient if kind == "file" else glm.GenerativeServiceClient
+            client = _clients[(kind, api_key)] = client_cls(client_options={"api_key": api_key})
+        return client
+
+
+class KeyedGenerativeModel(genai.GenerativeModel):
+    """GenerativeModel с клиентом своего ключа; без него модель при первом запросе берет клиент genai.configure."""
+
+    def __init__(self, model_name: str, client: glm.GenerativeServiceClient, **kwargs: Any):
+        super().__init__(model_name, **kwargs)
+        self._client = client
+
+
+def make_model(api_key: str, model_name: str, **kwargs: Any) -> genai.GenerativeModel:
+    """Модель, все запросы которой (generate_content, count_tokens) идут с ключом api_key."""
+    return KeyedGenerativeModel(model_name, get_client("generative", api_key), **kwargs)
+
+
+def upload_file(api_key: str, stream: Any, *, mime_type: str, display_name: str) -> genai.types.File:
+    """Загрузка файла в File API с ключом api_key (как genai.upload_file, но без глобального клиента)."""
+    return genai.types.File(get_client("file", api_key).create_file(
+        path=stream, mime_type=mime_type, display_name=display_name
+    ))
+
+
+def get_file(api_key: str, name: str) -> genai.types.File:
+    return genai.types.File(get_client("file", api_key).get_file(name=name))
+
+
+class StaticResponse:
+    """Готовый ответ с теми полями GenerateContentResponse, которые читает пайплайн (text, parts,
+    candidates[].finish_reason, prompt_feedback, usage_metadata). Его отдают заглушка и воспроизведение записей."""
+
+    def __init__(self, text: str, usage_metadata: Optional[SimpleNamespace] = None, finish_reason: str = "STOP"):
+        self.text = text
+        self.parts = [SimpleNamespace(text=text)] if text else []
+        self.candidates = [SimpleNamespace(finish_reason=SimpleNamespace(name=finish_reason))]
+        self.prompt_feedback = None
+        self.usage_metadata = usage_metadata
+
+
+class StaticStreamResponse(StaticResponse):
+    """Потоковый вариант: итерация отдает текст фрагментами по chunk_size символов, как stream=True."""
+    chunk_size: int = 48
+
+    def __init__(self, text: str, usage_metadata: Optional[SimpleNamespace] = None, finish_reason: str = "STOP"):
+        super().__init__(text, usage_metadata, finish_reason)
+        self._chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+
+    def __iter__(self):
+        for chunk_text in self._chunks:
+            yield StaticResponse(chunk_text)
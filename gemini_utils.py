@@ -1,12 +1,26 @@
 # geminijudge/gemini_utils.py
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx, add_script_run_ctx
 import google.generativeai as genai
 import time
-from io import BytesIO
 import os
-from typing import List, Optional, Any
+import logging
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Optional, Any, Dict, Callable
 import traceback
 
+import upload_cache
+import upload_stream
+import log_buffer
+import response_cache
+import metrics
+import rate_limiter
+import token_budget
+import gemini_clients
+
 # --- Имена моделей ---
 # Можно переопределить через переменные окружения
 MODEL_NAME_FOR_GENERATION_DEFAULT = "gemini-2.0-flash-lite"
@@ -25,112 +39,371 @@ GENERATION_CONFIG_DEFAULTS = { # Общие настройки, можно пе
     "top_k": 40,
     "max_output_tokens": 4096, # Увеличим для потенциально длинных обоснований
 }
+# Готовые конфиги по типам модели, чтобы не копировать словарь на каждый запрос
+GENERATION_CONFIGS = {
+    "generation": dict(GENERATION_CONFIG_DEFAULTS),
+    "evaluation": {**GENERATION_CONFIG_DEFAULTS, "temperature": 0.3}, # Для более точной оценки, меньше "творчества"
+}
+# Предварительная оценка в каскаде (pipeline.evaluate_responses_cascade): дешевая модель с настройками судьи
+GENERATION_CONFIGS["screening"] = GENERATION_CONFIGS["evaluation"]
+
+# --- Ожидание обработки файлов: адаптивный опрос вместо фиксированных 4 с ---
+UPLOAD_POLL_INITIAL_DELAY_S = 0.25
+UPLOAD_POLL_BACKOFF_FACTOR = 1.5
+UPLOAD_POLL_MAX_DELAY_S = 5.0
+UPLOAD_POLL_TIMEOUT_S = 90.0
+
+# --- Сроки ответа моделей и дублирующие (hedged) запросы ---
+# Срок на весь запрос, включая ожидание квоты и повторы; переопределяется GEMINIJUDGE_DEADLINE_S_<ТИП>, 0 — без срока
+REQUEST_DEADLINES_S_DEFAULT = {"generation": 120.0, "evaluation": 240.0, "screening": 120.0}
+# GEMINIJUDGE_HEDGE_PERCENTILE=95: если ответа нет дольше 95-го перцентиля наблюдаемых длительностей,
+# отправляется дубликат запроса и побеждает первый ответивший. Перцентиль считается, когда накоплено столько замеров
+HEDGE_MIN_SAMPLES = 20
+# Как часто ожидание ответа проверяет отмену со стороны вызывающего (cancel_event), с
+CANCEL_POLL_INTERVAL_S = 0.1
+
+# --- Состояние: st.session_state внутри Streamlit, общий словарь процесса в batch/CLI ---
+# Фоновая задача (jobs.py) подменяет состояние своего потока снимком сессии — сессия может закрыться раньше задачи.
+logger = logging.getLogger("geminijudge")
+_HEADLESS_STATE: Dict[str, Any] = {}
+_state_override = threading.local()
+
+class RunCancelled(Exception):
+    """Запуск отменен (см. raise_if_cancelled)."""
+
+def is_streamlit_context() -> bool:
+    return get_script_run_ctx(suppress_warning=True) is not None
 
-# --- Логирование (без изменений) ---
-def log_info(message: str):
-    if "log_messages" not in st.session_state: st.session_state.log_messages = []
-    st.session_state.log_messages.append(("info", message))
+def get_state():
+    """Хранилище состояния: состояние фоновой задачи, st.session_state при запуске через Streamlit, иначе словарь процесса."""
+    override = getattr(_state_override, "state", None)
+    if override is not None:
+        return override
+    if is_streamlit_context():
+        return st.session_state
+    return _HEADLESS_STATE
+
+@contextmanager
+def using_state(state: Dict[str, Any]):
+    """Состояние текущего потока (и пулов, созданных в нем через make_worker_pool) — словарь state."""
+    previous = getattr(_state_override, "state", None)
+    _state_override.state = state
+    try:
+        yield state
+    finally:
+        _state_override.state = previous
+
+def raise_if_cancelled():
+    """Бросает RunCancelled, если в состоянии есть взведенное событие cancel_event (отмена фоновой задачи)."""
+    cancel_event = get_state().get("cancel_event")
+    if cancel_event is not None and cancel_event.is_set():
+        raise RunCancelled("Запуск отменен пользователем.")
+
+def make_worker_pool(max_workers: int, thread_name_prefix: str = "geminijudge") -> ThreadPoolExecutor:
+    """
+    Пул потоков, который наследует контекст Streamlit вызывающего потока,
+    чтобы рабочие потоки писали в журнал и состояние своей сессии.
+    Сами виджеты из рабочих потоков не трогаем — их обновляет только основной поток.
+    """
+    ctx = get_script_run_ctx(suppress_warning=True)
+    state_override = getattr(_state_override, "state", None)
+    log_stage, log_run_id = get_log_context()
+    run_recorder = metrics.get_run_recorder()
 
-def log_success(message: str):
-    if "log_messages" not in st.session_state: st.session_state.log_messages = []
-    st.session_state.log_messages.append(("success", message))
+    def _attach_ctx():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        _state_override.state = state_override
+        _log_context.stage, _log_context.run_id = log_stage, log_run_id
+        metrics.set_run_recorder(run_recorder)
 
-def log_warning(message: str):
-    if "log_messages" not in st.session_state: st.session_state.log_messages = []
-    st.session_state.log_messages.append(("warning", message))
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix, initializer=_attach_ctx)
 
-def log_error(message: str):
-    if "log_messages" not in st.session_state: st.session_state.log_messages = []
-    st.session_state.log_messages.append(("error", message))
+# --- Логирование ---
+# Записи журнала структурированы (см. log_buffer.py). В Streamlit они копятся в кольцевом буфере
+# log_messages состояния сессии (или фоновой задачи), вне Streamlit уходят в logging. Дополнительно — в подключенные приемники (JSONL).
+_LOG_LEVELS = {"info": logging.INFO, "success": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+_log_context = threading.local()
+_LOG_SINKS: List[Any] = []
+
+def get_log_context() -> tuple:
+    return getattr(_log_context, "stage", None), getattr(_log_context, "run_id", None)
+
+@contextmanager
+def log_context(stage: Optional[str] = None, run_id: Optional[Any] = None):
+    """Этап и ID запуска для записей журнала текущего потока (None — оставить внешнее значение)."""
+    previous = get_log_context()
+    _log_context.stage = stage if stage is not None else previous[0]
+    _log_context.run_id = run_id if run_id is not None else previous[1]
+    try:
+        yield
+    finally:
+        _log_context.stage, _log_context.run_id = previous
+
+def add_log_sink(sink: Any):
+    """sink — объект с методом write(LogRecord), например log_buffer.JsonlLogSink."""
+    _LOG_SINKS.append(sink)
+
+def remove_log_sink(sink: Any):
+    if sink in _LOG_SINKS:
+        _LOG_SINKS.remove(sink)
+
+def get_log_buffer() -> log_buffer.LogBuffer:
+    state = get_state()
+    if not isinstance(state.get("log_messages"), log_buffer.LogBuffer):
+        state["log_messages"] = log_buffer.LogBuffer()
+    return state["log_messages"]
+
+def _log(level: str, message: str, duration_s: Optional[float] = None):
+    stage, run_id = get_log_context()
+    in_session = getattr(_state_override, "state", None) is not None or is_streamlit_context()
+    if run_id is None and in_session:
+        run_id = get_state().get("app_run_id")
+    record = log_buffer.make_record(level, message, stage=stage, run_id=run_id, duration_s=duration_s)
+    for sink in _LOG_SINKS:
+        sink.write(record)
+    if not in_session:
+        logger.log(_LOG_LEVELS[level], f"[{stage or '-'}] {message}" if stage else message)
+        return
+    get_log_buffer().append(record)
+
+def log_info(message: str, duration_s: Optional[float] = None):
+    _log("info", message, duration_s)
+
+def log_success(message: str, duration_s: Optional[float] = None):
+    _log("success", message, duration_s)
+
+def log_warning(message: str, duration_s: Optional[float] = None):
+    _log("warning", message, duration_s)
+
+def log_error(message: str, duration_s: Optional[float] = None):
+    _log("error", message, duration_s)
 
 # --- Функции для работы с Gemini ---
-def configure_gemini_api() -> bool:
-    api_key = st.session_state.get("api_key_input")
+# --- Пул клиентов моделей: общий для всех сессий Streamlit и потоков процесса ---
+# Ключ пула включает API ключ: у модели клиент своего ключа, и сессии с разными ключами не мешают друг другу
+_MODEL_POOL: Dict[tuple, genai.GenerativeModel] = {}
+_MODEL_POOL_LOCK = threading.Lock()
+
+def _freeze(value: Any) -> Any:
+    """Хешируемое представление конфигов (dict/list) для ключа пула."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def clear_model_pool():
+    with _MODEL_POOL_LOCK:
+        _MODEL_POOL.clear()
+
+def model_pool_size() -> int:
+    with _MODEL_POOL_LOCK:
+        return len(_MODEL_POOL)
+
+def get_api_keys() -> List[str]:
+    """
+    Ключи вызывающего: основной (из состояния сессии) и дополнительные из GOOGLE_API_KEYS через запятую — между
+    ними делится нагрузка. Передаются планировщику с каждым запросом, ключ сессии в общем планировщике не хранится.
+    """
+    extra_keys = [key.strip() for key in os.getenv("GOOGLE_API_KEYS", "").split(",") if key.strip()]
+    return list(dict.fromkeys([get_state().get("api_key_input") or ""] + extra_keys))
+
+def configure_gemini_api(api_key: Optional[str] = None) -> bool:
+    """
+    Ключ сессии (или фоновой задачи) в ее состоянии. Процесс не настраивается (genai.configure): модели и вызовы
+    File API получают явный клиент ключа из состояния (gemini_clients.py), поэтому смена ключа в одной сессии
+    не затрагивает другие.
+    """
+    state = get_state()
+    if api_key is not None:
+        state["api_key_input"] = api_key
+    api_key = state.get("api_key_input")
     if not api_key:
         log_error("API ключ Google AI не предоставлен.")
-        st.session_state.gemini_configured = False
-        return False
-    try:
-        genai.configure(api_key=api_key)
-        st.session_state.gemini_configured = True
-        log_success("Gemini API успешно сконфигурирован.")
-        return True
-    except Exception as e:
-        log_error(f"Ошибка конфигурации Gemini API: {e}")
-        st.session_state.gemini_configured = False
+        state["gemini_configured"] = False
         return False
+    state["gemini_configured"] = True
+    log_success("Gemini API успешно сконфигурирован.")
+    return True
 
-def get_gemini_model(model_type: str = "generation") -> Optional[genai.GenerativeModel]:
+def get_model_name(model_type: str) -> Optional[str]:
+    # Модель, выбранная в UI для этого запуска (например, evaluation_model_input), важнее переменной окружения
+    selected_model = get_state().get(f"{model_type}_model_input")
+    if selected_model:
+        return selected_model
+    if model_type == "generation":
+        return os.getenv("GEMINI_MODEL_GENERATION", MODEL_NAME_FOR_GENERATION_DEFAULT)
+    if model_type == "evaluation":
+        return os.getenv("GEMINI_MODEL_EVALUATION", MODEL_NAME_FOR_EVALUATION_DEFAULT)
+    if model_type == "screening":
+        return os.getenv("GEMINI_MODEL_SCREENING", MODEL_NAME_FOR_GENERATION_DEFAULT)
+    return None
+
+def get_gemini_model(model_type: str = "generation", api_key: Optional[str] = None) -> Optional[genai.GenerativeModel]:
     """
     Получает инициализированную модель Gemini.
-    model_type: "generation" для генерации примеров, "evaluation" для оценки.
+    model_type: "generation" для генерации примеров, "evaluation" для оценки, "screening" для дешевой предварительной оценки.
+    api_key: ключ, от имени которого пойдут запросы (по умолчанию ключ сессии); у каждого ключа свой клиент.
     """
-    if not st.session_state.get("gemini_configured", False):
-        if st.session_state.get("api_key_input") and not configure_gemini_api():
+    state = get_state()
+    if not state.get("gemini_configured", False):
+        if state.get("api_key_input") and not configure_gemini_api():
              log_error("Авто-конфигурация Gemini API не удалась.")
              return None
-        elif not st.session_state.get("api_key_input"):
+        elif not state.get("api_key_input"):
             return None
             
-    if model_type == "generation":
-        model_name = os.getenv("GEMINI_MODEL_GENERATION", MODEL_NAME_FOR_GENERATION_DEFAULT)
-    elif model_type == "evaluation":
-        model_name = os.getenv("GEMINI_MODEL_EVALUATION", MODEL_NAME_FOR_EVALUATION_DEFAULT)
-    else:
+    model_name = get_model_name(model_type)
+    if model_name is None:
         log_error(f"Неизвестный тип модели запрошен: {model_type}")
         return None
-    
-    # Можно добавить специфичные generation_config для разных моделей
-    current_generation_config = GENERATION_CONFIG_DEFAULTS.copy()
-    if model_type == "evaluation":
-        current_generation_config["temperature"] = 0.3 # Для более точной оценки, меньше "творчества"
 
-    try:
-        model = genai.GenerativeModel(
-            model_name,
-            safety_settings=SAFETY_SETTINGS,
-            generation_config=current_generation_config
-        )
-        log_info(f"Модель Gemini '{model_name}' (для {model_type}) инициализирована.")
+    # Можно добавить специфичные generation_config для разных моделей (см. GENERATION_CONFIGS)
+    current_generation_config = GENERATION_CONFIGS[model_type]
+    api_key = api_key or state.get("api_key_input")
+    pool_key = (
+        model_type, model_name, _freeze(current_generation_config), _freeze(SAFETY_SETTINGS), api_key,
+    )
+    model = _MODEL_POOL.get(pool_key)
+    if model is not None:
         return model
+
+    with _MODEL_POOL_LOCK:
+        model = _MODEL_POOL.get(pool_key)
+        if model is not None:
+            return model
+        try:
+            model = gemini_clients.make_model(
+                api_key,
+                model_name,
+                safety_settings=SAFETY_SETTINGS,
+                generation_config=current_generation_config
+            )
+        except Exception as e:
+            log_error(f"Ошибка инициализации модели '{model_name}' (для {model_type}): {e}")
+            return None
+        _MODEL_POOL[pool_key] = model
+    log_info(f"Модель Gemini '{model_name}' (для {model_type}) инициализирована.")
+    return model
+
+def _file_api_call(func: Callable[[str], Any]) -> Any:
+    """
+    Вызов File API через планировщик: func(api_key). Файлы видны только проекту основного ключа (из состояния),
+    поэтому ключ закреплен.
+    """
+    def on_retry(attempt: int, error: BaseException, delay_s: float):
+        log_warning(f"File API: {type(error).__name__}, повтор {attempt} через {delay_s:.1f} с.")
+    return rate_limiter.get_request_scheduler().call(
+        rate_limiter.FILE_API_MODEL, func, candidates=[get_state().get("api_key_input")], on_retry=on_retry
+    )
+
+def get_active_file(name: str) -> Optional[genai.types.File]:
+    """Ранее загруженный файл, если он еще существует на сервере и активен (без повторной загрузки)."""
+    try:
+        gemini_file = _file_api_call(lambda api_key: gemini_clients.get_file(api_key, name))
     except Exception as e:
-        log_error(f"Ошибка инициализации модели '{model_name}' (для {model_type}): {e}")
+        log_info(f"Файл '{name}' недоступен на сервере ({type(e).__name__}).")
+        return None
+    if gemini_file.state.name != "ACTIVE":
+        log_info(f"Файл '{name}' в состоянии {gemini_file.state.name}.")
+        return None
+    return gemini_file
+
+def _get_cached_active_file(cache_key: str) -> Optional[genai.types.File]:
+    cache = upload_cache.get_upload_cache()
+    cached_name = cache.get(cache_key)
+    if not cached_name:
         return None
+    gemini_file = get_active_file(cached_name)
+    if gemini_file is None:
+        log_info(f"Файл из кэша '{cached_name}' загружаем заново.")
+        cache.invalidate(cache_key)
+    return gemini_file
 
 def upload_file_to_gemini(
     uploaded_file_st_obj: st.runtime.uploaded_file_manager.UploadedFile,
-    display_name_prefix: str = "doc"
+    display_name_prefix: str = "doc",
+    use_cache: bool = True,
+    on_progress: Optional[Callable[[str], None]] = None
 ) -> Optional[genai.types.File]:
+    """
+    on_progress: вызывается с текущим состоянием файла ("QUEUED", "UPLOADING", "CACHED", "PROCESSING", "ACTIVE", ...).
+    Может вызываться из рабочего потока, поэтому не должен рисовать виджеты напрямую.
+    Содержимое не копируется в память целиком: хэш считается по кускам буфера, в File API уходит файловый объект
+    поверх того же буфера (upload_stream.py), а одновременные загрузки ограничены бюджетом памяти процесса
+    (иначе ждут в очереди).
+    """
+    def report(file_state: str):
+        if on_progress:
+            on_progress(file_state)
+
+    raise_if_cancelled()
     # Для загрузки файла не обязательно указывать конкретную модель, т.к. это File API
     # Но конфигурация API все равно должна быть выполнена
-    if not st.session_state.get("gemini_configured", False):
+    if not get_state().get("gemini_configured", False):
         log_error("Невозможно загрузить файл: Gemini API не сконфигурирован.")
         return None
 
     file_display_name = f"{display_name_prefix}_{uploaded_file_st_obj.name}"
     log_info(f"Загрузка файла: {file_display_name} ({uploaded_file_st_obj.type})")
-    
-    file_bytes = uploaded_file_st_obj.getvalue()
-    
+    upload_started = time.perf_counter()
+
+    file_digest = upload_stream.content_digest(uploaded_file_st_obj)
+
+    cache = upload_cache.get_upload_cache()
+    cache_key = upload_cache.content_key(file_digest, uploaded_file_st_obj.type, get_state().get("api_key_input"))
+    if use_cache:
+        cached_file = _get_cached_active_file(cache_key)
+        if cached_file:
+            cache.record_hit()
+            report("CACHED")
+            upload_duration = time.perf_counter() - upload_started
+            log_success(f"Файл '{file_display_name}' найден в кэше загрузок (ID: {cached_file.name}), загрузка пропущена.",
+                        duration_s=upload_duration)
+            metrics.record_upload(file_display_name, "cached", upload_duration)
+            return cached_file
+        cache.record_miss()
+
+    def send(api_key: str) -> genai.types.File:
+        # Поток открывается на каждую попытку: повтор после сбоя читает документ с начала
+        with upload_stream.open_stream(uploaded_file_st_obj) as stream:
+            return gemini_clients.upload_file(api_key, stream, display_name=file_display_name,
+                                              mime_type=uploaded_file_st_obj.type)
+
+    def on_queued():
+        log_info(f"Файл '{file_display_name}' ждет очереди: исчерпан бюджет памяти загрузок.")
+        report("QUEUED")
+
     try:
-        gemini_file = genai.upload_file(
-            path=BytesIO(file_bytes),
-            display_name=file_display_name,
-            mime_type=uploaded_file_st_obj.type
-        )
+        with upload_stream.get_upload_memory_budget().reserve(
+            upload_stream.memory_bytes(uploaded_file_st_obj), on_queued=on_queued, check_cancelled=raise_if_cancelled
+        ):
+            report("UPLOADING")
+            gemini_file = _file_api_call(send)
         log_info(f"Файл '{gemini_file.display_name}' (ID: {gemini_file.name}) отправлен на сервер. Ожидание обработки...")
 
-        delay_seconds = 4 
-        max_retries = 10  
-        retries = 0
-        while gemini_file.state.name == "PROCESSING" and retries < max_retries:
-            time.sleep(delay_seconds)
-            gemini_file = genai.get_file(name=gemini_file.name) 
-            log_info(f"Статус '{gemini_file.display_name}': {gemini_file.state.name} ({retries+1})")
-            retries += 1
-        
+        # Короткие файлы обычно готовы за секунду-две, поэтому начинаем с частого опроса и постепенно его разрежаем
+        delay_seconds = UPLOAD_POLL_INITIAL_DELAY_S
+        deadline = time.monotonic() + UPLOAD_POLL_TIMEOUT_S
+        poll_started = time.perf_counter()
+        polls = 0
+        report(gemini_file.state.name)
+        while gemini_file.state.name == "PROCESSING" and time.monotonic() < deadline:
+            time.sleep(min(delay_seconds, max(0.0, deadline - time.monotonic())))
+            gemini_file = _file_api_call(lambda api_key, name=gemini_file.name: gemini_clients.get_file(api_key, name))
+            polls += 1
+            log_info(f"Статус '{gemini_file.display_name}': {gemini_file.state.name} ({polls})")
+            report(gemini_file.state.name)
+            delay_seconds = min(delay_seconds * UPLOAD_POLL_BACKOFF_FACTOR, UPLOAD_POLL_MAX_DELAY_S)
+        poll_duration = time.perf_counter() - poll_started
+        upload_duration = time.perf_counter() - upload_started
+        metrics.record_upload(file_display_name, gemini_file.state.name.lower(), upload_duration, poll_duration)
+
         if gemini_file.state.name == "ACTIVE":
-            log_success(f"Файл '{gemini_file.display_name}' активен.")
+            log_success(f"Файл '{gemini_file.display_name}' активен.", duration_s=upload_duration)
+            if use_cache:
+                cache.put(cache_key, gemini_file)
             return gemini_file
         elif gemini_file.state.name == "PROCESSING":
             log_warning(f"Файл '{gemini_file.display_name}' еще обрабатывается. Это может повлиять на результат.")
@@ -148,15 +421,158 @@ def upload_file_to_gemini(
                 log_warning(f"Не удалось получить детали ошибки для файла: {e_detail}")
             log_error(error_message)
             return None
+    except RunCancelled:
+        # Отмена во время ожидания очереди загрузок — не ошибка файла
+        raise
     except Exception as e:
-        log_error(f"Исключение при загрузке/обработке '{file_display_name}': {type(e).__name__} - {e}")
+        upload_duration = time.perf_counter() - upload_started
+        log_error(f"Исключение при загрузке/обработке '{file_display_name}': {type(e).__name__} - {e}",
+                  duration_s=upload_duration)
+        metrics.record_upload(file_display_name, "error", upload_duration)
+        report("ERROR")
+        return None
+
+class RequestCancelled(Exception):
+    """Попытка проиграла гонку дублирующих запросов или вызывающий перестал ждать."""
+
+class RequestDeadlineExceeded(Exception):
+    pass
+
+def get_request_deadline(model_type: str) -> Optional[float]:
+    deadline_s = float(os.getenv(f"GEMINIJUDGE_DEADLINE_S_{model_type.upper()}", REQUEST_DEADLINES_S_DEFAULT.get(model_type, 0)))
+    return deadline_s if deadline_s > 0 else None
+
+def get_hedge_delay(model_type: str, model_name: str) -> Optional[float]:
+    """Через сколько секунд без ответа отправлять дубликат; None — дублирование выключено или мало данных."""
+    percentile = float(os.getenv("GEMINIJUDGE_HEDGE_PERCENTILE", "0") or 0)
+    if percentile <= 0:
         return None
+    samples = metrics.REGISTRY.recent_values(metrics.MODEL_REQUEST_DURATION, model_type=model_type, model=model_name)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return metrics.quantile(samples, percentile / 100)
+
+def _race_attempts(
+    run_attempt: Callable[[Callable[[str], None], threading.Event], Any],
+    deadline_s: Optional[float],
+    hedge_delay_s: Optional[float],
+    on_chunk: Optional[Callable[[str], None]],
+    cancel_event: Optional[threading.Event] = None
+) -> tuple:
+    """
+    Запускает run_attempt(forward, cancelled) в рабочем потоке и ждет не дольше deadline_s
+    (иначе RequestDeadlineExceeded). Если за hedge_delay_s ответа нет — запускает вторую такую же попытку.
+    Побеждает попытка, первой отдавшая фрагмент потока (forward) или готовый ответ; проигравшая получает
+    RequestCancelled при следующем forward, а событие cancelled сообщает ей, что ответ больше не нужен.
+    Фрагменты передаются в on_chunk из вызывающего потока.
+    Если взведен cancel_event, ожидание прекращается с RequestCancelled, а попытки получают событие cancelled.
+    Проигравшая или брошенная потоковая попытка останавливается на следующем фрагменте; обычный (не потоковый)
+    запрос прервать нельзя — он доработает в фоне, ограниченный таймаутом транспорта, и его ответ будет отброшен.
+    Без срока и без дубликата гонки нет: попытка выполняется прямо в вызывающем потоке (cancel_event служит ей
+    событием cancelled).
+    Возвращает (ответ, номер победившей попытки, сколько попыток было запущено).
+    """
+    if hedge_delay_s is None and not deadline_s:
+        cancelled = cancel_event or threading.Event()
+
+        def forward_inline(text: str):
+            if cancelled.is_set():
+                raise RequestCancelled()
+            if on_chunk:
+                on_chunk(text)
+        response = run_attempt(forward_inline, cancelled)
+        if cancelled.is_set():
+            raise RequestCancelled()
+        return response, 0, 1
+
+    events: "queue.Queue[tuple]" = queue.Queue()
+    cancelled = threading.Event()
+    race_lock = threading.Lock()
+    winner: List[int] = []
+
+    def claim(index: int) -> bool:
+        with race_lock:
+            if not winner:
+                winner.append(index)
+            return winner[0] == index
+
+    def worker(index: int):
+        def forward(text: str):
+            if cancelled.is_set() or not claim(index):
+                raise RequestCancelled()
+            events.put(("chunk", index, text))
+        try:
+            response = run_attempt(forward, cancelled)
+            events.put(("done", index, response) if claim(index) else ("cancelled", index, None))
+        except RequestCancelled:
+            events.put(("cancelled", index, None))
+        except Exception as e:
+            events.put(("error", index, e))
+
+    started = time.monotonic()
+    pool = make_worker_pool(2, "model_request")
+    try:
+        pool.submit(worker, 0)
+        launched, finished = 1, 0
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelled()
+            now = time.monotonic()
+            waits = []
+            if deadline_s:
+                waits.append(started + deadline_s - now)
+            if hedge_delay_s is not None and launched == 1 and not winner:
+                waits.append(started + hedge_delay_s - now)
+            if cancel_event is not None:
+                waits.append(CANCEL_POLL_INTERVAL_S)
+            try:
+                kind, index, payload = events.get(timeout=max(0.0, min(waits)) if waits else None)
+            except queue.Empty:
+                if deadline_s and time.monotonic() >= started + deadline_s:
+                    raise RequestDeadlineExceeded(f"нет ответа за {deadline_s:g} с")
+                if hedge_delay_s is not None and launched == 1 and not winner:
+                    pool.submit(worker, 1)
+                    launched += 1
+                continue
+            if kind == "chunk":
+                if on_chunk:
+                    on_chunk(payload)
+            elif kind == "done":
+                return payload, index, launched
+            else:
+                finished += 1
+                # Ошибка победившей попытки (после отданных фрагментов) или всех попыток — окончательная
+                if kind == "error" and ((winner and winner[0] == index) or finished == launched):
+                    raise payload
+    finally:
+        cancelled.set()
+        pool.shutdown(wait=False, cancel_futures=True)
 
 def generate_text_from_model(
     prompt_text: str,
-    model_type: str, # "generation" или "evaluation"
-    files_for_context: Optional[List[genai.types.File]] = None
+    model_type: str, # "generation", "evaluation" или "screening"
+    files_for_context: Optional[List[genai.types.File]] = None,
+    bypass_cache: bool = False,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    response_schema: Optional[Dict[str, Any]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    expected_output_tokens: Optional[int] = None
 ) -> Optional[str]:
+    """
+    bypass_cache: не читать и не писать кэш ответов (GEMINIJUDGE_RESPONSE_CACHE=1),
+    например когда нужны разные ответы на один и тот же промпт.
+    response_schema: если задана, модель отвечает JSON по этой схеме (response_mime_type="application/json");
+    возвращается текст JSON, проверка — на стороне вызывающего.
+    on_chunk: если задан, ответ запрашивается потоково и каждый фрагмент текста передается сюда
+    по мере получения (в вызывающем потоке). Возвращается все равно полный текст.
+    Если модель не ответила за срок (get_request_deadline), возвращается None.
+    Отмененный запуск (raise_if_cancelled) не отправляет новых запросов.
+    cancel_event: вызывающий может перестать ждать ответа (например, исход голосования уже ясен) — тогда
+    возвращается None, а потоковый ответ перестает читаться со следующего фрагмента.
+    expected_output_tokens: ожидаемый размер ответа; бюджет max_output_tokens поднимается под него
+    (token_budget.plan_output_tokens). Запрос, который не помещается в контекст модели, не отправляется — возвращается None.
+    """
+    raise_if_cancelled()
     model = get_gemini_model(model_type=model_type)
     if not model:
         log_error(f"Генерация (тип: {model_type}) невозможна: модель не инициализирована.")
@@ -171,11 +587,102 @@ def generate_text_from_model(
         if not active_files_for_request and files_for_context:
             log_warning(f"Для модели ({model_type}): Контекстные файлы были предоставлены, но ни один из них не активен.")
     
+    expected_output_tokens = expected_output_tokens or token_budget.EXPECTED_OUTPUT_TOKENS_DEFAULT.get(model_type)
+    generation_config = GENERATION_CONFIGS[model_type]
+    max_output_tokens = token_budget.plan_output_tokens(model.model_name, generation_config["max_output_tokens"], expected_output_tokens)
+    if max_output_tokens != generation_config["max_output_tokens"]:
+        generation_config = {**generation_config, "max_output_tokens": max_output_tokens}
+    if response_schema is not None:
+        generation_config = {**generation_config, "response_mime_type": "application/json", "response_schema": response_schema}
+
+    cache_key = None
+    if response_cache.is_enabled() and not bypass_cache:
+        cache_key = response_cache.request_key(
+            model.model_name, generation_config, SAFETY_SETTINGS, prompt_text,
+            [response_cache.file_identity(f) for f in active_files_for_request]
+        )
+        cached_text = response_cache.get_response_cache().get(cache_key)
+        if cached_text is not None:
+            log_success(f"Ответ модели ({model.model_name}) взят из кэша ({len(cached_text)} симв.).")
+            metrics.record_model_call(model_type, model.model_name, "cache_hit")
+            if on_chunk:
+                on_chunk(cached_text)
+            return cached_text
+
+    # Размер запроса проверяется только перед отправкой: ответ из кэша не требует подсчета токенов файлов
+    budget = token_budget.plan_request(
+        model, prompt_text, active_files_for_request, GENERATION_CONFIGS[model_type]["max_output_tokens"],
+        expected_output_tokens, api_call=_file_api_call
+    )
+    if not budget.fits:
+        log_error(f"Запрос к модели ({model.model_name}) не отправлен: ~{budget.input_tokens} токенов на входе "
+                  f"при лимите {budget.input_limit}. Сократите документы или ответы.")
+        metrics.record_model_call(model_type, model.model_name, "rejected")
+        return None
+
     log_info(f"Запрос к модели ({model.model_name}, тип: {model_type}). Промпт: {len(prompt_text)} симв. Файлов: {len(active_files_for_request)}.")
     request_parts.extend(active_files_for_request)
 
+    scheduler = rate_limiter.get_request_scheduler()
+    estimated_tokens = budget.input_tokens
+    primary_key = get_state().get("api_key_input")
+    deadline_s = get_request_deadline(model_type)
+    hedge_delay_s = get_hedge_delay(model_type, model.model_name)
+    request_started = time.perf_counter()
+    deadline_at = time.monotonic() + deadline_s if deadline_s else None
+
+    def on_retry(attempt_number: int, error: BaseException, delay_s: float):
+        log_warning(f"Модель ({model.model_name}): {type(error).__name__}, повтор {attempt_number} через {delay_s:.1f} с.")
+
+    def run_attempt(forward: Callable[[str], None], cancelled: threading.Event):
+        attempt_state = {"api_key": primary_key, "streamed": False}
+
+        def attempt(api_key: str):
+            if cancelled.is_set():
+                # Ответ перестал быть нужен, пока попытка ждала лимита
+                raise RequestCancelled()
+            attempt_state["api_key"] = api_key
+            attempt_model = model if api_key == primary_key else (get_gemini_model(model_type, api_key=api_key) or model)
+            request_options = {}
+            if deadline_at:
+                # Таймаут транспорта, чтобы брошенная попытка не висела дольше срока
+                request_options["timeout"] = max(1.0, deadline_at - time.monotonic())
+            # Модель из пула общая, поэтому схема ответа и бюджет ответа передаются только в этот запрос
+            config_override = {"generation_config": generation_config} if generation_config is not GENERATION_CONFIGS[model_type] else {}
+            response = attempt_model.generate_content(
+                request_parts, stream=on_chunk is not None, request_options=request_options, **config_override
+            )
+            if on_chunk:
+                # После полного прохода по потоку response содержит собранный ответ, как и в обычном режиме
+                for chunk in response:
+                    if cancelled.is_set():
+                        raise RequestCancelled()
+                    if chunk.candidates and chunk.parts:
+                        forward(chunk.text)
+                        attempt_state["streamed"] = True
+            return response
+
+        def can_retry() -> bool:
+            in_time = deadline_at is None or time.monotonic() < deadline_at
+            return in_time and not attempt_state["streamed"] and not cancelled.is_set()
+
+        # Загруженные файлы видны только основному ключу; запросы без файлов можно отправлять с любого
+        response = scheduler.call(
+            model.model_name, attempt, estimated_tokens,
+            candidates=[primary_key] if active_files_for_request else get_api_keys(),
+            can_retry=can_retry, on_retry=on_retry
+        )
+        scheduler.settle(attempt_state["api_key"], model.model_name, estimated_tokens,
+                         metrics.usage_from_response(response)["total_tokens"])
+        return response
+
     try:
-        response = model.generate_content(request_parts)
+        response, winner_index, launched = _race_attempts(run_attempt, deadline_s, hedge_delay_s, on_chunk, cancel_event)
+        usage = metrics.usage_from_response(response)
+        if launched > 1:
+            log_info(f"Модель ({model.model_name}): ответа не было {hedge_delay_s:.1f} с, отправлен дубликат; "
+                     f"победил {'дубликат' if winner_index else 'исходный запрос'}.")
+            metrics.REGISTRY.inc(metrics.HEDGED_REQUESTS, model=model.model_name, winner="hedge" if winner_index else "primary")
 
         if not response.parts:
             block_reason = "Причина неизвестна (ответ пуст)"
@@ -188,12 +695,34 @@ def generate_text_from_model(
                     finish_reason_val = candidate.finish_reason.name
                 if finish_reason_val != "STOP" and finish_reason_val != "MAX_TOKENS":
                      block_reason += f" (Finish Reason: {finish_reason_val})"
-            log_warning(f"Модель ({model.model_name}) вернула пустой ответ. {block_reason}")
+            request_duration = time.perf_counter() - request_started
+            log_warning(f"Модель ({model.model_name}) вернула пустой ответ. {block_reason}", duration_s=request_duration)
+            metrics.record_model_call(model_type, model.model_name, "empty", request_duration, usage)
             return None
         
         generated_text = response.text 
-        log_success(f"Модель ({model.model_name}) сгенерировала ответ ({len(generated_text)} симв.).")
+        request_duration = time.perf_counter() - request_started
+        if response.candidates and response.candidates[0].finish_reason and response.candidates[0].finish_reason.name == "MAX_TOKENS":
+            log_warning(f"Ответ модели ({model.model_name}) обрезан по лимиту max_output_tokens={budget.max_output_tokens}.")
+            metrics.REGISTRY.inc(metrics.RESPONSE_TRUNCATIONS, model_type=model_type, model=model.model_name)
+        log_success(f"Модель ({model.model_name}) сгенерировала ответ ({len(generated_text)} симв.).", duration_s=request_duration)
+        metrics.record_model_call(model_type, model.model_name, "ok", request_duration, usage)
+        if cache_key:
+            response_cache.get_response_cache().put(cache_key, generated_text)
         return generated_text
+    except RequestCancelled:
+        request_duration = time.perf_counter() - request_started
+        log_info(f"Запрос к модели ({model.model_name}) отменен: ответ больше не нужен.", duration_s=request_duration)
+        metrics.record_model_call(model_type, model.model_name, "cancelled", request_duration)
+        return None
+    except RequestDeadlineExceeded as e:
+        request_duration = time.perf_counter() - request_started
+        log_error(f"Модель ({model.model_name}) не ответила в срок: {e}.", duration_s=request_duration)
+        metrics.record_model_call(model_type, model.model_name, "timeout", request_duration)
+        return None
     except Exception as e:
-        log_error(f"Ошибка при генерации контента моделью ({model.model_name if model else 'N/A'}): {type(e).__name__} - {e}")
+        request_duration = time.perf_counter() - request_started
+        log_error(f"Ошибка при генерации контента моделью ({model.model_name if model else 'N/A'}): {type(e).__name__} - {e}",
+                  duration_s=request_duration)
+        metrics.record_model_call(model_type, model.model_name, "error", request_duration)
         return None
\ No newline at end of file
@@ -0,0 +1,156 @@
+# geminijudge/jobs.py
+# Фоновые задачи для Streamlit: общий для всех сессий пул потоков и реестр задач со статусом, прогрессом и отменой.
+# Скрипт Streamlit только ставит задачу и опрашивает ее, поэтому не блокируется, а результат переживает перезагрузку страницы
+# (ID задачи хранится в URL, сама задача — в процессе).
+# Владельца у задачи нет: ссылка ?job=<id> — это ссылка-доступ. ID — случайный uuid4 (122 бита), угадать его нельзя,
+# и кто получил ссылку, видит ввод и результаты задачи (кроме ключа API). Поэтому другим пользователям ID не показывается
+# нигде, кроме URL самой сессии (логи и журнал результатов — на стороне оператора), и в реестре нет списка задач.
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import gemini_utils
+import metrics
+
+JOB_WORKERS_DEFAULT = 4
+# Сколько хранить завершенные задачи, с
+JOB_TTL_S_DEFAULT = 24 * 3600
+JOB_STATUSES = ("queued", "running", "done", "error", "cancelled")
+FINISHED_STATUSES = ("done", "error", "cancelled")
+
+logger = logging.getLogger("geminijudge")
+
+
+class Job:
+    """
+    Одна фоновая задача. state — снимок состояния сессии на момент запуска: в потоке задачи он подменяет
+    st.session_state (gemini_utils.get_state), туда же задача пишет результаты.
+    progress — произвольные поля для отображения хода работы; пишет задача, читает UI.
+    """
+
+    def __init__(self, kind: str, state: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.state = state
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.result: Any = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.cancel_event = threading.Event()
+        self.recorder = metrics.RunRecorder()
+        self._progress: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        state["cancel_event"] = self.cancel_event
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def update_progress(self, **fields):
+        with self._lock:
+            self._progress.update(fields)
+
+    def progress(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._progress)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        """Точка отмены между шагами задачи: бросает gemini_utils.RunCancelled, если отмена запрошена."""
+        if self.cancel_event.is_set():
+            raise gemini_utils.RunCancelled("Запуск отменен пользователем.")
+
+    def elapsed_s(self) -> Optional[float]:
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+
+class JobRegistry:
+    def __init__(self, max_workers: int, ttl_s: float):
+        self.max_workers = max_workers
+        self.ttl_s = ttl_s
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, func: Callable[[Job], Any], state: Dict[str, Any]) -> Job:
+        """Ставит func(job) в общий пул. Если свободных потоков нет, задача ждет в статусе queued."""
+        job = Job(kind, state)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func)
+        return job
+
+    def _run(self, job: Job, func: Callable[[Job], Any]):
+        if job.cancel_event.is_set():
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            return
+        job.started_at = time.time()
+        job.status = "running"
+        with gemini_utils.using_state(job.state), metrics.recording_run(job.recorder), \
+                gemini_utils.log_context(run_id=job.state.get("app_run_id")):
+            try:
+                job.result = func(job)
+                job.status = "done"
+            except gemini_utils.RunCancelled:
+                gemini_utils.log_warning("Запуск отменен.")
+                job.status = "cancelled"
+            except Exception as e:
+                logger.exception("Фоновая задача %s (%s) завершилась ошибкой", job.id, job.kind)
+                gemini_utils.log_error(f"Фоновая задача завершилась ошибкой: {type(e).__name__} - {e}")
+                job.error = f"{type(e).__name__} - {e}"
+                job.status = "error"
+            finally:
+                job.finished_at = time.time()
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        if not job_id:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel()
+        return True
+
+    def _prune(self):
+        expired_before = time.time() - self.ttl_s
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished and job.finished_at < expired_before]:
+            del self._jobs[job_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            by_status = dict.fromkeys(JOB_STATUSES, 0)
+            for job in self._jobs.values():
+                by_status[job.status] += 1
+        return {"workers": self.max_workers, **by_status}
+
+
+_job_registry: Optional[JobRegistry] = None
+_job_registry_lock = threading.Lock()
+
+
+def get_job_registry() -> JobRegistry:
+    """Реестр процесса: модуль импортируется один раз, поэтому пул и задачи общие для всех сессий Streamlit."""
+    global _job_registry
+    with _job_registry_lock:
+        if _job_registry is None:
+            _job_registry = JobRegistry(
+                max_workers=int(os.getenv("GEMINIJUDGE_JOB_WORKERS", JOB_WORKERS_DEFAULT)),
+                ttl_s=float(os.getenv("GEMINIJUDGE_JOB_TTL_S", JOB_TTL_S_DEFAULT)),
+            )
+        return _job_registry
@@ -0,0 +1,84 @@
+# geminijudge/log_buffer.py
+# Журнал операций: кольцевой буфер структурированных записей (хранит только последние N) и JSONL-приемник для batch.
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional
+
+LOG_BUFFER_CAPACITY_DEFAULT = 500
+
+
+@dataclass
+class LogRecord:
+    level: str
+    message: str
+    timestamp: float
+    stage: Optional[str] = None
+    run_id: Optional[Any] = None
+    duration_s: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class LogBuffer:
+    """Журнал фиксированной емкости: при переполнении вытесняются самые старые записи."""
+
+    def __init__(self, capacity: int = LOG_BUFFER_CAPACITY_DEFAULT):
+        self._records: "deque[LogRecord]" = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self.total_appended = 0
+
+    def append(self, record: LogRecord):
+        with self._lock:
+            self._records.append(record)
+            self.total_appended += 1
+
+    def latest(self, limit: int, offset: int = 0) -> List[LogRecord]:
+        """Записи от новых к старым: пропустить offset самых новых и вернуть не больше limit следующих."""
+        with self._lock:
+            size = len(self._records)
+            end = max(0, size - offset)
+            start = max(0, end - limit)
+            return [self._records[i] for i in range(end - 1, start - 1, -1)]
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    @property
+    def dropped(self) -> int:
+        return self.total_appended - len(self)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+
+class JsonlLogSink:
+    """Дописывает каждую запись строкой JSON в файл (потокобезопасно)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, record: LogRecord):
+        line = json.dumps(record.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def make_record(level: str, message: str, stage: Optional[str] = None, run_id: Optional[Any] = None,
+                duration_s: Optional[float] = None) -> LogRecord:
+    return LogRecord(level=level, message=message, timestamp=time.time(), stage=stage, run_id=run_id,
+                     duration_s=round(duration_s, 3) if duration_s is not None else None)
@@ -0,0 +1,305 @@
+# geminijudge/metrics.py
+# Метрики процесса: счетчики и гистограммы с метками, экспорт в текстовый формат Prometheus или JSON,
+# плюс сборщик разбивки одного запуска (этапы, запросы к моделям, токены) для показа в UI и в результатах batch.
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+LATENCY_BUCKETS_S = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+TOKEN_BUCKETS = (100, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000)
+# Сколько последних значений гистограммы хранить для точных перцентилей
+RECENT_SAMPLES = 1000
+
+STAGE_DURATION = "geminijudge_stage_duration_seconds"
+MODEL_REQUEST_DURATION = "geminijudge_model_request_duration_seconds"
+MODEL_REQUESTS = "geminijudge_model_requests_total"
+MODEL_TOKENS = "geminijudge_model_tokens_total"
+MODEL_REQUEST_TOKENS = "geminijudge_model_request_tokens"
+UPLOAD_DURATION = "geminijudge_upload_duration_seconds"
+UPLOAD_POLL_DURATION = "geminijudge_upload_poll_duration_seconds"
+# Ожидание загрузки в очереди, когда исчерпан бюджет памяти загрузок (upload_stream.py)
+UPLOAD_QUEUE_WAIT = "geminijudge_upload_queue_wait_seconds"
+RETRIES = "geminijudge_retries_total"
+RATE_LIMIT_WAIT = "geminijudge_rate_limit_wait_seconds"
+HEDGED_REQUESTS = "geminijudge_hedged_requests_total"
+# Ответы, оборванные по max_output_tokens (finish_reason=MAX_TOKENS)
+RESPONSE_TRUNCATIONS = "geminijudge_truncated_responses_total"
+STRUCTURED_OUTPUTS = "geminijudge_structured_outputs_total"
+# Решения каскадной оценки: screened — хватило дешевой модели, escalated — кейс передан оценочной модели
+CASCADE_DECISIONS = "geminijudge_cascade_decisions_total"
+# Исходы проверки JSON-ответа: valid — сразу валиден, repaired — исправлен небольшим запросом
+# (полный запрос не повторялся), failed — не исправлен
+STRUCTURED_OUTCOMES = ("valid", "repaired", "failed")
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(label_key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(label_key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (f'{k}="{v.replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def quantile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = q * (len(ordered) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent: "deque[float]" = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def cumulative_buckets(self) -> List[Tuple[str, int]]:
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            running += bucket_count
+            cumulative.append((repr(float(bound)), running))
+        cumulative.append(("+Inf", self.count))
+        return cumulative
+
+    def snapshot(self) -> Dict[str, Any]:
+        recent = list(self.recent)
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "buckets": dict(self.cumulative_buckets()),
+            "p50": quantile(recent, 0.5),
+            "p95": quantile(recent, 0.95),
+            "p99": quantile(recent, 0.99),
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._histogram_buckets: Dict[str, Tuple[float, ...]] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS_S, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self._histogram_buckets.setdefault(name, buckets))
+            histogram.observe(value)
+
+    def recent_values(self, name: str, **labels) -> List[float]:
+        """Последние наблюдения гистограммы (для перцентилей в рантайме)."""
+        with self._lock:
+            histogram = self._histograms.get(name, {}).get(_label_key(labels))
+            return list(histogram.recent) if histogram else []
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self._counters.items()
+                },
+                "histograms": {
+                    name: [{"labels": dict(key), **histogram.snapshot()} for key, histogram in series.items()]
+                    for name, series in self._histograms.items()
+                },
+            }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    for bound, cumulative in histogram.cumulative_buckets():
+                        lines.append(f"{name}_bucket{_format_labels(key, ('le', bound))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+
+    def write_json(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+REGISTRY = MetricsRegistry()
+
+
+# --- Разбивка одного запуска ---
+class RunRecorder:
+    """Собирает длительности этапов, загрузок и запросов к моделям одного запуска (одной оценки или кейса)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages: Dict[str, float] = {}
+        self.model_calls: List[Dict[str, Any]] = []
+        self.uploads: List[Dict[str, Any]] = []
+        self.structured_outputs: Dict[str, Dict[str, int]] = {}
+
+    def add_stage(self, stage: str, duration_s: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + duration_s
+
+    def add_model_call(self, call: Dict[str, Any]):
+        with self._lock:
+            self.model_calls.append(call)
+
+    def add_upload(self, upload: Dict[str, Any]):
+        with self._lock:
+            self.uploads.append(upload)
+
+    def add_structured_output(self, stage: str, outcome: str):
+        with self._lock:
+            outcomes = self.structured_outputs.setdefault(stage, dict.fromkeys(STRUCTURED_OUTCOMES, 0))
+            outcomes[outcome] += 1
+
+    def breakdown(self) -> Dict[str, Any]:
+        with self._lock:
+            tokens_by_model_type: Dict[str, Dict[str, int]] = {}
+            for call in self.model_calls:
+                totals = tokens_by_model_type.setdefault(
+                    call["model_type"], {"requests": 0, "prompt_tokens": 0, "candidates_tokens": 0, "total_tokens": 0}
+                )
+                totals["requests"] += 1
+                for kind in ("prompt_tokens", "candidates_tokens", "total_tokens"):
+                    totals[kind] += call.get(kind) or 0
+            return {
+                "stages": {stage: round(duration, 3) for stage, duration in self.stages.items()},
+                "model_calls": list(self.model_calls),
+                "uploads": list(self.uploads),
+                "tokens_by_model_type": tokens_by_model_type,
+                "structured_outputs": {stage: dict(outcomes) for stage, outcomes in self.structured_outputs.items()},
+            }
+
+
+_run_context = threading.local()
+
+
+def get_run_recorder() -> Optional[RunRecorder]:
+    return getattr(_run_context, "recorder", None)
+
+
+def set_run_recorder(recorder: Optional[RunRecorder]):
+    _run_context.recorder = recorder
+
+
+@contextmanager
+def recording_run(recorder: RunRecorder):
+    """Все метрики текущего потока (и пулов, созданных в нем через make_worker_pool) попадут и в recorder."""
+    previous = get_run_recorder()
+    set_run_recorder(recorder)
+    try:
+        yield recorder
+    finally:
+        set_run_recorder(previous)
+
+
+# --- Точки инструментирования ---
+@contextmanager
+def stage_span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        REGISTRY.observe(STAGE_DURATION, duration, stage=stage)
+        recorder = get_run_recorder()
+        if recorder:
+            recorder.add_stage(stage, duration)
+
+
+def usage_from_response(response: Any) -> Dict[str, Optional[int]]:
+    usage = getattr(response, "usage_metadata", None)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_token_count", None),
+        "candidates_tokens": getattr(usage, "candidates_token_count", None),
+        "total_tokens": getattr(usage, "total_token_count", None),
+    }
+
+
+def record_model_call(model_type: str, model_name: str, status: str, duration_s: Optional[float] = None,
+                      usage: Optional[Dict[str, Optional[int]]] = None):
+    """
+    status: "ok", "empty", "error", "timeout", "cancelled" (ответ стал не нужен вызывающему),
+    "cache_hit" или "rejected" (запрос не поместился в контекст модели) — последние два без обращения к API.
+    """
+    REGISTRY.inc(MODEL_REQUESTS, model_type=model_type, model=model_name, status=status)
+    if duration_s is not None:
+        REGISTRY.observe(MODEL_REQUEST_DURATION, duration_s, model_type=model_type, model=model_name)
+    for kind, value in (usage or {}).items():
+        if value:
+            REGISTRY.inc(MODEL_TOKENS, value, model_type=model_type, model=model_name, kind=kind)
+            REGISTRY.observe(MODEL_REQUEST_TOKENS, value, buckets=TOKEN_BUCKETS, model_type=model_type, kind=kind)
+    recorder = get_run_recorder()
+    if recorder:
+        recorder.add_model_call({
+            "model_type": model_type, "model": model_name, "status": status,
+            "duration_s": round(duration_s, 3) if duration_s is not None else None, **(usage or {}),
+        })
+
+
+def record_upload(display_name: str, status: str, duration_s: float, poll_duration_s: Optional[float] = None):
+    REGISTRY.observe(UPLOAD_DURATION, duration_s, status=status)
+    if poll_duration_s is not None:
+        REGISTRY.observe(UPLOAD_POLL_DURATION, poll_duration_s)
+    recorder = get_run_recorder()
+    if recorder:
+        recorder.add_upload({
+            "file": display_name, "status": status, "duration_s": round(duration_s, 3),
+            "poll_duration_s": round(poll_duration_s, 3) if poll_duration_s is not None else None,
+        })
+
+
+def record_structured_output(stage: str, outcome: str):
+    """outcome — один из STRUCTURED_OUTCOMES."""
+    REGISTRY.inc(STRUCTURED_OUTPUTS, stage=stage, outcome=outcome)
+    recorder = get_run_recorder()
+    if recorder:
+        recorder.add_structured_output(stage, outcome)
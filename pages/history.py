@@ -0,0 +1,104 @@
+# geminijudge/pages/history.py
+# История оценок: агрегаты по хранилищу результатов (results_store.py) — UI и batch-прогоны вместе.
+import time
+from datetime import datetime, timezone
+
+import streamlit as st
+from dotenv import load_dotenv
+
+import results_store
+
+load_dotenv()
+
+PERIODS = {
+    "1": "Сутки",
+    "7": "7 дней",
+    "30": "30 дней",
+    "90": "90 дней",
+    "all": "Все время",
+}
+SOURCES = {"": "Все", "ui": "UI", "batch": "Пакетные прогоны"}
+RECENT_LIMIT = 50
+
+
+def format_rate(value):
+    return "—" if value is None else f"{value:.1%}"
+
+
+def format_day(day: int) -> str:
+    return datetime.fromtimestamp(day, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+st.header("📊 История оценок")
+if not results_store.is_enabled():
+    st.info("Хранилище результатов выключено (GEMINIJUDGE_RESULTS_STORE=0).")
+    st.stop()
+
+store = results_store.get_results_store()
+filter_columns = st.columns(3)
+period = filter_columns[0].selectbox("Период:", options=list(PERIODS), format_func=PERIODS.get, index=2)
+source = filter_columns[1].selectbox("Источник:", options=list(SOURCES), format_func=SOURCES.get)
+evaluation_model = filter_columns[2].selectbox("Модель оценки:", options=[""] + store.distinct_values("evaluation_model"),
+                                               format_func=lambda model: model or "Все")
+since = None if period == "all" else time.time() - int(period) * results_store.DAY_S
+filters = {"source": source or None, "evaluation_model": evaluation_model or None}
+
+query_started = time.perf_counter()
+summary = store.summary(since, **filters)
+by_family = store.aggregate("prompt_family", since, **filters)
+by_day = store.aggregate("day", since, **filters)
+by_mode = store.aggregate("evaluation_mode", since, **filters)
+query_s = time.perf_counter() - query_started
+
+if not summary["cases"]:
+    st.info("За выбранный период оценок нет. Они появятся после запусков в UI или batch_judge.py.")
+    st.stop()
+
+metric_columns = st.columns(4)
+metric_columns[0].metric("Оценок", f"{summary['cases']:,}".replace(",", " "),
+                         help=f"Успешных: {summary['ok']}")
+metric_columns[1].metric("Побед модели А", format_rate(summary["model_a_win_rate"]))
+metric_columns[2].metric("Судья обманут", format_rate(summary["fooled_rate"]),
+                         help="Доля оценок, в которых выбран 'неправильный' ответ.")
+metric_columns[3].metric("Средняя длительность", "—" if summary["mean_elapsed_s"] is None else f"{summary['mean_elapsed_s']:.2f} с")
+st.caption(f"Запросы к хранилищу: {query_s * 1000:.0f} мс")
+
+st.subheader("По семействам промптов")
+st.dataframe(
+    [{"Семейство": row["prompt_family"], "Оценок": row["cases"], "Побед модели А": format_rate(row["model_a_win_rate"]),
+      "Судья обманут": format_rate(row["fooled_rate"]),
+      "Средняя длительность, с": None if row["mean_elapsed_s"] is None else round(row["mean_elapsed_s"], 2)}
+     for row in by_family],
+    hide_index=True, use_container_width=True
+)
+
+st.subheader("По дням (UTC)")
+st.line_chart(
+    {"День": [format_day(row["day"]) for row in by_day],
+     "Побед модели А": [row["model_a_win_rate"] for row in by_day],
+     "Судья обманут": [row["fooled_rate"] for row in by_day]},
+    x="День"
+)
+st.line_chart(
+    {"День": [format_day(row["day"]) for row in by_day],
+     "Средняя длительность, с": [row["mean_elapsed_s"] for row in by_day],
+     "Максимальная длительность, с": [row["max_elapsed_s"] for row in by_day]},
+    x="День"
+)
+
+st.subheader("По режимам оценки")
+st.dataframe(
+    [{"Режим": row["evaluation_mode"], "Оценок": row["cases"], "Побед модели А": format_rate(row["model_a_win_rate"]),
+      "Судья обманут": format_rate(row["fooled_rate"]), "Токенов": row["total_tokens"]}
+     for row in by_mode],
+    hide_index=True, use_container_width=True
+)
+
+with st.expander(f"Последние {RECENT_LIMIT} оценок"):
+    st.dataframe(
+        [{"Время": datetime.fromtimestamp(row["created_at"]).strftime("%Y-%m-%d %H:%M:%S"), "Источник": row["source"],
+          "Семейство": row["prompt_family"], "Статус": row["status"], "Выбран": row["chosen_id"],
+          "Режим": row["evaluation_mode"], "Модель оценки": row["evaluation_model"], "Длительность, с": row["elapsed_s"]}
+         for row in store.recent(RECENT_LIMIT, since, **filters)],
+        hide_index=True, use_container_width=True
+    )
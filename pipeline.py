@@ -0,0 +1,1101 @@
+# geminijudge/pipeline.py
+# Этапы пайплайна GeminiJudge без привязки к UI: используются и в app.py, и в batch_judge.py
+import dataclasses
+import functools
+import json
+import math
+import queue
+import threading
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import List, Optional, Dict, Tuple, Any, Callable
+
+import prompts
+import gemini_utils
+import upload_cache
+import upload_stream
+import retrieval
+import metrics
+import checkpoints
+import token_budget
+
+UPLOAD_MAX_WORKERS_DEFAULT = 4
+FANOUT_MAX_WORKERS_DEFAULT = 12
+FANOUT_MAX_ATTEMPTS_DEFAULT = 3
+# Турнирная оценка: размер группы (судья сравнивает не больше стольких кандидатов за запрос) и параллелизм групп
+TOURNAMENT_GROUP_SIZE_DEFAULT = 4
+TOURNAMENT_MAX_WORKERS_DEFAULT = 8
+TOURNAMENT_MAX_ATTEMPTS_DEFAULT = 2
+# Самосогласованность: K независимых оценок с разным порядком кандидатов, все отправляются сразу
+SELF_CONSISTENCY_VOTES_DEFAULT = 5
+# Каскад: сначала несколько голосов дешевой модели (параллельно, с разным порядком кандидатов); дорогой судья
+# вызывается, только если доля голосов за лидера ниже порога (при 2 голосах и пороге 1.0 — если голоса разошлись)
+CASCADE_SCREEN_VOTES_DEFAULT = 2
+CASCADE_CONFIDENCE_THRESHOLD_DEFAULT = 1.0
+# Исправление невалидного JSON — небольшой запрос без документов, поэтому идет к более дешевой модели генерации
+STRUCTURED_REPAIR_MODEL_TYPE = "generation"
+
+# Имена этапов для журнала
+STAGE_FILES = "files"
+STAGE_GENERATION = "generation"
+STAGE_EVALUATION = "evaluation"
+
+
+@dataclass
+class EvaluationResult:
+    chosen_id: Optional[str]
+    rationale: str
+    all_responses: Dict[str, str] = field(default_factory=dict)
+    # Только для турнира: раунды по порядку, в каждом — группы {"candidates", "winner", "rationale"}
+    rounds: List[List[Dict[str, Any]]] = field(default_factory=list)
+    # Только для самосогласованности: голоса по ID, доля голосов за выбранный ID среди поданных и число запросов
+    votes: Dict[str, int] = field(default_factory=dict)
+    confidence: Optional[float] = None
+    calls: Dict[str, int] = field(default_factory=dict)
+    # Только для каскада: передан ли кейс дорогому судье (votes, confidence — голоса дешевой модели)
+    escalated: Optional[bool] = None
+
+
+def pipeline_stage(stage: str):
+    """Помечает записи журнала, сделанные внутри функции (и ее рабочих потоков), именем этапа и замеряет его длительность."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with gemini_utils.log_context(stage=stage), metrics.stage_span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_parallel(
+    tasks: List[Callable[[Callable[..., None]], Any]],
+    max_workers: int,
+    on_event: Optional[Callable[..., None]] = None,
+    thread_name_prefix: str = "pipeline"
+) -> List[Any]:
+    """
+    Выполняет задачи в пуле потоков и возвращает их результаты в исходном порядке.
+    Каждая задача получает функцию emit(*event). Рабочие потоки только кладут события в очередь,
+    а on_event(*event) вызывается в потоке, который вызвал run_parallel, — из него можно обновлять виджеты Streamlit.
+    """
+    events: "queue.Queue[tuple]" = queue.Queue()
+
+    def drain_events():
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                return
+            if on_event:
+                on_event(*event)
+
+    def emit(*event):
+        events.put(event)
+
+    results: List[Any] = [None] * len(tasks)
+    if not tasks:
+        return results
+    with gemini_utils.make_worker_pool(max(1, min(max_workers, len(tasks))), thread_name_prefix) as executor:
+        futures = {executor.submit(task, emit): i for i, task in enumerate(tasks)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            drain_events()
+            for future in done:
+                results[futures[future]] = future.result()
+    drain_events()
+    return results
+
+
+# --- Чекпоинты этапов ---
+def document_digests(documents: list) -> List[str]:
+    """Отпечатки содержимого документов для ключей чекпоинтов (хэш по кускам, без копии содержимого)."""
+    return [f"{upload_stream.content_digest(doc)}:{doc.type}" for doc in documents]
+
+
+class StageCheckpoints:
+    """
+    Чекпоинты этапов одного прогона. Ключ этапа — хэш его входов, отпечатков документов, имени модели этапа и API ключа,
+    поэтому результат с устаревшими входами просто не находится и этап выполняется заново.
+    resume=False: сохраненные результаты не читаются, но новые все равно записываются (для возобновления позже).
+    memo: {этап: (ключ, результат)} — последний результат каждого этапа в памяти (в UI — в сессии). Проверяется
+    раньше SQLite и хранит живые объекты, поэтому при повторном запуске с теми же входами этап не делает
+    ни одного запроса (даже проверки файлов), и работает, даже когда чекпоинты выключены.
+    """
+
+    def __init__(self, documents_fingerprint: List[str], resume: bool = True, enabled: Optional[bool] = None,
+                 memo: Optional[Dict[str, Tuple[str, Any]]] = None):
+        self.documents_fingerprint = documents_fingerprint
+        self.resume = resume
+        self.enabled = checkpoints.is_enabled() if enabled is None else enabled
+        self.memo = memo
+        self.restored_stages: List[str] = []
+
+    def _key(self, stage: str, inputs: Dict[str, Any]) -> str:
+        # Имена этапов генерации и оценки совпадают с типами моделей; смена модели делает чекпоинт устаревшим
+        key_inputs = {"documents": self.documents_fingerprint, "model": gemini_utils.get_model_name(stage), **inputs}
+        # Чекпоинты общие для всех сессий процесса, а результаты этапов принадлежат ключу: загруженные файлы видны
+        # только его проекту, а 'неправильные' ответы и вердикты получены за его квоту. Поэтому сессия с другим
+        # ключом их не находит и выполняет этапы заново
+        key_inputs["api_key"] = upload_cache.api_key_fingerprint(gemini_utils.get_state().get("api_key_input"))
+        return checkpoints.stage_key(stage, key_inputs)
+
+    def load(self, stage: str, inputs: Dict[str, Any], decode: Optional[Callable[[Any], Any]] = None) -> Optional[Any]:
+        """Сохраненный результат этапа с такими входами или None."""
+        if not self.resume:
+            return None
+        key = self._key(stage, inputs)
+        if self.memo is not None and stage in self.memo and self.memo[stage][0] == key:
+            return self.memo[stage][1]
+        if not self.enabled:
+            return None
+        store = checkpoints.get_checkpoint_store()
+        saved = store.get(key)
+        if saved is None:
+            return None
+        value = decode(saved) if decode else saved
+        if value is None:
+            store.invalidate(key)
+            return None
+        if self.memo is not None:
+            self.memo[stage] = (key, value)
+        return value
+
+    def save(self, stage: str, inputs: Dict[str, Any], value: Any, encode: Optional[Callable[[Any], Any]] = None):
+        key = self._key(stage, inputs)
+        if self.memo is not None:
+            self.memo[stage] = (key, value)
+        if self.enabled:
+            checkpoints.get_checkpoint_store().put(key, stage, encode(value) if encode else value)
+
+    def run(
+        self,
+        stage: str,
+        compute: Callable[[], Any],
+        inputs: Dict[str, Any],
+        is_complete: Callable[[Any], bool] = bool,
+        encode: Optional[Callable[[Any], Any]] = None,
+        decode: Optional[Callable[[Any], Any]] = None
+    ) -> Any:
+        """
+        Возвращает сохраненный результат этапа или compute(). Сохраняется только результат, для которого is_complete —
+        упавший этап при следующем запуске выполняется снова. decode может вернуть None, если сохраненный
+        результат больше не годится (например, файл удален с сервера).
+        """
+        value = self.load(stage, inputs, decode)
+        if value is not None:
+            with gemini_utils.log_context(stage=stage):
+                gemini_utils.log_success("Результат этапа взят из чекпоинта, этап не выполнялся повторно.")
+            self.restored_stages.append(stage)
+            return value
+        value = compute()
+        if is_complete(value):
+            self.save(stage, inputs, value, encode)
+        return value
+
+    def run_distractors(
+        self,
+        compute: Callable[[List[str], int], List[str]],
+        inputs: Dict[str, Any],
+        num_samples: int
+    ) -> List[str]:
+        """
+        Этап 1 с пулом 'неправильных' ответов: ключ не зависит от их количества. Если в пуле ответов не меньше
+        num_samples, берутся первые num_samples без запросов; иначе compute(уже есть, сколько не хватает)
+        догенерирует только недостающие, и пул пополняется.
+        """
+        pool = self.load(STAGE_GENERATION, inputs) or []
+        with gemini_utils.log_context(stage=STAGE_GENERATION):
+            if len(pool) >= num_samples:
+                gemini_utils.log_success(f"'Неправильные' ответы взяты из сохраненных ({num_samples} из {len(pool)}), генерация не нужна.")
+                self.restored_stages.append(STAGE_GENERATION)
+                return pool[:num_samples]
+            if pool:
+                gemini_utils.log_info(f"Сохранено {len(pool)} 'неправильных' ответов, догенерируем {num_samples - len(pool)}.")
+        new_responses = compute(pool, num_samples - len(pool))
+        if new_responses:
+            pool = pool + new_responses
+            self.save(STAGE_GENERATION, inputs, pool)
+        return pool[:num_samples]
+
+
+# --- Этап 0: Подготовка файлов ---
+@pipeline_stage(STAGE_FILES)
+def upload_documents(
+    documents: list,
+    max_workers: int = UPLOAD_MAX_WORKERS_DEFAULT,
+    on_progress: Optional[Callable[[int, str, str], None]] = None
+) -> Tuple[List[Any], bool]:
+    """
+    Загружает документы в Gemini File API параллельно (не больше max_workers одновременно).
+    documents: объекты с атрибутами name/type и методом getvalue() (UploadedFile из Streamlit или локальный файл);
+    буфер getbuffer() или путь path читаются кусками, без копии содержимого (upload_stream.py).
+    on_progress(индекс, имя файла, состояние) вызывается в потоке, который вызвал upload_documents,
+    поэтому из него можно обновлять виджеты Streamlit.
+    Возвращает (список активных файлов в исходном порядке, все ли файлы успешно подготовлены).
+    """
+    processed_files = []
+    if not documents:
+        gemini_utils.log_info("Контекстные файлы не предоставлены.")
+        return processed_files, True
+    all_successful = True
+    cache_stats_before = upload_cache.get_upload_cache().stats()
+
+    def make_upload_task(index: int, doc: Any):
+        def upload_task(emit):
+            return gemini_utils.upload_file_to_gemini(
+                doc, display_name_prefix=f"doc{index+1}",
+                on_progress=lambda file_state: emit(index, file_state)
+            )
+        return upload_task
+
+    def report_progress(index: int, file_state: str):
+        if on_progress:
+            on_progress(index, documents[index].name, file_state)
+
+    for i, doc in enumerate(documents):
+        gemini_utils.log_info(f"Обработка файла {i+1}/{len(documents)}: {doc.name}")
+    upload_results = run_parallel(
+        [make_upload_task(i, doc) for i, doc in enumerate(documents)],
+        max_workers=max_workers, on_event=report_progress, thread_name_prefix="upload"
+    )
+
+    for doc, gemini_file_obj in zip(documents, upload_results):
+        if gemini_file_obj and hasattr(gemini_file_obj, 'state') and gemini_file_obj.state.name == "ACTIVE":
+            processed_files.append(gemini_file_obj)
+        elif gemini_file_obj:
+            gemini_utils.log_warning(f"Файл {doc.name} загружен, но не активен (состояние: {gemini_file_obj.state.name}).")
+            all_successful = False
+        else:
+            gemini_utils.log_error(f"Не удалось обработать файл {doc.name}.")
+            all_successful = False
+    cache_stats_after = upload_cache.get_upload_cache().stats()
+    gemini_utils.log_info(
+        f"Кэш загрузок: попаданий {cache_stats_after['hits'] - cache_stats_before['hits']}, "
+        f"промахов {cache_stats_after['misses'] - cache_stats_before['misses']} "
+        f"(всего за процесс: hit rate {cache_stats_after['hit_rate']:.0%})."
+    )
+    if all_successful and processed_files:
+        gemini_utils.log_success(f"{len(processed_files)} файлов успешно подготовлены.")
+    elif processed_files:
+        gemini_utils.log_warning(f"Подготовлено {len(processed_files)} из {len(documents)} файлов.")
+    else:
+        gemini_utils.log_error("Ни один из файлов не был успешно обработан.")
+        all_successful = False
+    return processed_files, all_successful
+
+
+@pipeline_stage(STAGE_FILES)
+def restore_uploaded_files(file_names: List[str], max_workers: int = UPLOAD_MAX_WORKERS_DEFAULT) -> Optional[List[Any]]:
+    """Проверяет ранее загруженные файлы (get_file, без повторной загрузки). None, если хотя бы один недоступен."""
+    restored = run_parallel(
+        [lambda emit, name=name: gemini_utils.get_active_file(name) for name in file_names],
+        max_workers=max_workers, thread_name_prefix="upload"
+    )
+    return restored if all(restored) else None
+
+
+def upload_documents_resumable(
+    documents: list,
+    stage_checkpoints: StageCheckpoints,
+    on_progress: Optional[Callable[[int, str, str], None]] = None
+) -> Tuple[List[Any], bool]:
+    """upload_documents с чекпоинтом: активные файлы прошлого прогона только проверяются, а не загружаются заново."""
+    def restore(saved_files: List[Dict[str, str]]) -> Optional[Tuple[List[Any], bool]]:
+        restored = restore_uploaded_files([saved["name"] for saved in saved_files])
+        if restored is None:
+            return None
+        if on_progress:
+            for index, doc in enumerate(documents):
+                on_progress(index, doc.name, "CACHED")
+        return restored, True
+
+    return stage_checkpoints.run(
+        STAGE_FILES, lambda: upload_documents(documents, on_progress=on_progress), {},
+        is_complete=lambda result: result[1] and bool(result[0]),
+        encode=lambda result: [{"name": gemini_file.name} for gemini_file in result[0]],
+        decode=restore
+    )
+
+
+def encode_evaluation_result(result: EvaluationResult) -> Dict[str, Any]:
+    return dataclasses.asdict(result)
+
+
+def decode_evaluation_result(saved: Dict[str, Any]) -> EvaluationResult:
+    return EvaluationResult(**saved)
+
+
+@pipeline_stage(STAGE_FILES)
+def prepare_retrieval_context(documents: list) -> Tuple[Optional[retrieval.RetrievalContext], bool]:
+    """
+    Локальная альтернатива upload_documents: извлекает текст документов и строит BM25-индекс
+    (кэшируется по хэшу содержимого). Возвращает (контекст для промптов или None, все ли документы обработаны).
+    """
+    if not documents:
+        gemini_utils.log_info("Контекстные файлы не предоставлены.")
+        return None, True
+    index, from_cache = retrieval.get_document_index(documents)
+    for name in index.skipped_documents:
+        gemini_utils.log_warning(f"Не удалось извлечь текст из файла {name}, он не будет учтен.")
+    if not index.chunks:
+        gemini_utils.log_error("Ни из одного файла не удалось извлечь текст.")
+        return None, False
+    gemini_utils.log_success(
+        f"Локальный индекс {'взят из кэша' if from_cache else 'построен'}: {len(index.chunks)} фрагментов из "
+        f"{len(documents) - len(index.skipped_documents)} файлов (~{index.full_document_tokens} токенов целиком)."
+    )
+    return retrieval.RetrievalContext(index), not index.skipped_documents
+
+
+def _with_retrieved_context(prompt_text: str, retrieval_context: Optional[retrieval.RetrievalContext], queries: List[str]) -> str:
+    if retrieval_context is None:
+        return prompt_text
+    return prompt_text + prompts.get_retrieved_context_section(retrieval_context.build_context_block(queries))
+
+
+# --- Структурированный вывод (JSON по схеме) ---
+def _load_json_object(raw_response: str) -> Tuple[Optional[Dict[str, Any]], str]:
+    text = raw_response.strip()
+    if text.startswith("```"):
+        # Модели иногда оборачивают JSON в блок кода, несмотря на response_mime_type
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    try:
+        value = json.loads(text)
+    except ValueError as e:
+        return None, f"невалидный JSON: {e}"
+    if not isinstance(value, dict):
+        return None, "ожидался JSON-объект"
+    return value, ""
+
+
+def parse_structured_distractors(raw_response: str) -> Tuple[Optional[List[str]], str]:
+    """Возвращает (ответы, "") или (None, описание ошибки для запроса исправления)."""
+    value, error = _load_json_object(raw_response)
+    if value is None:
+        return None, error
+    answers = value.get(prompts.DISTRACTORS_JSON_FIELD)
+    if not isinstance(answers, list) or not all(isinstance(answer, str) for answer in answers):
+        return None, f"поле '{prompts.DISTRACTORS_JSON_FIELD}' должно быть массивом строк"
+    answers = [answer.strip() for answer in answers if answer.strip()]
+    if not answers:
+        return None, f"массив '{prompts.DISTRACTORS_JSON_FIELD}' пуст"
+    return answers, ""
+
+
+def parse_structured_evaluation(raw_response: str, all_responses: Dict[str, str]) -> Tuple[Optional[Tuple[str, str]], str]:
+    """Возвращает ((выбранный ID, обоснование), "") или (None, описание ошибки для запроса исправления)."""
+    value, error = _load_json_object(raw_response)
+    if value is None:
+        return None, error
+    chosen_id, rationale_text = value.get("chosen_id"), value.get("rationale")
+    if not isinstance(chosen_id, str) or chosen_id.strip() not in all_responses:
+        return None, f"'chosen_id' должен быть одним из: {', '.join(all_responses)}"
+    if not isinstance(rationale_text, str):
+        return None, "поле 'rationale' должно быть строкой"
+    return (chosen_id.strip(), rationale_text.strip()), ""
+
+
+def request_structured_output(
+    prompt_text: str,
+    model_type: str,
+    response_schema: Dict[str, Any],
+    validate: Callable[[str], Tuple[Any, str]],
+    stage: str,
+    files_for_context: Optional[List[Any]] = None,
+    bypass_cache: bool = False,
+    cancel_event: Optional[threading.Event] = None,
+    expected_output_tokens: Optional[int] = None
+) -> Any:
+    """
+    Запрашивает JSON по схеме и проверяет его validate. Если ответ не прошел проверку, полный запрос
+    с документами не повторяется: отдельный небольшой запрос исправляет только структуру уже полученного ответа.
+    Возвращает значение validate или None.
+    """
+    raw_response = gemini_utils.generate_text_from_model(
+        prompt_text, model_type=model_type, files_for_context=files_for_context,
+        bypass_cache=bypass_cache, response_schema=response_schema, cancel_event=cancel_event,
+        expected_output_tokens=expected_output_tokens
+    )
+    if not raw_response:
+        return None
+    value, error = validate(raw_response)
+    if value is not None:
+        metrics.record_structured_output(stage, "valid")
+        return value
+
+    gemini_utils.log_warning(f"JSON-ответ модели не прошел проверку ({error}), запрашиваем исправление.")
+    repaired_response = gemini_utils.generate_text_from_model(
+        prompts.get_json_repair_prompt(raw_response, response_schema, error),
+        model_type=STRUCTURED_REPAIR_MODEL_TYPE, response_schema=response_schema,
+        expected_output_tokens=token_budget.estimate_text_tokens(raw_response) # Исправленный JSON не короче исходного
+    )
+    value, error = validate(repaired_response) if repaired_response else (None, "нет ответа на запрос исправления")
+    if value is None:
+        gemini_utils.log_error(f"JSON-ответ не удалось исправить: {error}.")
+        metrics.record_structured_output(stage, "failed")
+        return None
+    gemini_utils.log_success("JSON-ответ исправлен небольшим запросом, полный запрос не повторялся.")
+    metrics.record_structured_output(stage, "repaired")
+    return value
+
+
+# --- Этап 1: Генерация "неправильных" ответов ---
+class IncrementalDistractorParser:
+    """
+    Разбирает текст модели по мере поступления фрагментов. Ответ отдается, как только его закрывает
+    строка со следующим INCORRECT_ANSWER_PARSING_PREFIX (или конец потока в finish()).
+    Результат совпадает с разбором всего текста целиком.
+    """
+
+    def __init__(self):
+        # Незавершенная последняя строка — кусками: склеивается один раз, когда строка завершится,
+        # поэтому разбор линеен по длине текста даже при очень длинных строках
+        self._tail_parts: List[str] = []
+        self._tail_head = "" # Начало незавершенной строки (для проверки префикса)
+        self._pending_cr = False # Строка закончилась на \r, и следующий фрагмент может начаться с \n
+        self._current_answer_lines: List[str] = []
+
+    def _close_current_answer(self) -> List[str]:
+        answer = "\n".join(self._current_answer_lines).strip()
+        self._current_answer_lines = []
+        return [answer] if answer else []
+
+    def _process_line(self, line: str) -> List[str]:
+        if line.startswith(prompts.INCORRECT_ANSWER_PARSING_PREFIX):
+            closed = self._close_current_answer()
+            self._current_answer_lines = [line.replace(prompts.INCORRECT_ANSWER_PARSING_PREFIX, "", 1).strip()]
+            return closed
+        if self._current_answer_lines:
+            self._current_answer_lines.append(line.strip())
+        return []
+
+    def _take_tail(self, last_piece: str = "") -> str:
+        line = "".join(self._tail_parts) + last_piece
+        self._tail_parts = []
+        self._tail_head = ""
+        self._pending_cr = False
+        return line
+
+    def _extend_tail(self, piece: str):
+        self._tail_parts.append(piece)
+        if len(self._tail_head) < len(prompts.INCORRECT_ANSWER_PARSING_PREFIX):
+            self._tail_head = (self._tail_head + piece)[:len(prompts.INCORRECT_ANSWER_PARSING_PREFIX)]
+
+    def feed(self, chunk: str) -> List[str]:
+        completed = []
+        if chunk and self._pending_cr:
+            # Строка, закончившаяся на \r, завершена; \n сразу после него — часть того же перевода строки
+            completed.extend(self._process_line(self._take_tail()))
+            if chunk.startswith("\n"):
+                chunk = chunk[1:]
+        # Переводы строк ищутся только в новом фрагменте
+        pieces = chunk.splitlines(keepends=True)
+        for i, piece in enumerate(pieces):
+            content = piece.splitlines()[0]
+            if content == piece:
+                # Последний кусок без перевода строки — строка еще не завершена
+                self._extend_tail(piece)
+            elif i == len(pieces) - 1 and piece.endswith("\r"):
+                self._extend_tail(content)
+                self._pending_cr = True
+            else:
+                completed.extend(self._process_line(self._take_tail(content)))
+        # Новый префикс виден уже в начале незавершенной строки — предыдущий ответ можно отдавать
+        if self._tail_head.startswith(prompts.INCORRECT_ANSWER_PARSING_PREFIX):
+            completed.extend(self._close_current_answer())
+        return completed
+
+    def finish(self) -> List[str]:
+        completed = []
+        if self._tail_parts or self._pending_cr:
+            completed.extend(self._process_line(self._take_tail()))
+        completed.extend(self._close_current_answer())
+        return completed
+
+
+def parse_incorrect_responses(raw_response: str) -> List[str]:
+    parser = IncrementalDistractorParser()
+    return parser.feed(raw_response) + parser.finish()
+
+
+@pipeline_stage(STAGE_GENERATION)
+def generate_incorrect_responses(
+    user_prompt: str,
+    model_a_response: str,
+    num_samples: int,
+    files_for_context: Optional[List[Any]] = None,
+    on_distractor: Optional[Callable[[int, str, float], None]] = None,
+    retrieval_context: Optional[retrieval.RetrievalContext] = None,
+    structured_output: bool = False,
+    existing_responses: Optional[List[str]] = None
+) -> List[str]:
+    """
+    on_distractor(индекс, текст, секунд с начала запроса): если задан, ответ модели читается потоково
+    и каждый 'неправильный' ответ передается сюда сразу после того, как он полностью получен.
+    retrieval_context: если задан, в промпт добавляются релевантные фрагменты документов (см. retrieval.py).
+    structured_output: ответ запрашивается JSON по схеме (без потоковой выдачи: on_distractor вызывается
+    для всех ответов после проверки JSON).
+    existing_responses: уже полученные ответы — модель просят их не повторять, индексы новых идут после них,
+    а совпадающие с ними ответы отбрасываются.
+    """
+    existing_responses = existing_responses or []
+    prompt_text = _with_retrieved_context(
+        prompts.get_generate_incorrect_answers_prompt(
+            user_prompt, model_a_response, num_samples, structured=structured_output,
+            existing_incorrect_answers=existing_responses
+        ),
+        retrieval_context, [user_prompt, model_a_response]
+    )
+    # Бюджет ответа под num_samples ответов длины ответа модели А, иначе длинные ответы обрываются на MAX_TOKENS
+    expected_output_tokens = token_budget.estimate_distractors_tokens(model_a_response, num_samples)
+    started = time.perf_counter()
+    streamed_responses: List[str] = []
+    parser = IncrementalDistractorParser()
+
+    def emit(completed_responses: List[str]):
+        for resp_text in completed_responses:
+            elapsed = time.perf_counter() - started
+            if not streamed_responses:
+                gemini_utils.log_info(f"Первый 'неправильный' ответ получен через {elapsed:.2f} с.")
+            streamed_responses.append(resp_text)
+            on_distractor(len(existing_responses) + len(streamed_responses) - 1, resp_text, elapsed)
+
+    if structured_output:
+        incorrect_responses = request_structured_output(
+            prompt_text, "generation", prompts.DISTRACTORS_RESPONSE_SCHEMA, parse_structured_distractors,
+            STAGE_GENERATION, files_for_context=files_for_context, expected_output_tokens=expected_output_tokens
+        )
+        if not incorrect_responses:
+            gemini_utils.log_error("Не получены 'неправильные' ответы от модели генерации.")
+            return []
+        incorrect_responses = _drop_existing(incorrect_responses, existing_responses)
+        if on_distractor:
+            emit(incorrect_responses)
+        return _log_extracted(incorrect_responses)
+
+    raw_response = gemini_utils.generate_text_from_model(
+        prompt_text, model_type="generation", # Используем модель для генерации
+        files_for_context=files_for_context,
+        on_chunk=(lambda chunk: emit(parser.feed(chunk))) if on_distractor else None,
+        expected_output_tokens=expected_output_tokens
+    )
+    if raw_response and on_distractor:
+        emit(parser.finish())
+        incorrect_responses = streamed_responses
+    elif raw_response:
+        incorrect_responses = parse_incorrect_responses(raw_response)
+    elif streamed_responses:
+        # Поток оборвался: ответы, закрытые следующим префиксом, получены целиком — оставляем их
+        gemini_utils.log_warning(f"Поток генерации прерван, используются {len(streamed_responses)} полностью полученных ответа(ов).")
+        incorrect_responses = streamed_responses
+    else:
+        gemini_utils.log_error("Не получены 'неправильные' ответы от модели генерации.")
+        return []
+
+    return _log_extracted(_drop_existing(incorrect_responses, existing_responses))
+
+
+def _normalize_for_dedup(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def _drop_existing(incorrect_responses: List[str], existing_responses: List[str]) -> List[str]:
+    """Отбрасывает ответы, совпадающие с уже полученными (при дозапросе в пул)."""
+    if not existing_responses:
+        return incorrect_responses
+    existing_keys = {_normalize_for_dedup(resp_text) for resp_text in existing_responses}
+    return [resp_text for resp_text in incorrect_responses if _normalize_for_dedup(resp_text) not in existing_keys]
+
+
+def _log_extracted(incorrect_responses: List[str]) -> List[str]:
+    if not incorrect_responses:
+        gemini_utils.log_warning("Не удалось извлечь 'неправильные' ответы.")
+        return []
+    gemini_utils.log_success(f"Извлечено {len(incorrect_responses)} 'неправильных' ответов.")
+    return incorrect_responses
+
+
+@pipeline_stage(STAGE_GENERATION)
+def generate_incorrect_responses_fanout(
+    user_prompt: str,
+    model_a_response: str,
+    num_samples: int,
+    files_for_context: Optional[List[Any]] = None,
+    on_distractor: Optional[Callable[[int, str, float], None]] = None,
+    max_workers: int = FANOUT_MAX_WORKERS_DEFAULT,
+    max_attempts: int = FANOUT_MAX_ATTEMPTS_DEFAULT,
+    retrieval_context: Optional[retrieval.RetrievalContext] = None,
+    structured_output: bool = False,
+    existing_responses: Optional[List[str]] = None
+) -> List[str]:
+    """
+    Каждый 'неправильный' ответ запрашивается отдельным небольшим запросом со своей подсказкой
+    стиля ошибки (prompts.ERROR_STYLE_HINTS). Запросы идут параллельно, поэтому задержка почти не растет
+    с num_samples, а сбой формата теряет один ответ, а не все. Неудачный или повторяющийся ответ
+    перезапрашивается отдельно, до max_attempts попыток.
+    on_distractor(индекс, текст, секунд с начала) вызывается в вызывающем потоке по мере готовности ответов.
+    existing_responses: уже полученные ответы; новые продолжают их нумерацию (и подсказки стиля) и не повторяют их.
+    """
+    existing_responses = existing_responses or []
+    started = time.perf_counter()
+    seen_responses = {_normalize_for_dedup(resp_text) for resp_text in existing_responses}
+    seen_lock = threading.Lock()
+    expected_output_tokens = token_budget.estimate_distractors_tokens(model_a_response, 1)
+
+    def make_sample_task(index: int):
+        prompt_text = _with_retrieved_context(
+            prompts.get_generate_incorrect_answers_prompt(
+                user_prompt, model_a_response, 1, error_style_hint=prompts.get_error_style_hint(index),
+                structured=structured_output
+            ),
+            retrieval_context, [user_prompt, model_a_response]
+        )
+
+        def sample_task(emit):
+            for attempt in range(1, max_attempts + 1):
+                if structured_output:
+                    parsed = request_structured_output(
+                        prompt_text, "generation", prompts.DISTRACTORS_RESPONSE_SCHEMA, parse_structured_distractors,
+                        STAGE_GENERATION, files_for_context=files_for_context, bypass_cache=attempt > 1,
+                        expected_output_tokens=expected_output_tokens
+                    ) or []
+                else:
+                    raw_response = gemini_utils.generate_text_from_model(
+                        prompt_text, model_type="generation", files_for_context=files_for_context,
+                        bypass_cache=attempt > 1, # Из кэша повтор вернул бы тот же неудачный ответ
+                        expected_output_tokens=expected_output_tokens
+                    )
+                    # Если модель забыла префикс, единственный запрошенный ответ — это весь текст
+                    parsed = parse_incorrect_responses(raw_response) if raw_response else []
+                    if not parsed and raw_response and raw_response.strip():
+                        parsed = [raw_response.strip()]
+                if not parsed:
+                    gemini_utils.log_warning(f"Не удалось получить 'неправильный' ответ #{index+1} (попытка {attempt}/{max_attempts}).")
+                    continue
+                with seen_lock:
+                    is_new = _normalize_for_dedup(parsed[0]) not in seen_responses
+                    seen_responses.add(_normalize_for_dedup(parsed[0]))
+                if is_new:
+                    emit(index, parsed[0], time.perf_counter() - started)
+                    return parsed[0]
+                gemini_utils.log_warning(f"'Неправильный' ответ #{index+1} повторяет уже полученный (попытка {attempt}/{max_attempts}).")
+            return None
+        return sample_task
+
+    first_distractor_logged = []
+
+    def report_distractor(index: int, resp_text: str, elapsed_s: float):
+        if not first_distractor_logged:
+            first_distractor_logged.append(True)
+            gemini_utils.log_info(f"Первый 'неправильный' ответ получен через {elapsed_s:.2f} с.")
+        if on_distractor:
+            on_distractor(index, resp_text, elapsed_s)
+
+    gemini_utils.log_info(f"Параллельная генерация: {num_samples} запросов по одному 'неправильному' ответу.")
+    sample_results = run_parallel(
+        [make_sample_task(len(existing_responses) + i) for i in range(num_samples)],
+        max_workers=max_workers, on_event=report_distractor, thread_name_prefix="fanout"
+    )
+    incorrect_responses = [resp_text for resp_text in sample_results if resp_text]
+    if not incorrect_responses:
+        gemini_utils.log_error("Не получены 'неправильные' ответы от модели генерации.")
+        return []
+    if len(incorrect_responses) < num_samples:
+        gemini_utils.log_warning(f"Получено {len(incorrect_responses)} из {num_samples} 'неправильных' ответов.")
+    gemini_utils.log_success(f"Извлечено {len(incorrect_responses)} 'неправильных' ответов.")
+    return incorrect_responses
+
+
+# --- Этап 2: Оценка ---
+def build_all_responses(model_a_response: str, incorrect_responses: List[str]) -> Dict[str, str]:
+    all_responses_dict = {prompts.MODEL_A_ANSWER_ID: model_a_response}
+    for i, resp_text in enumerate(incorrect_responses):
+        all_responses_dict[prompts.get_incorrect_answer_id(i)] = resp_text
+    return all_responses_dict
+
+
+def build_responses_text_block(all_responses: Dict[str, str]) -> str:
+    """Слишком длинные кандидаты сокращаются только в промпте судьи (token_budget.get_candidate_max_tokens)."""
+    max_tokens = token_budget.get_candidate_max_tokens()
+    text_block_for_prompt = ""
+    trimmed_ids = []
+    for identifier, text in all_responses.items():
+        prompt_text = token_budget.trim_to_tokens(text, max_tokens)
+        if prompt_text is not text:
+            trimmed_ids.append(identifier)
+        text_block_for_prompt += f"{identifier}:\n{prompt_text}\n---\n"
+    if trimmed_ids:
+        gemini_utils.log_info(f"Для оценки сокращены длинные ответы (до ~{max_tokens} токенов): {', '.join(trimmed_ids)}.")
+    return text_block_for_prompt
+
+
+def parse_evaluation_response(full_evaluation_response: str, all_responses: Dict[str, str]) -> Tuple[Optional[str], str]:
+    """Возвращает (выбранный ID или None, обоснование). Если ID не распознан, обоснованием служит весь ответ."""
+    parts = full_evaluation_response.split(prompts.EVALUATION_SECTION_DELIMITER, 1)
+    chosen_id_raw = parts[0].strip()
+    rationale_text = parts[1].strip() if len(parts) > 1 else ""
+
+    chosen_id = chosen_id_raw.split()[0] if chosen_id_raw else ""
+
+    if chosen_id in all_responses:
+        gemini_utils.log_success(f"Оценочная модель выбрала ID: '{chosen_id}'. Обоснование получено.")
+        if not rationale_text:
+            gemini_utils.log_warning("Обоснование от оценочной модели пустое, хотя ID выбран.")
+        return chosen_id, rationale_text
+
+    gemini_utils.log_warning(f"Оценочная модель вернула '{chosen_id_raw}', ID не распознан.")
+    # Попытка найти по тексту (менее надежно, но как запасной вариант)
+    for id_key, text_val in all_responses.items():
+        # Сравниваем только первую часть ответа модели (до разделителя) с текстами кандидатов
+        if chosen_id_raw.strip() == text_val.strip():
+            gemini_utils.log_warning(f"ID '{id_key}' определен по совпадению текста ответа (опасно).")
+            return id_key, rationale_text # Все равно сохраняем обоснование, если есть
+    # Сохраняем весь ответ как "обоснование" для отладки
+    return None, full_evaluation_response
+
+
+@pipeline_stage(STAGE_EVALUATION)
+def evaluate_responses(
+    user_prompt: str,
+    model_a_response: str,
+    incorrect_responses: List[str],
+    files_for_context: Optional[List[Any]] = None,
+    retrieval_context: Optional[retrieval.RetrievalContext] = None,
+    structured_output: bool = False
+) -> EvaluationResult:
+    all_responses_dict = build_all_responses(model_a_response, incorrect_responses)
+    # Фрагменты ищутся и по промпту, и по каждому кандидату, чтобы у судьи были данные для проверки всех ответов
+    prompt_text = _with_retrieved_context(
+        prompts.get_evaluate_responses_prompt(user_prompt, build_responses_text_block(all_responses_dict), structured=structured_output),
+        retrieval_context, [user_prompt] + list(all_responses_dict.values())
+    )
+    if structured_output:
+        verdict = request_structured_output(
+            prompt_text, "evaluation", prompts.get_evaluation_response_schema(list(all_responses_dict)),
+            lambda raw_response: parse_structured_evaluation(raw_response, all_responses_dict),
+            STAGE_EVALUATION, files_for_context=files_for_context
+        )
+        if verdict is None:
+            gemini_utils.log_error("Не получен ответ от оценочной модели.")
+            return EvaluationResult(None, "", all_responses_dict)
+        gemini_utils.log_success(f"Оценочная модель выбрала ID: '{verdict[0]}'. Обоснование получено.")
+        return EvaluationResult(verdict[0], verdict[1], all_responses_dict)
+
+    full_evaluation_response = gemini_utils.generate_text_from_model(
+        prompt_text, model_type="evaluation", # Используем модель для оценки
+        files_for_context=files_for_context
+    )
+    if not full_evaluation_response:
+        gemini_utils.log_error("Не получен ответ от оценочной модели.")
+        return EvaluationResult(None, "", all_responses_dict)
+
+    chosen_id, rationale_text = parse_evaluation_response(full_evaluation_response, all_responses_dict)
+    return EvaluationResult(chosen_id, rationale_text, all_responses_dict)
+
+
+def split_into_groups(candidate_ids: List[str], group_size: int) -> List[List[str]]:
+    """Делит кандидатов на группы не больше group_size с размерами, отличающимися не больше чем на 1."""
+    num_groups = math.ceil(len(candidate_ids) / group_size)
+    base_size, extra = divmod(len(candidate_ids), num_groups)
+    groups, start = [], 0
+    for i in range(num_groups):
+        size = base_size + (1 if i < extra else 0)
+        groups.append(candidate_ids[start:start + size])
+        start += size
+    return groups
+
+
+def _request_verdict(
+    user_prompt: str,
+    candidate_responses: Dict[str, str],
+    files_for_context: Optional[List[Any]],
+    retrieval_context: Optional[retrieval.RetrievalContext],
+    structured_output: bool,
+    bypass_cache: bool = False,
+    cancel_event: Optional[threading.Event] = None,
+    model_type: str = "evaluation"
+) -> Tuple[Optional[str], str]:
+    """Один запрос к судье по кандидатам candidate_responses (в порядке словаря). Возвращает (ID или None, обоснование)."""
+    prompt_text = _with_retrieved_context(
+        prompts.get_evaluate_responses_prompt(user_prompt, build_responses_text_block(candidate_responses), structured=structured_output),
+        retrieval_context, [user_prompt] + list(candidate_responses.values())
+    )
+    if structured_output:
+        verdict = request_structured_output(
+            prompt_text, model_type, prompts.get_evaluation_response_schema(list(candidate_responses)),
+            lambda raw_response: parse_structured_evaluation(raw_response, candidate_responses),
+            STAGE_EVALUATION, files_for_context=files_for_context, bypass_cache=bypass_cache, cancel_event=cancel_event
+        )
+        return verdict or (None, "")
+    full_evaluation_response = gemini_utils.generate_text_from_model(
+        prompt_text, model_type=model_type, files_for_context=files_for_context,
+        bypass_cache=bypass_cache, cancel_event=cancel_event,
+        # Отменяемый запрос читаем потоком: после отмены ответ перестает читаться со следующего фрагмента
+        on_chunk=(lambda text: None) if cancel_event is not None else None
+    )
+    if not full_evaluation_response:
+        return None, ""
+    return parse_evaluation_response(full_evaluation_response, candidate_responses)
+
+
+def _judge_group(
+    user_prompt: str,
+    group_responses: Dict[str, str],
+    files_for_context: Optional[List[Any]],
+    retrieval_context: Optional[retrieval.RetrievalContext],
+    max_attempts: int,
+    structured_output: bool = False
+) -> Tuple[Optional[str], str]:
+    rationale_text = ""
+    for attempt in range(1, max_attempts + 1):
+        # Из кэша повтор вернул бы тот же нераспознанный ответ
+        chosen_id, rationale_text = _request_verdict(
+            user_prompt, group_responses, files_for_context, retrieval_context, structured_output, bypass_cache=attempt > 1
+        )
+        if chosen_id:
+            return chosen_id, rationale_text
+        gemini_utils.log_warning(f"Группа {', '.join(group_responses)}: оценка не получена (попытка {attempt}/{max_attempts}).")
+    return None, rationale_text
+
+
+@pipeline_stage(STAGE_EVALUATION)
+def evaluate_responses_tournament(
+    user_prompt: str,
+    model_a_response: str,
+    incorrect_responses: List[str],
+    files_for_context: Optional[List[Any]] = None,
+    retrieval_context: Optional[retrieval.RetrievalContext] = None,
+    group_size: int = TOURNAMENT_GROUP_SIZE_DEFAULT,
+    max_workers: int = TOURNAMENT_MAX_WORKERS_DEFAULT,
+    max_attempts: int = TOURNAMENT_MAX_ATTEMPTS_DEFAULT,
+    on_round: Optional[Callable[[int, List[Dict[str, Any]]], None]] = None,
+    structured_output: bool = False
+) -> EvaluationResult:
+    """
+    Оценка большого пула кандидатов по сетке: кандидаты делятся на группы не больше group_size,
+    группы оцениваются параллельно, победители групп выходят в следующий раунд, пока не останется одна группа.
+    Число раундов растет как log(N) по числу кандидатов, а промпт судьи остается маленьким.
+    Кандидат, оставшийся в группе один, проходит дальше без запроса к судье.
+    Обоснование итогового выбора — из финала, обоснования всех групп сохраняются в EvaluationResult.rounds.
+    on_round(номер раунда, группы раунда) вызывается в вызывающем потоке после каждого раунда.
+    """
+    all_responses_dict = build_all_responses(model_a_response, incorrect_responses)
+    group_size = max(2, group_size)
+    contenders = list(all_responses_dict)
+    rounds: List[List[Dict[str, Any]]] = []
+
+    def make_group_task(group: List[str]):
+        def group_task(emit):
+            if len(group) == 1:
+                # Сравнивать не с кем (группа из остатка или пул из одного кандидата): запрос к судье не нужен
+                return group[0], "Единственный кандидат группы, прошел без оценки."
+            return _judge_group(
+                user_prompt, {candidate_id: all_responses_dict[candidate_id] for candidate_id in group},
+                files_for_context, retrieval_context, max_attempts, structured_output
+            )
+        return group_task
+
+    while True:
+        round_number = len(rounds) + 1
+        groups = split_into_groups(contenders, group_size)
+        gemini_utils.log_info(f"Турнир, раунд {round_number}: {len(contenders)} кандидатов в {len(groups)} групп(ах).")
+        outcomes = run_parallel(
+            [make_group_task(group) for group in groups], max_workers=max_workers, thread_name_prefix="tournament"
+        )
+        round_groups = [
+            {"candidates": group, "winner": winner_id, "rationale": rationale_text}
+            for group, (winner_id, rationale_text) in zip(groups, outcomes)
+        ]
+        rounds.append(round_groups)
+        if on_round:
+            on_round(round_number, round_groups)
+
+        failed_groups = sum(1 for winner_id, _ in outcomes if winner_id is None)
+        if failed_groups:
+            gemini_utils.log_error(f"Турнир остановлен: в раунде {round_number} не оценено групп: {failed_groups} из {len(groups)}.")
+            return EvaluationResult(None, "", all_responses_dict, rounds)
+        if len(groups) == 1:
+            chosen_id, rationale_text = outcomes[0]
+            gemini_utils.log_success(f"Турнир завершен за {round_number} раунд(ов): выбран '{chosen_id}'.")
+            return EvaluationResult(chosen_id, rationale_text, all_responses_dict, rounds)
+        contenders = [winner_id for winner_id, _ in outcomes]
+
+
+def candidate_orders(candidate_ids: List[str], num_votes: int) -> List[List[str]]:
+    """
+    Порядок кандидатов для каждого голоса: циклические сдвиги, разнесенные равномерно, чтобы каждый кандидат
+    побывал на разных позициях (против склонности судьи к первому/последнему варианту). Первый голос — исходный порядок.
+    """
+    orders = []
+    for vote in range(num_votes):
+        shift = (vote * len(candidate_ids)) // num_votes % len(candidate_ids)
+        orders.append(candidate_ids[shift:] + candidate_ids[:shift])
+    return orders
+
+
+@pipeline_stage(STAGE_EVALUATION)
+def evaluate_responses_self_consistency(
+    user_prompt: str,
+    model_a_response: str,
+    incorrect_responses: List[str],
+    files_for_context: Optional[List[Any]] = None,
+    retrieval_context: Optional[retrieval.RetrievalContext] = None,
+    num_votes: int = SELF_CONSISTENCY_VOTES_DEFAULT,
+    quorum: Optional[int] = None,
+    structured_output: bool = False
+) -> EvaluationResult:
+    """
+    Самосогласованность: до num_votes оценок, у каждой свой порядок кандидатов. Сначала одновременно отправляются
+    quorum оценок (по умолчанию большинство от num_votes); следующие — только при расхождении, ровно столько,
+    сколько голосов не хватает лидеру до кворума. Как только у лидера quorum голосов или отрыв, который оставшиеся
+    голоса уже не отыграют, запросы в полете отменяются. При единогласии время — как у одного запроса, а запросов —
+    quorum. confidence — доля поданных голосов за выбранный ID; обоснование — из первого голоса за него.
+    calls["requested"] — сколько запросов действительно отправлено (включая отмененные в полете).
+    """
+    all_responses_dict = build_all_responses(model_a_response, incorrect_responses)
+    num_votes = max(1, num_votes)
+    quorum = quorum or num_votes // 2 + 1
+    orders = candidate_orders(list(all_responses_dict), num_votes)
+    stop_event = threading.Event()
+
+    def cast_vote(vote: int):
+        # Одинаковый порядок дал бы одинаковый промпт, а из кэша — тот же голос
+        repeated_order = orders[vote] in orders[:vote]
+        return _request_verdict(
+            user_prompt, {candidate_id: all_responses_dict[candidate_id] for candidate_id in orders[vote]},
+            files_for_context, retrieval_context, structured_output, bypass_cache=repeated_order, cancel_event=stop_event
+        )
+
+    votes: Dict[str, int] = {}
+    rationales: Dict[str, str] = {}
+    failed = 0
+    launched = 0
+    pending = set()
+    executor = gemini_utils.make_worker_pool(min(num_votes, quorum), "self_consistency")
+    try:
+        while True:
+            ranked = sorted(votes.values(), reverse=True) + [0, 0]
+            if ranked[0] >= quorum or ranked[0] - ranked[1] > len(pending) + num_votes - launched:
+                break
+            # В полете держится столько голосов, сколько лидеру не хватает до кворума
+            while launched < num_votes and len(pending) < quorum - ranked[0]:
+                pending.add(executor.submit(cast_vote, launched))
+                launched += 1
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chosen_id, rationale_text = future.result()
+                if chosen_id is None:
+                    failed += 1
+                    continue
+                votes[chosen_id] = votes.get(chosen_id, 0) + 1
+                rationales.setdefault(chosen_id, rationale_text)
+    finally:
+        stop_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    calls = {"requested": launched, "voted": sum(votes.values()), "failed": failed,
+             "cancelled": launched - sum(votes.values()) - failed}
+    if not votes:
+        gemini_utils.log_error("Самосогласованность: ни один голос не получен.")
+        return EvaluationResult(None, "", all_responses_dict, calls=calls)
+    # При равенстве голосов побеждает ID, за который проголосовали раньше
+    chosen_id = max(votes, key=lambda candidate_id: (votes[candidate_id], -list(rationales).index(candidate_id)))
+    confidence = round(votes[chosen_id] / calls["voted"], 3)
+    gemini_utils.log_success(
+        f"Самосогласованность: выбран '{chosen_id}' ({votes[chosen_id]} из {calls['voted']} голосов, согласие {confidence:.0%}); "
+        f"отменено запросов: {calls['cancelled']}."
+    )
+    return EvaluationResult(chosen_id, rationales[chosen_id], all_responses_dict, votes=votes, confidence=confidence, calls=calls)
+
+
+@pipeline_stage(STAGE_EVALUATION)
+def evaluate_responses_cascade(
+    user_prompt: str,
+    model_a_response: str,
+    incorrect_responses: List[str],
+    files_for_context: Optional[List[Any]] = None,
+    retrieval_context: Optional[retrieval.RetrievalContext] = None,
+    confidence_threshold: float = CASCADE_CONFIDENCE_THRESHOLD_DEFAULT,
+    screen_votes: int = CASCADE_SCREEN_VOTES_DEFAULT,
+    structured_output: bool = False
+) -> EvaluationResult:
+    """
+    Каскад: screen_votes голосов дешевой модели ("screening") отправляются одновременно, у каждого свой порядок
+    кандидатов. confidence — доля голосов за лидера среди запрошенных (несостоявшийся голос считается несогласием).
+    Если confidence не ниже confidence_threshold, решение дешевой модели окончательное; иначе кейс один раз
+    оценивает дорогая модель ("evaluation"), и ее выбор заменяет решение каскада.
+    """
+    all_responses_dict = build_all_responses(model_a_response, incorrect_responses)
+    screen_votes = max(1, screen_votes)
+    orders = candidate_orders(list(all_responses_dict), screen_votes)
+
+    def make_screen_task(vote: int):
+        def screen_task(emit):
+            return _request_verdict(
+                user_prompt, {candidate_id: all_responses_dict[candidate_id] for candidate_id in orders[vote]},
+                files_for_context, retrieval_context, structured_output,
+                bypass_cache=orders[vote] in orders[:vote], model_type="screening"
+            )
+        return screen_task
+
+    outcomes = run_parallel(
+        [make_screen_task(vote) for vote in range(screen_votes)], max_workers=screen_votes, thread_name_prefix="cascade"
+    )
+    votes: Dict[str, int] = {}
+    rationales: Dict[str, str] = {}
+    for chosen_id, rationale_text in outcomes:
+        if chosen_id:
+            votes[chosen_id] = votes.get(chosen_id, 0) + 1
+            rationales.setdefault(chosen_id, rationale_text)
+    calls = {"screening": screen_votes, "evaluation": 0}
+    leader_id = max(votes, key=votes.get) if votes else None
+    confidence = round(votes[leader_id] / screen_votes, 3) if leader_id else 0.0
+    if leader_id and confidence >= confidence_threshold:
+        metrics.REGISTRY.inc(metrics.CASCADE_DECISIONS, outcome="screened")
+        gemini_utils.log_success(f"Каскад: дешевая модель выбрала '{leader_id}' (согласие {confidence:.0%}), дорогой судья не нужен.")
+        return EvaluationResult(leader_id, rationales[leader_id], all_responses_dict, votes=votes,
+                                confidence=confidence, calls=calls, escalated=False)
+
+    gemini_utils.log_info(f"Каскад: согласие дешевой модели {confidence:.0%} ниже порога {confidence_threshold:.0%}, "
+                          f"кейс передан оценочной модели.")
+    metrics.REGISTRY.inc(metrics.CASCADE_DECISIONS, outcome="escalated")
+    calls["evaluation"] = 1
+    chosen_id, rationale_text = _request_verdict(
+        user_prompt, all_responses_dict, files_for_context, retrieval_context, structured_output
+    )
+    if chosen_id is None:
+        gemini_utils.log_error("Не получен ответ от оценочной модели.")
+    else:
+        gemini_utils.log_success(f"Оценочная модель выбрала ID: '{chosen_id}'.")
+    return EvaluationResult(chosen_id, rationale_text, all_responses_dict, votes=votes,
+                            confidence=confidence, calls=calls, escalated=True)
+
+
+def evaluate_responses_by_mode(
+    evaluation_mode: str,
+    user_prompt: str,
+    model_a_response: str,
+    incorrect_responses: List[str],
+    files_for_context: Optional[List[Any]] = None,
+    retrieval_context: Optional[retrieval.RetrievalContext] = None,
+    structured_output: bool = False,
+    num_votes: int = SELF_CONSISTENCY_VOTES_DEFAULT,
+    cascade_threshold: float = CASCADE_CONFIDENCE_THRESHOLD_DEFAULT
+) -> EvaluationResult:
+    """Этап 2 в режиме evaluation_mode: "single", "tournament", "self_consistency" или "cascade"."""
+    kwargs = {"files_for_context": files_for_context, "retrieval_context": retrieval_context, "structured_output": structured_output}
+    if evaluation_mode == "tournament":
+        return evaluate_responses_tournament(user_prompt, model_a_response, incorrect_responses, **kwargs)
+    if evaluation_mode == "self_consistency":
+        return evaluate_responses_self_consistency(user_prompt, model_a_response, incorrect_responses, num_votes=num_votes, **kwargs)
+    if evaluation_mode == "cascade":
+        return evaluate_responses_cascade(
+            user_prompt, model_a_response, incorrect_responses, confidence_threshold=cascade_threshold, **kwargs
+        )
+    return evaluate_responses(user_prompt, model_a_response, incorrect_responses, **kwargs)
+
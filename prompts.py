@@ -1,14 +1,65 @@
 # geminijudge/prompts.py
+import json
+from typing import List, Optional
 
 MODEL_A_ANSWER_ID = "ОТВЕТ_МОДЕЛИ_A"
 INCORRECT_ANSWER_PARSING_PREFIX = "НЕПРАВИЛЬНЫЙ_ОТВЕТ:"
 EVALUATION_SECTION_DELIMITER = "--- РАЗДЕЛ ОБОСНОВАНИЯ ---" # Разделитель для парсинга ID и обоснования
 
+# Структурированный вывод (response_mime_type="application/json"): схемы ответов в формате response_schema Gemini
+DISTRACTORS_JSON_FIELD = "incorrect_answers"
+DISTRACTORS_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {DISTRACTORS_JSON_FIELD: {"type": "array", "items": {"type": "string"}}},
+    "required": [DISTRACTORS_JSON_FIELD],
+}
+JSON_REPAIR_INPUT_HEADER = "Ответ для исправления:"
+
+# Подсказки "стиля ошибки" для режима, где каждый неправильный ответ генерируется отдельным запросом
+ERROR_STYLE_HINTS = [
+    "Исказить конкретный факт из документов: число, дату, имя или название.",
+    "Упустить ключевую деталь или условие из документов, без которого ответ вводит в заблуждение.",
+    "Ввести 'ложный след': правдоподобную связанную концепцию, которой нет в документах или которая описана там иначе.",
+    "Неверно интерпретировать причинно-следственную связь или вывод, сделанный в документах.",
+    "Перепутать между собой сущности, события или разделы документов.",
+    "Сделать чрезмерное обобщение: распространить частный случай из документов на все случаи.",
+]
+
 
 def get_incorrect_answer_id(index: int) -> str:
     return f"НЕПРАВИЛЬНЫЙ_ОТВЕТ_{index + 1}"
 
-def get_generate_incorrect_answers_prompt(user_prompt: str, model_a_response: str, num_incorrect_samples: int) -> str:
+def get_error_style_hint(index: int) -> str:
+    hint = ERROR_STYLE_HINTS[index % len(ERROR_STYLE_HINTS)]
+    variant = index // len(ERROR_STYLE_HINTS)
+    if variant:
+        hint += f" Это вариант №{variant + 1}: он должен отличаться от других ответов с тем же способом ошибки."
+    return hint
+
+def get_generate_incorrect_answers_prompt(user_prompt: str, model_a_response: str, num_incorrect_samples: int, error_style_hint: str = "", structured: bool = False, existing_incorrect_answers: Optional[List[str]] = None) -> str:
+    error_style_block = f"\nГлавный способ ошибиться для этого ответа: {error_style_hint}\n" if error_style_hint else ""
+    # При добавлении ответов к уже полученным (повторный запуск с большим кол-вом) модель не должна их повторять
+    existing_block = ""
+    if existing_incorrect_answers:
+        existing_list = "\n".join(f"- {answer}" for answer in existing_incorrect_answers)
+        existing_block = f"""
+Эти неправильные ответы уже есть. Не повторяй их и их способы ошибиться:
+---
+{existing_list}
+---
+"""
+    if structured:
+        format_block = f"""Сгенерируй {num_incorrect_samples} НЕПРАВИЛЬНЫХ ответов и верни JSON-объект с полем "{DISTRACTORS_JSON_FIELD}":
+массив ровно из {num_incorrect_samples} строк, по одному неправильному ответу в каждой строке, без префиксов и нумерации.
+
+Не добавляй никаких других полей и пояснений."""
+    else:
+        format_block = f"""Сгенерируй {num_incorrect_samples} НЕПРАВИЛЬНЫХ ответов. Каждый ответ должен начинаться с новой строки и префикса "{INCORRECT_ANSWER_PARSING_PREFIX}".
+Пример:
+{INCORRECT_ANSWER_PARSING_PREFIX} [Текст первого неправильного ответа, искажающий факт из документа X]
+{INCORRECT_ANSWER_PARSING_PREFIX} [Текст второго неправильного ответа, упускающий важную деталь из документа Y]
+
+Не добавляй никаких других пояснений. Только ответы с указанным префиксом."""
     return f"""
 Тебе предоставлены:
 1. Контекстные документы (прикреплены к этому запросу). Тщательно изучи их содержимое.
@@ -32,17 +83,42 @@ def get_generate_incorrect_answers_prompt(user_prompt: str, model_a_response: st
 ---
 {model_a_response}
 ---
+{existing_block}
+{format_block}
+Твоя цель — создать сложные для проверки "ловушки", а не очевидные ошибки.
+{error_style_block}"""
 
-Сгенерируй {num_incorrect_samples} НЕПРАВИЛЬНЫХ ответов. Каждый ответ должен начинаться с новой строки и префикса "{INCORRECT_ANSWER_PARSING_PREFIX}".
-Пример:
-{INCORRECT_ANSWER_PARSING_PREFIX} [Текст первого неправильного ответа, искажающий факт из документа X]
-{INCORRECT_ANSWER_PARSING_PREFIX} [Текст второго неправильного ответа, упускающий важную деталь из документа Y]
+def get_retrieved_context_section(context_block: str) -> str:
+    # Добавляется в конец промпта, когда вместо файлов передаются локально отобранные фрагменты
+    return f"""
+ВАЖНО: контекстные документы не прикреплены файлами. Ниже приведены их фрагменты, отобранные как наиболее релевантные запросу.
+Считай эти фрагменты содержимым прикрепленных документов и единственным источником правды.
 
-Не добавляй никаких других пояснений. Только ответы с указанным префиксом.
-Твоя цель — создать сложные для проверки "ловушки", а не очевидные ошибки.
+Фрагменты контекстных документов:
+---
+{context_block}
+---
 """
 
-def get_evaluate_responses_prompt(user_prompt: str, all_responses_text_block: str) -> str:
+def get_evaluate_responses_prompt(user_prompt: str, all_responses_text_block: str, structured: bool = False) -> str:
+    if structured:
+        format_block = f"""ФОРМАТ ТВОЕГО ОТВЕТА:
+Верни JSON-объект с двумя полями:
+- "chosen_id": ТОЛЬКО идентификатор лучшего ответа (например, "{MODEL_A_ANSWER_ID}" или "{get_incorrect_answer_id(0)}");
+- "rationale": детальное обоснование твоего выбора, как описано в Шаге 3."""
+    else:
+        format_block = f"""ФОРМАТ ТВОЕГО ОТВЕТА:
+Твой ответ должен состоять из двух частей, разделенных специальным маркером.
+
+1.  **Идентификатор выбранного ответа:** На первой строке ТОЛЬКО идентификатор лучшего ответа (например, "{MODEL_A_ANSWER_ID}" или "{get_incorrect_answer_id(0)}").
+2.  **Обоснование:** После идентификатора, на новой строке, вставь маркер "{EVALUATION_SECTION_DELIMITER}". Затем, на следующих строках, предоставь детальное обоснование твоего выбора, как описано в Шаге 3.
+
+Пример формата ответа:
+{MODEL_A_ANSWER_ID}
+{EVALUATION_SECTION_DELIMITER}
+Выбранный ответ ({MODEL_A_ANSWER_ID}) является наилучшим, потому что он точно цитирует статистику из документа "Отчет_2023.pdf" (страница 5, параграф 2) касательно роста производства. Также он полно раскрывает причины этого роста, упомянутые в документе "Анализ_рынка.docx" (раздел 3.1).
+{get_incorrect_answer_id(0)} хуже, так как он неверно указывает дату ключевого события (в документе "История_проекта.txt" это 2022 год, а не 2021).
+... (и так далее)"""
     return f"""
 Ты — высококвалифицированный эксперт-аналитик, специализирующийся на глубокой проверке фактов и оценке качества информации ИСКЛЮЧИТЕЛЬНО на основе предоставленных документов.
 Тебе даны:
@@ -76,19 +152,36 @@ def get_evaluate_responses_prompt(user_prompt: str, all_responses_text_block: st
 {all_responses_text_block}
 ---
 
-ФОРМАТ ТВОЕГО ОТВЕТА:
-Твой ответ должен состоять из двух частей, разделенных специальным маркером.
-
-1.  **Идентификатор выбранного ответа:** На первой строке ТОЛЬКО идентификатор лучшего ответа (например, "{MODEL_A_ANSWER_ID}" или "{get_incorrect_answer_id(0)}").
-2.  **Обоснование:** После идентификатора, на новой строке, вставь маркер "{EVALUATION_SECTION_DELIMITER}". Затем, на следующих строках, предоставь детальное обоснование твоего выбора, как описано в Шаге 3.
-
-Пример формата ответа:
-{MODEL_A_ANSWER_ID}
-{EVALUATION_SECTION_DELIMITER}
-Выбранный ответ ({MODEL_A_ANSWER_ID}) является наилучшим, потому что он точно цитирует статистику из документа "Отчет_2023.pdf" (страница 5, параграф 2) касательно роста производства. Также он полно раскрывает причины этого роста, упомянутые в документе "Анализ_рынка.docx" (раздел 3.1).
-{get_incorrect_answer_id(0)} хуже, так как он неверно указывает дату ключевого события (в документе "История_проекта.txt" это 2022 год, а не 2021).
-... (и так далее)
+{format_block}
 
 Будь предельно внимателен и объективен. Твой анализ должен быть безупречен с точки зрения фактов из документов.
 Если ни один ответ не является идеальным, выбери тот, который содержит наименьшее количество существенных ошибок и наиболее полно отвечает на запрос в рамках документов.
-"""
\ No newline at end of file
+"""
+
+def get_evaluation_response_schema(candidate_ids: list) -> dict:
+    # enum не дает модели выбрать несуществующий идентификатор
+    return {
+        "type": "object",
+        "properties": {
+            "chosen_id": {"type": "string", "format": "enum", "enum": list(candidate_ids)},
+            "rationale": {"type": "string"},
+        },
+        "required": ["chosen_id", "rationale"],
+    }
+
+def get_json_repair_prompt(invalid_output: str, response_schema: dict, error: str) -> str:
+    # Небольшой запрос без документов: исправляется только структура уже полученного ответа
+    return f"""
+Ниже приведен ответ другой модели, который должен был быть JSON-объектом по схеме, но не прошел проверку.
+Ошибка проверки: {error}
+
+Схема:
+{json.dumps(response_schema, ensure_ascii=False)}
+
+{JSON_REPAIR_INPUT_HEADER}
+---
+{invalid_output}
+---
+
+Верни только исправленный JSON по схеме. Сохрани содержание ответа: не добавляй, не удаляй и не переписывай тексты, исправь только структуру и синтаксис.
+"""
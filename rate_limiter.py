@@ -0,0 +1,295 @@
+# geminijudge/rate_limiter.py
+# Общий планировщик запросов к Gemini (модели и File API): клиентские лимиты RPM/TPM на каждую пару
+# (API ключ, модель), повтор 429 и временных ошибок с экспоненциальной задержкой и джиттером,
+# распределение нагрузки между несколькими API ключами.
+#
+# Лимиты задаются переменными окружения (0 — без ограничения):
+#   GEMINIJUDGE_RPM, GEMINIJUDGE_TPM             — для всех моделей на один ключ
+#   GEMINIJUDGE_RATE_LIMITS                      — JSON {"gemini-2.0-flash-lite": {"rpm": 30, "tpm": 1000000}, ...};
+#                                                  необязательный "burst" — сколько запросов можно отправить разом
+#   GEMINIJUDGE_FILE_API_RPM                     — для загрузки и опроса файлов
+#   GEMINIJUDGE_MAX_ATTEMPTS, GEMINIJUDGE_RETRY_BASE_DELAY_S, GEMINIJUDGE_RETRY_MAX_DELAY_S
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from google.api_core import exceptions as google_exceptions
+
+import metrics
+
+FILE_API_MODEL = "file_api"
+MAX_ATTEMPTS_DEFAULT = 5
+RETRY_BASE_DELAY_S_DEFAULT = 1.0
+RETRY_MAX_DELAY_S_DEFAULT = 60.0
+# Ожидание по умолчанию после 429, если сервер не подсказал retry_delay
+RATE_LIMIT_COOLDOWN_S_DEFAULT = 10.0
+# Если RPM модели не задан, после первого 429 темп подбирается сам: старт с 80% темпа, который подсказал
+# сервер (1 / retry_delay), +1% за каждый успешный запрос, -20% за каждый следующий 429
+ADAPTIVE_DECREASE = 0.8
+ADAPTIVE_INCREASE = 1.01
+ADAPTIVE_MIN_RPS = 0.2
+# Оценка размера запроса для TPM до ответа; после ответа сверяется с usage_metadata (RequestScheduler.settle)
+CHARS_PER_TOKEN = 4
+TOKENS_PER_FILE_ESTIMATE = 2000
+
+RATE_LIMIT_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+TRANSIENT_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.Aborted,
+    ConnectionError,
+    TimeoutError,
+)
+_RETRY_DELAY_RE = re.compile(r"retry(?:_delay)?\D{0,20}?(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+T = TypeVar("T")
+# (RPM, TPM, burst запросов); 0 — без ограничения, burst None — вся минутная квота
+Limits = Tuple[float, float, Optional[float]]
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    return isinstance(error, RATE_LIMIT_ERRORS)
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    return isinstance(error, RATE_LIMIT_ERRORS + TRANSIENT_ERRORS)
+
+
+def retry_delay_hint(error: BaseException) -> Optional[float]:
+    """Пауза, которую сервер просит выдержать после 429 (RetryInfo в тексте ошибки), если она указана."""
+    match = _RETRY_DELAY_RE.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+def estimate_request_tokens(prompt_text: str, num_files: int = 0) -> int:
+    return len(prompt_text) // CHARS_PER_TOKEN + 1 + num_files * TOKENS_PER_FILE_ESTIMATE
+
+
+class TokenBucket:
+    """
+    Ведро на минутную квоту. Резервирование может увести баланс в минус — тогда вызывающий ждет,
+    пока ведро не наполнится, а следующие встают в очередь за ним (честный порядок без блокировок на время сна).
+    Не потокобезопасно само по себе: вызывается под замком планировщика.
+    """
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        # По умолчанию можно сразу израсходовать всю минутную квоту, как в окне квоты Gemini
+        self.capacity = float(burst or per_minute)
+        self.rate_per_s = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_s)
+        self.updated = now
+
+    def wait_for(self, amount: float, now: float) -> float:
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate_per_s)
+
+    def reserve(self, amount: float, now: float) -> float:
+        wait_s = self.wait_for(amount, now)
+        self.tokens -= min(amount, self.capacity)
+        return wait_s
+
+    def adjust(self, delta: float, now: float):
+        """Поправка после ответа: фактический расход токенов минус оценка (отрицательная — возврат)."""
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+    def penalize(self, delay_s: float, now: float):
+        """После 429: следующий запрос не раньше чем через delay_s, остальные — за ним с обычным интервалом."""
+        self._refill(now)
+        self.tokens = min(self.tokens, -delay_s * self.rate_per_s)
+
+
+class _Lane:
+    """Лимиты одной пары (ключ, модель): заданные в конфиге или подобранные после 429."""
+
+    def __init__(self, rpm: float, tpm: float, burst: Optional[float] = None):
+        self.configured_rpm = rpm > 0
+        self.requests = TokenBucket(rpm, burst) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+
+    def on_success(self):
+        if self.requests and not self.configured_rpm:
+            self.requests.rate_per_s *= ADAPTIVE_INCREASE
+
+    def on_rate_limit(self, delay_s: float, now: float):
+        if not self.configured_rpm:
+            if self.requests is None:
+                rate_per_s = max(ADAPTIVE_MIN_RPS, ADAPTIVE_DECREASE / max(delay_s, 1e-3))
+                self.requests = TokenBucket(rate_per_s * 60, burst=1)
+            else:
+                self.requests.rate_per_s = max(ADAPTIVE_MIN_RPS, self.requests.rate_per_s * ADAPTIVE_DECREASE)
+        self.requests.penalize(delay_s, now)
+
+    def wait_for(self, estimated_tokens: float, now: float) -> float:
+        waits = [0.0]
+        if self.requests:
+            waits.append(self.requests.wait_for(1, now))
+        if self.tokens and estimated_tokens:
+            waits.append(self.tokens.wait_for(estimated_tokens, now))
+        return max(waits)
+
+    def reserve(self, estimated_tokens: float, now: float) -> float:
+        waits = [0.0]
+        if self.requests:
+            waits.append(self.requests.reserve(1, now))
+        if self.tokens and estimated_tokens:
+            waits.append(self.tokens.reserve(estimated_tokens, now))
+        return max(waits)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def load_limits_from_env() -> Tuple[Limits, Dict[str, Limits]]:
+    default_limits: Limits = (_env_float("GEMINIJUDGE_RPM", 0), _env_float("GEMINIJUDGE_TPM", 0), None)
+    per_model: Dict[str, Limits] = {FILE_API_MODEL: (_env_float("GEMINIJUDGE_FILE_API_RPM", 0), 0, None)}
+    try:
+        configured = json.loads(os.getenv("GEMINIJUDGE_RATE_LIMITS", "") or "{}")
+    except ValueError:
+        configured = {}
+    for model_name, limits in configured.items():
+        per_model[model_name.removeprefix("models/")] = (
+            float(limits.get("rpm", 0)), float(limits.get("tpm", 0)), limits.get("burst")
+        )
+    return default_limits, per_model
+
+
+class RequestScheduler:
+    def __init__(
+        self,
+        default_limits: Limits = (0, 0, None),
+        model_limits: Optional[Dict[str, Limits]] = None,
+        max_attempts: int = MAX_ATTEMPTS_DEFAULT,
+        base_delay_s: float = RETRY_BASE_DELAY_S_DEFAULT,
+        max_delay_s: float = RETRY_MAX_DELAY_S_DEFAULT,
+    ):
+        self.default_limits = default_limits
+        self.model_limits = model_limits or {}
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self._lanes: Dict[Tuple[str, str], _Lane] = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+
+    def _lane(self, api_key: str, model_name: str) -> _Lane:
+        lane = self._lanes.get((api_key, model_name))
+        if lane is None:
+            rpm, tpm, burst = self.model_limits.get(model_name.removeprefix("models/"), self.default_limits)
+            lane = self._lanes[(api_key, model_name)] = _Lane(rpm, tpm, burst)
+        return lane
+
+    def _acquire(self, model_name: str, estimated_tokens: float, candidates: List[str]) -> Tuple[str, float]:
+        """Выбирает ключ, который освободится раньше всех, и резервирует на нем квоту. Возвращает (ключ, ожидание)."""
+        with self._lock:
+            now = time.monotonic()
+            api_key = min(candidates, key=lambda key: self._lane(key, model_name).wait_for(estimated_tokens, now))
+            return api_key, self._lane(api_key, model_name).reserve(estimated_tokens, now)
+
+    def _backoff_delay(self, attempt: int) -> float:
+        # "Полный джиттер": одновременно упавшие запросы не повторяются синхронно
+        with self._lock:
+            return self._rng.uniform(0, min(self.max_delay_s, self.base_delay_s * 2 ** attempt))
+
+    def settle(self, api_key: str, model_name: str, estimated_tokens: float, actual_tokens: Optional[int]):
+        """Сверяет оценку токенов с usage_metadata ответа."""
+        if actual_tokens is None:
+            return
+        with self._lock:
+            lane = self._lane(api_key, model_name)
+            if lane.tokens:
+                lane.tokens.adjust(actual_tokens - estimated_tokens, time.monotonic())
+
+    def _on_success(self, api_key: str, model_name: str):
+        with self._lock:
+            self._lane(api_key, model_name).on_success()
+
+    def _on_rate_limit(self, api_key: str, model_name: str, delay_s: float):
+        with self._lock:
+            self._lane(api_key, model_name).on_rate_limit(delay_s, time.monotonic())
+
+    def call(
+        self,
+        model_name: str,
+        func: Callable[[str], T],
+        estimated_tokens: float = 0,
+        candidates: Optional[List[str]] = None,
+        can_retry: Optional[Callable[[], bool]] = None,
+        on_retry: Optional[Callable[[int, BaseException, float], None]] = None,
+    ) -> T:
+        """
+        Вызывает func(api_key) в пределах лимитов. 429 и временные ошибки повторяются до max_attempts раз;
+        после 429 ключ притормаживается для этой модели, и следующая попытка может уйти на другой ключ.
+        candidates — ключи вызывающего, между которыми можно выбирать (планировщик общий для всех сессий и ключей
+        не хранит); один ключ — запрос закреплен за ним (например, ссылается на файлы, загруженные с ним).
+        can_retry — False, если повтор уже небезопасен (например, часть потокового ответа отдана дальше).
+        Ошибки, которые не стоит повторять, и последняя неудачная попытка пробрасываются.
+        """
+        candidates = list(dict.fromkeys(key for key in candidates or [] if key)) or [""]
+        attempt = 0
+        while True:
+            api_key, wait_s = self._acquire(model_name, estimated_tokens, candidates)
+            if wait_s > 0:
+                metrics.REGISTRY.observe(metrics.RATE_LIMIT_WAIT, wait_s, model=model_name)
+                time.sleep(wait_s)
+            try:
+                result = func(api_key)
+                self._on_success(api_key, model_name)
+                return result
+            except Exception as e:
+                last_attempt = attempt + 1 >= self.max_attempts
+                if last_attempt or not is_retryable_error(e) or (can_retry and not can_retry()):
+                    raise
+                if is_rate_limit_error(e):
+                    delay_s = (retry_delay_hint(e) or RATE_LIMIT_COOLDOWN_S_DEFAULT) + self._backoff_delay(0)
+                    self._on_rate_limit(api_key, model_name, delay_s)
+                    reason = "rate_limit"
+                else:
+                    delay_s = self._backoff_delay(attempt)
+                    reason = "transient"
+                metrics.REGISTRY.inc(metrics.RETRIES, model=model_name, reason=reason)
+                if on_retry:
+                    on_retry(attempt + 1, e, delay_s)
+                if reason == "transient":
+                    time.sleep(delay_s)
+                attempt += 1
+
+
+_scheduler: Optional[RequestScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_request_scheduler() -> RequestScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            default_limits, model_limits = load_limits_from_env()
+            _scheduler = RequestScheduler(
+                default_limits, model_limits,
+                max_attempts=int(_env_float("GEMINIJUDGE_MAX_ATTEMPTS", MAX_ATTEMPTS_DEFAULT)),
+                base_delay_s=_env_float("GEMINIJUDGE_RETRY_BASE_DELAY_S", RETRY_BASE_DELAY_S_DEFAULT),
+                max_delay_s=_env_float("GEMINIJUDGE_RETRY_MAX_DELAY_S", RETRY_MAX_DELAY_S_DEFAULT),
+            )
+        return _scheduler
+
+
+def reset_request_scheduler():
+    """Пересоздать планировщик при следующем обращении (например, после смены переменных окружения)."""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = None
@@ -0,0 +1,364 @@
+# geminijudge/replay.py
+# Запись и воспроизведение ответов Gemini для регрессионных прогонов без сети и квоты.
+# Слой подменяет gemini_clients.make_model / upload_file / get_file (как fake_gemini), поэтому код пайплайна
+# не меняется.
+#
+# Режимы (GEMINIJUDGE_REPLAY или batch_judge.py --replay):
+#   record — запросы идут в API, ответы сохраняются в хранилище;
+#   replay — записанные ответы отдаются локально, незаписанные запросы идут в API и дописываются;
+#   strict — только записанные ответы, любой незаписанный запрос — ошибка UnrecordedRequest.
+#
+# Отпечаток запроса — модель, конфиг генерации, настройки безопасности, хэш промпта и sha256 содержимого файлов.
+# Хранилище — gzip JSONL (по строке на ответ или файл), при загрузке побеждает последняя запись с тем же ключом.
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from google.api_core import exceptions as google_exceptions
+
+import gemini_clients
+import metrics
+import response_cache
+import upload_cache
+
+MODES = ("off", "record", "replay", "strict")
+REPLAY_FILENAME = "replay.jsonl.gz"
+# Имена воспроизведенных файлов: по ним слой узнает, что файл не существует на сервере
+REPLAY_FILE_PREFIX = "files/replay-"
+# Блок чтения загружаемого файла при подсчете хэша
+READ_BLOCK_BYTES = 1024 * 1024
+
+
+class UnrecordedRequest(LookupError):
+    """Запрос отсутствует в записи (режим strict или файлы контекста воспроизведены локально)."""
+
+
+def get_mode() -> str:
+    mode = os.getenv("GEMINIJUDGE_REPLAY", "off").lower()
+    return mode if mode in MODES else "off"
+
+
+def get_store_path() -> str:
+    return os.getenv("GEMINIJUDGE_REPLAY_PATH") or os.path.join(upload_cache.get_cache_dir(), REPLAY_FILENAME)
+
+
+def prompt_digest(prompt_text: str) -> str:
+    return hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()
+
+
+def _content_digest(path_or_stream: Any) -> str:
+    """sha256 загружаемого файла, прочитанного блоками (поток после подсчета перематывается в начало)."""
+    digest = hashlib.sha256()
+    stream = path_or_stream if hasattr(path_or_stream, "read") else open(path_or_stream, "rb")
+    try:
+        while True:
+            block = stream.read(READ_BLOCK_BYTES)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        if stream is path_or_stream:
+            stream.seek(0)
+        else:
+            stream.close()
+    return digest.hexdigest()
+
+
+class ReplayStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._responses: Dict[str, Dict[str, Any]] = {}
+        self._files: Dict[str, Dict[str, Any]] = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if self._load():
+            self._rewrite()
+        self._writer = None
+
+    def _load(self) -> bool:
+        """Читает запись; True, если файл оборван (процесс записи был прерван) и его нужно переписать."""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    self._apply(json.loads(line))
+        except (EOFError, OSError, zlib.error, json.JSONDecodeError):
+            return True
+        return False
+
+    def _apply(self, entry: Dict[str, Any]):
+        if entry.get("type") == "file":
+            self._files[entry["digest"]] = entry
+        elif entry.get("type") == "response":
+            self._responses[entry["key"]] = entry
+
+    def _rewrite(self):
+        tmp_path = f"{self.path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            for entry in list(self._files.values()) + list(self._responses.values()):
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def _append(self, entry: Dict[str, Any]):
+        with self._lock:
+            existing = self._files.get(entry.get("digest")) or self._responses.get(entry.get("key"))
+            if existing == entry:
+                # Повторный одинаковый ответ не увеличивает запись
+                return
+            self._apply(entry)
+            if self._writer is None:
+                self._writer = gzip.open(self.path, "at", encoding="utf-8")
+            self._writer.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            # Сброс после каждой записи: прерванный прогон теряет только хвост сжатого потока
+            self._writer.flush()
+            self.recorded += 1
+
+    def get_response(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._responses.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put_response(self, key: str, model_name: str, response: Any):
+        text = response.text if response.parts else ""
+        finish_reason = None
+        if getattr(response, "candidates", None) and getattr(response.candidates[0], "finish_reason", None):
+            finish_reason = response.candidates[0].finish_reason.name
+        feedback = getattr(response, "prompt_feedback", None)
+        block_reason = feedback.block_reason.name if feedback and getattr(feedback, "block_reason", None) else None
+        self._append({
+            "type": "response", "key": key, "model": model_name, "text": text,
+            "finish_reason": finish_reason, "block_reason": block_reason,
+            "usage": metrics.usage_from_response(response),
+        })
+
+    def get_file(self, digest: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._files.get(digest)
+
+    def put_file(self, digest: str, mime_type: Optional[str], display_name: Optional[str]):
+        if self.get_file(digest) is None:
+            self._append({"type": "file", "digest": digest, "mime_type": mime_type, "display_name": display_name})
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": _mode, "path": self.path, "responses": len(self._responses), "files": len(self._files),
+                "hits": self.hits, "misses": self.misses, "recorded": self.recorded,
+            }
+
+
+_mode = "off"
+_store: Optional[ReplayStore] = None
+_ORIGINALS: List[tuple] = []
+# Имя файла (удаленного или воспроизведенного) -> sha256 содержимого
+_digest_by_name: Dict[str, str] = {}
+_digest_lock = threading.Lock()
+
+
+def get_store() -> Optional[ReplayStore]:
+    return _store
+
+
+def _remember_digest(name: str, digest: str):
+    with _digest_lock:
+        _digest_by_name[name] = digest
+
+
+def _file_digest(gemini_file: Any) -> str:
+    with _digest_lock:
+        digest = _digest_by_name.get(gemini_file.name)
+    return digest or response_cache.file_identity(gemini_file)
+
+
+def _replayed_file(name: str, entry: Dict[str, Any], display_name: Optional[str] = None) -> SimpleNamespace:
+    return SimpleNamespace(
+        name=name, display_name=display_name or entry.get("display_name") or name, mime_type=entry.get("mime_type"),
+        state=SimpleNamespace(name="ACTIVE"), error=None,
+        expiration_time=datetime.now(timezone.utc) + timedelta(hours=48),
+    )
+
+
+def _replayed_response(entry: Dict[str, Any], stream: bool) -> gemini_clients.StaticResponse:
+    usage = SimpleNamespace(
+        prompt_token_count=entry["usage"].get("prompt_tokens"),
+        candidates_token_count=entry["usage"].get("candidates_tokens"),
+        total_token_count=entry["usage"].get("total_tokens"),
+    )
+    text = entry["text"]
+    response = gemini_clients.StaticStreamResponse(text, usage) if stream else gemini_clients.StaticResponse(text, usage)
+    response.candidates = [SimpleNamespace(finish_reason=SimpleNamespace(name=entry["finish_reason"]))] \
+        if entry.get("finish_reason") else []
+    if entry.get("block_reason"):
+        response.prompt_feedback = SimpleNamespace(block_reason=SimpleNamespace(name=entry["block_reason"]))
+    return response
+
+
+class _RecordingStream:
+    """Потоковый ответ API, который сохраняется в запись после полного прохода по фрагментам."""
+
+    def __init__(self, response: Any, on_complete):
+        self._response = response
+        self._on_complete = on_complete
+
+    def __iter__(self):
+        for chunk in self._response:
+            yield chunk
+        self._on_complete(self._response)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._response, name)
+
+
+def _original(attr: str) -> Any:
+    """Функция, поверх которой установлен слой (настоящий genai или fake_gemini)."""
+    return next(original for _, name, original in _ORIGINALS if name == attr)
+
+
+class ReplayGenerativeModel:
+    def __init__(self, api_key: str, model_name: str, safety_settings: Any = None, generation_config: Any = None, **kwargs):
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self._safety_settings = safety_settings
+        self._generation_config = generation_config or {}
+        self._init_args = (api_key, model_name, safety_settings, generation_config, kwargs)
+        self._live_model = None
+
+    def _live(self) -> Any:
+        if self._live_model is None:
+            api_key, model_name, safety_settings, generation_config, kwargs = self._init_args
+            self._live_model = _original("make_model")(api_key, model_name, safety_settings=safety_settings,
+                                                       generation_config=generation_config, **kwargs)
+        return self._live_model
+
+    def fingerprint(self, contents: Any, generation_config: Optional[Dict[str, Any]] = None) -> str:
+        parts = contents if isinstance(contents, list) else [contents]
+        prompt_text = "\n".join(part for part in parts if isinstance(part, str))
+        file_ids = [_file_digest(part) for part in parts if not isinstance(part, str)]
+        # Конфиг запроса (например, схема JSON-ответа) дополняет конфиг модели, как и в genai
+        config = {**self._generation_config, **(generation_config or {})}
+        return response_cache.request_key(
+            self.model_name, config, self._safety_settings, prompt_digest(prompt_text), file_ids
+        )
+
+    def generate_content(self, contents: Any, stream: bool = False, **kwargs) -> Any:
+        key = self.fingerprint(contents, kwargs.get("generation_config"))
+        if _mode in ("replay", "strict"):
+            entry = _store.get_response(key)
+            if entry is not None:
+                return _replayed_response(entry, stream)
+            parts = contents if isinstance(contents, list) else [contents]
+            if _mode == "strict":
+                raise UnrecordedRequest(f"запрос к {self.model_name} не записан (ключ {key[:12]})")
+            if any(getattr(part, "name", "").startswith(REPLAY_FILE_PREFIX) for part in parts
+                   if not isinstance(part, str)):
+                raise UnrecordedRequest(f"запрос к {self.model_name} не записан, а файлы контекста воспроизведены локально")
+        response = self._live().generate_content(contents, stream=stream, **kwargs)
+        if stream:
+            return _RecordingStream(response, lambda full: _store.put_response(key, self.model_name, full))
+        _store.put_response(key, self.model_name, response)
+        return response
+
+    def count_tokens(self, contents: Any) -> Any:
+        # Подсчет токенов не записывается: при воспроизведении вызывающий обходится оценкой
+        if _mode in ("replay", "strict"):
+            raise UnrecordedRequest(f"подсчет токенов для {self.model_name} не записывается")
+        return self._live().count_tokens(contents)
+
+
+def _upload_file(api_key: str, stream: Any, *, mime_type: str, display_name: str) -> Any:
+    digest = _content_digest(stream)
+    if _mode in ("replay", "strict"):
+        entry = _store.get_file(digest)
+        if entry is not None:
+            replay_name = f"{REPLAY_FILE_PREFIX}{digest[:16]}"
+            _remember_digest(replay_name, digest)
+            return _replayed_file(replay_name, entry, display_name)
+        if _mode == "strict":
+            raise UnrecordedRequest(f"файл '{display_name}' (sha256 {digest[:12]}) не записан")
+    gemini_file = _original("upload_file")(api_key, stream, mime_type=mime_type, display_name=display_name)
+    _remember_digest(gemini_file.name, digest)
+    _store.put_file(digest, mime_type, display_name)
+    return gemini_file
+
+
+def _get_file(api_key: str, name: str) -> Any:
+    with _digest_lock:
+        digest = _digest_by_name.get(name)
+    if _mode in ("replay", "strict"):
+        # Файл из кэша загрузок прошлых живых прогонов тоже воспроизводим, если его содержимое записано
+        digest = digest or upload_cache.get_upload_cache().content_digest(name)
+        entry = _store.get_file(digest) if digest else None
+        if entry is not None:
+            _remember_digest(name, digest)
+            return _replayed_file(name, entry)
+        if _mode == "strict" or name.startswith(REPLAY_FILE_PREFIX):
+            raise google_exceptions.NotFound(f"Файл {name} не записан")
+    return _original("get_file")(api_key, name)
+
+
+def install(mode: str, path: Optional[str] = None) -> Optional[ReplayStore]:
+    """
+    Включает слой записи/воспроизведения поверх текущих клиентов gemini_clients (в том числе поверх fake_gemini).
+    mode "off" снимает слой. Пул моделей gemini_utils после смены режима нужно очистить.
+    Повторный вызов с теми же параметрами ничего не меняет.
+    """
+    global _mode, _store
+    path = path or get_store_path()
+    if _store is not None and _mode == mode and _store.path == path:
+        # Streamlit выполняет скрипт заново на каждое действие: слой и записанные имена файлов сохраняем
+        return _store
+    uninstall()
+    if mode not in MODES:
+        raise ValueError(f"Неизвестный режим записи/воспроизведения: {mode}")
+    if mode == "off":
+        return None
+    _mode = mode
+    _store = ReplayStore(path)
+    replacements = [
+        (gemini_clients, "make_model", ReplayGenerativeModel),
+        (gemini_clients, "upload_file", _upload_file),
+        (gemini_clients, "get_file", _get_file),
+    ]
+    for target, attr, replacement in replacements:
+        _ORIGINALS.append((target, attr, getattr(target, attr)))
+        setattr(target, attr, replacement)
+    return _store
+
+
+def install_from_env() -> Optional[ReplayStore]:
+    return install(get_mode())
+
+
+def uninstall():
+    global _mode, _store
+    while _ORIGINALS:
+        target, attr, original = _ORIGINALS.pop()
+        setattr(target, attr, original)
+    if _store is not None:
+        _store.close()
+    _mode, _store = "off", None
+    with _digest_lock:
+        _digest_by_name.clear()
+
+
+atexit.register(uninstall)
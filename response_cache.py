@@ -0,0 +1,134 @@
+# geminijudge/response_cache.py
+# Дисковый кэш ответов моделей (SQLite): одинаковые запросы генерации/оценки не тратят квоту повторно.
+# Ключ — модель, конфиг генерации, текст промпта и хэши содержимого прикрепленных файлов.
+# Вытеснение — LRU по суммарному размеру, плюс TTL на каждую запись.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import upload_cache
+
+RESPONSE_CACHE_FILENAME = "responses.sqlite3"
+RESPONSE_CACHE_MAX_MB_DEFAULT = 256
+RESPONSE_CACHE_TTL_S_DEFAULT = 7 * 24 * 3600
+
+
+def is_enabled() -> bool:
+    return os.getenv("GEMINIJUDGE_RESPONSE_CACHE", "0").lower() in ("1", "true", "yes", "on")
+
+
+def request_key(model_name: str, generation_config: Dict[str, Any], safety_settings: Any,
+                prompt_text: str, file_ids: List[str]) -> str:
+    payload = json.dumps(
+        {"model": model_name, "config": generation_config, "safety": safety_settings,
+         "prompt": prompt_text, "files": file_ids},
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_identity(gemini_file: Any) -> str:
+    """Хэш содержимого файла, если он известен кэшу загрузок, иначе имя удаленного файла."""
+    return upload_cache.get_upload_cache().content_digest(gemini_file.name) or gemini_file.name
+
+
+class ResponseCache:
+    def __init__(self, path: str, max_bytes: int, ttl_s: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str, ttl_s: Optional[float] = None):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now + (self.ttl_s if ttl_s is None else ttl_s), now),
+            )
+            self.stores += 1
+            self._evict(now)
+
+    def _evict(self, now: float):
+        self.evictions += self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+        total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        # Удаляем давно не использовавшиеся записи, пока не уложимся в лимит
+        freed = 0
+        evicted_keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            evicted_keys.append((key,))
+            freed += size
+            if total_size - freed <= self.max_bytes:
+                break
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted_keys)
+        self.evictions += len(evicted_keys)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, total_size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": total_size,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                os.path.join(upload_cache.get_cache_dir(), RESPONSE_CACHE_FILENAME),
+                max_bytes=int(float(os.getenv("GEMINIJUDGE_RESPONSE_CACHE_MAX_MB", RESPONSE_CACHE_MAX_MB_DEFAULT)) * 1024 * 1024),
+                ttl_s=float(os.getenv("GEMINIJUDGE_RESPONSE_CACHE_TTL_S", RESPONSE_CACHE_TTL_S_DEFAULT)),
+            )
+        return _response_cache
@@ -0,0 +1,373 @@
+# geminijudge/results_store.py
+# Хранилище результатов оценок (SQLite, только добавление): каждая оценка из UI и batch — одна строка с полями
+# для аналитики (семейство промпта, режим и модели, кто выбран, обманул ли судью 'неправильный' ответ, длительность,
+# токены). Тексты ответов и обоснование лежат в отдельной таблице. Запись идет пачками в одной транзакции, и в ней же
+# обновляются суточные суммы (judgments_daily): агрегаты за целые сутки читаются из них, и только неполные сутки
+# на краях периода — из самих строк, поэтому время запроса почти не зависит от числа оценок.
+import atexit
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import prompts
+import upload_cache
+
+logger = logging.getLogger("geminijudge")
+
+RESULTS_FILENAME = "results.sqlite3"
+# Пачка записывается, когда накопилось столько строк или через FLUSH_INTERVAL_S после первой строки пачки (таймер)
+WRITE_BATCH_SIZE = 500
+FLUSH_INTERVAL_S = 5.0
+# Семейство промпта по умолчанию — первые слова промпта без чисел и знаков препинания
+PROMPT_FAMILY_WORDS = 3
+DAY_S = 86400
+# Измерения суточных сумм: по ним можно группировать и фильтровать
+DIMENSIONS = ("source", "prompt_family", "evaluation_model", "evaluation_mode", "status")
+GROUP_BY_COLUMNS = DIMENSIONS[:4] + ("day",)
+FILTER_COLUMNS = DIMENSIONS
+# Суммы, из которых складываются показатели; в judgments_daily — столбцы с теми же именами
+TOTALS_COLUMNS = ("cases", "ok", "won", "won_n", "fooled", "fooled_n", "elapsed_sum", "elapsed_n", "elapsed_max", "tokens")
+RAW_TOTALS_SQL = (
+    "COUNT(*), SUM(status = 'ok'), SUM(model_a_won), COUNT(model_a_won), SUM(fooled), COUNT(fooled),"
+    " SUM(elapsed_s), COUNT(elapsed_s), MAX(elapsed_s), SUM(total_tokens)"
+)
+DAILY_TOTALS_SQL = (
+    "SUM(cases), SUM(ok), SUM(won), SUM(won_n), SUM(fooled), SUM(fooled_n),"
+    " SUM(elapsed_sum), SUM(elapsed_n), MAX(elapsed_max), SUM(tokens)"
+)
+
+
+def is_enabled() -> bool:
+    return os.getenv("GEMINIJUDGE_RESULTS_STORE", "1").lower() in ("1", "true", "yes", "on")
+
+
+def derive_prompt_family(prompt_text: str) -> str:
+    words = re.findall(r"[^\W\d_]+", prompt_text.casefold())
+    return " ".join(words[:PROMPT_FAMILY_WORDS]) or "—"
+
+
+def build_record(
+    source: str,
+    run_id: Any,
+    status: str,
+    prompt_text: str,
+    model_a_response: str,
+    incorrect_responses: List[str],
+    chosen_id: Optional[str],
+    rationale: str = "",
+    prompt_family: Optional[str] = None,
+    generation_mode: Optional[str] = None,
+    evaluation_mode: Optional[str] = None,
+    generation_model: Optional[str] = None,
+    evaluation_model: Optional[str] = None,
+    elapsed_s: Optional[float] = None,
+    run_metrics: Optional[Dict[str, Any]] = None,
+    created_at: Optional[float] = None
+) -> Dict[str, Any]:
+    """Строка хранилища из результата одной оценки (run_metrics — metrics.RunRecorder.breakdown())."""
+    tokens_by_model_type = (run_metrics or {}).get("tokens_by_model_type", {})
+    return {
+        "created_at": created_at or time.time(),
+        "source": source,
+        "run_id": None if run_id is None else str(run_id),
+        "prompt_family": prompt_family or derive_prompt_family(prompt_text),
+        "prompt_hash": hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:16],
+        "status": status,
+        "generation_mode": generation_mode,
+        "evaluation_mode": evaluation_mode,
+        "generation_model": generation_model,
+        "evaluation_model": evaluation_model,
+        "num_candidates": len(incorrect_responses) + 1,
+        "chosen_id": chosen_id,
+        "model_a_won": None if chosen_id is None else int(chosen_id == prompts.MODEL_A_ANSWER_ID),
+        "fooled": None if chosen_id is None else int(chosen_id != prompts.MODEL_A_ANSWER_ID),
+        "elapsed_s": elapsed_s,
+        "total_tokens": sum(totals.get("total_tokens", 0) for totals in tokens_by_model_type.values()) or None,
+        "details": {
+            "prompt": prompt_text, "model_a_response": model_a_response,
+            "incorrect_responses": incorrect_responses, "rationale": rationale,
+        },
+    }
+
+
+RECORD_COLUMNS = (
+    "created_at", "source", "run_id", "prompt_family", "prompt_hash", "status", "generation_mode", "evaluation_mode",
+    "generation_model", "evaluation_model", "num_candidates", "chosen_id", "model_a_won", "fooled", "elapsed_s",
+    "total_tokens",
+)
+
+
+class ResultsStore:
+    def __init__(self, path: str, batch_size: int = WRITE_BATCH_SIZE, flush_interval_s: float = FLUSH_INTERVAL_S):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.written = 0
+        self.batches = 0
+        self._pending: List[Dict[str, Any]] = []
+        self._flush_timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # UI и batch могут писать в один файл из разных процессов
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS judgments ("
+            " id INTEGER PRIMARY KEY, created_at REAL NOT NULL, source TEXT NOT NULL, run_id TEXT,"
+            " prompt_family TEXT NOT NULL, prompt_hash TEXT NOT NULL, status TEXT NOT NULL,"
+            " generation_mode TEXT, evaluation_mode TEXT, generation_model TEXT, evaluation_model TEXT,"
+            " num_candidates INTEGER, chosen_id TEXT, model_a_won INTEGER, fooled INTEGER,"
+            " elapsed_s REAL, total_tokens INTEGER)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS judgment_details (id INTEGER PRIMARY KEY, details TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS judgments_created ON judgments(created_at)")
+        # Пустые измерения хранятся как '' (NULL не совпадает сам с собой в первичном ключе)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS judgments_daily ("
+            f" day INTEGER NOT NULL, {', '.join(f'{d} TEXT NOT NULL' for d in DIMENSIONS)},"
+            " cases INTEGER NOT NULL, ok INTEGER NOT NULL, won INTEGER NOT NULL, won_n INTEGER NOT NULL,"
+            " fooled INTEGER NOT NULL, fooled_n INTEGER NOT NULL, elapsed_sum REAL NOT NULL, elapsed_n INTEGER NOT NULL,"
+            " elapsed_max REAL, tokens INTEGER NOT NULL,"
+            f" PRIMARY KEY (day, {', '.join(DIMENSIONS)})) WITHOUT ROWID"
+        )
+
+    # --- Запись ---
+    def append(self, record: Dict[str, Any], flush: bool = False):
+        """
+        Ставит строку в очередь. Пачка пишется, когда наберется batch_size строк, по таймеру через flush_interval_s
+        после первой строки (даже если новых строк больше не будет), перед запросами и при выходе.
+        flush=True — записать сразу (одиночные оценки из UI: их сразу видят другие процессы, и они не теряются при падении).
+        """
+        with self._lock:
+            self._pending.append(record)
+            if flush or len(self._pending) >= self.batch_size:
+                self._flush_locked()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval_s, self._flush_on_timer)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_on_timer(self):
+        with self._lock:
+            self._flush_timer = None
+            try:
+                self._flush_locked()
+            except sqlite3.Error as e:
+                # Строки остались в очереди: запишутся со следующей пачкой или при выходе
+                logger.warning(f"Хранилище результатов: не удалось записать пачку ({type(e).__name__} - {e}).")
+
+    def _flush_locked(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if not self._pending:
+            return
+        records, self._pending = self._pending, []
+        daily: Dict[tuple, List[Any]] = {}
+        for record in records:
+            key = (int(record["created_at"] // DAY_S) * DAY_S,) + tuple(record.get(d) or "" for d in DIMENSIONS)
+            totals = daily.setdefault(key, [0, 0, 0, 0, 0, 0, 0.0, 0, None, 0])
+            totals[0] += 1
+            totals[1] += record["status"] == "ok"
+            if record.get("model_a_won") is not None:
+                totals[2] += record["model_a_won"]
+                totals[3] += 1
+            if record.get("fooled") is not None:
+                totals[4] += record["fooled"]
+                totals[5] += 1
+            if record.get("elapsed_s") is not None:
+                totals[6] += record["elapsed_s"]
+                totals[7] += 1
+                totals[8] = max(totals[8] or 0.0, record["elapsed_s"])
+            totals[9] += record.get("total_tokens") or 0
+        key_columns = ("day",) + DIMENSIONS
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            # id назначаются здесь: запись идет под блокировкой файла, поэтому другой процесс их не займет
+            first_id = self._conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM judgments").fetchone()[0]
+            self._conn.executemany(
+                f"INSERT INTO judgments (id, {', '.join(RECORD_COLUMNS)}) VALUES (?{', ?' * len(RECORD_COLUMNS)})",
+                [[first_id + i] + [record.get(column) for column in RECORD_COLUMNS] for i, record in enumerate(records)],
+            )
+            self._conn.executemany(
+                "INSERT INTO judgment_details (id, details) VALUES (?, ?)",
+                [(first_id + i, json.dumps(record["details"], ensure_ascii=False))
+                 for i, record in enumerate(records) if record.get("details") is not None],
+            )
+            self._conn.executemany(
+                f"INSERT INTO judgments_daily ({', '.join(key_columns + TOTALS_COLUMNS)})"
+                f" VALUES ({', '.join('?' * (len(key_columns) + len(TOTALS_COLUMNS)))})"
+                f" ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET "
+                + ", ".join(
+                    f"{c} = MAX(COALESCE({c}, excluded.{c}), COALESCE(excluded.{c}, {c}))" if c == "elapsed_max"
+                    else f"{c} = {c} + excluded.{c}"
+                    for c in TOTALS_COLUMNS
+                ),
+                [list(key) + totals for key, totals in daily.items()],
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            self._pending = records + self._pending
+            raise
+        self.written += len(records)
+        self.batches += 1
+
+    # --- Запросы ---
+    @staticmethod
+    def _where(column_filters: Dict[str, Any], conditions: List[str], params: List[Any]):
+        clauses, params = list(conditions), list(params)
+        for column, value in column_filters.items():
+            if column not in FILTER_COLUMNS:
+                raise ValueError(f"Фильтр по '{column}' не поддерживается, доступны: {', '.join(FILTER_COLUMNS)}")
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def _query(self, sql: str, params: List[Any]) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._flush_locked()
+            cursor = self._conn.execute(sql, params)
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def _totals(
+        self, group_by: Optional[str], since: Optional[float], until: Optional[float], filters: Dict[str, Any]
+    ) -> Dict[Any, List[Any]]:
+        """Суммы по группам: целые сутки периода — из judgments_daily, неполные сутки на краях — из judgments."""
+        day_from = None if since is None else math.ceil(since / DAY_S) * DAY_S
+        day_to = None if until is None else math.floor(until / DAY_S) * DAY_S
+        parts = []
+        if day_from is None or day_to is None or day_from < day_to:
+            conditions, params = [], []
+            if day_from is not None:
+                conditions.append("day >= ?")
+                params.append(day_from)
+            if day_to is not None:
+                conditions.append("day < ?")
+                params.append(day_to)
+            where, params = self._where(filters, conditions, params)
+            group = group_by or "NULL"
+            parts.append((f"SELECT {group}, {DAILY_TOTALS_SQL} FROM judgments_daily{where} GROUP BY 1", params))
+            raw_ranges = [(since, day_from)] if since is not None and since < day_from else []
+            if until is not None and day_to < until:
+                raw_ranges.append((day_to, until))
+        else:
+            # Период внутри одних суток
+            raw_ranges = [(since, until)]
+        raw_group = {None: "NULL", "day": f"CAST(created_at / {DAY_S} AS INTEGER) * {DAY_S}"}.get(
+            group_by, f"COALESCE({group_by}, '')"
+        )
+        for range_from, range_to in raw_ranges:
+            where, params = self._where(filters, ["created_at >= ?", "created_at < ?"], [range_from, range_to])
+            parts.append((f"SELECT {raw_group}, {RAW_TOTALS_SQL} FROM judgments{where} GROUP BY 1", params))
+
+        totals: Dict[Any, List[Any]] = {}
+        with self._lock:
+            self._flush_locked()
+            for sql, params in parts:
+                for key, *row in self._conn.execute(sql, params):
+                    if not row[0]:
+                        continue
+                    merged = totals.setdefault(key, [0] * len(TOTALS_COLUMNS))
+                    for i, (column, value) in enumerate(zip(TOTALS_COLUMNS, row)):
+                        if column == "elapsed_max":
+                            merged[i] = max(merged[i], value or 0)
+                        else:
+                            merged[i] += value or 0
+        return totals
+
+    @staticmethod
+    def _metrics(totals: List[Any]) -> Dict[str, Any]:
+        sums = dict(zip(TOTALS_COLUMNS, totals))
+        return {
+            "cases": sums["cases"],
+            "ok": sums["ok"],
+            "model_a_win_rate": sums["won"] / sums["won_n"] if sums["won_n"] else None,
+            "fooled_rate": sums["fooled"] / sums["fooled_n"] if sums["fooled_n"] else None,
+            "mean_elapsed_s": sums["elapsed_sum"] / sums["elapsed_n"] if sums["elapsed_n"] else None,
+            "max_elapsed_s": sums["elapsed_max"] if sums["elapsed_n"] else None,
+            "total_tokens": sums["tokens"],
+        }
+
+    def summary(self, since: Optional[float] = None, until: Optional[float] = None, **filters) -> Dict[str, Any]:
+        """Итог за период [since, until): число кейсов, доля побед модели А, доля обманутого судьи, длительность, токены."""
+        totals = self._totals(None, since, until, filters)
+        return self._metrics(totals.get(None, [0] * len(TOTALS_COLUMNS)))
+
+    def aggregate(
+        self,
+        group_by: str,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: Optional[int] = None,
+        **filters
+    ) -> List[Dict[str, Any]]:
+        """
+        Те же показатели, что в summary, по группам: group_by — один из GROUP_BY_COLUMNS
+        ("day" — начало суток UTC в секундах). Группы по убыванию числа кейсов, для "day" — по времени.
+        """
+        if group_by not in GROUP_BY_COLUMNS:
+            raise ValueError(f"Группировка по '{group_by}' не поддерживается, доступны: {', '.join(GROUP_BY_COLUMNS)}")
+        rows = [{group_by: key if key != "" else None, **self._metrics(totals)}
+                for key, totals in self._totals(group_by, since, until, filters).items()]
+        if group_by == "day":
+            rows.sort(key=lambda row: row["day"])
+        else:
+            rows.sort(key=lambda row: row["cases"], reverse=True)
+        return rows[:limit] if limit else rows
+
+    def recent(self, limit: int = 50, since: Optional[float] = None, with_details: bool = False, **filters) -> List[Dict[str, Any]]:
+        """Последние оценки (новые первыми); with_details — вместе с промптом, ответами и обоснованием."""
+        where, params = self._where(filters, [] if since is None else ["created_at >= ?"], [] if since is None else [since])
+        if with_details:
+            sql = (f"SELECT judgments.*, judgment_details.details FROM judgments"
+                   f" LEFT JOIN judgment_details USING (id){where} ORDER BY judgments.id DESC LIMIT ?")
+        else:
+            sql = f"SELECT * FROM judgments{where} ORDER BY id DESC LIMIT ?"
+        rows = self._query(sql, params + [int(limit)])
+        for row in rows:
+            if row.get("details"):
+                row["details"] = json.loads(row["details"])
+        return rows
+
+    def distinct_values(self, column: str) -> List[str]:
+        """Встречающиеся значения измерения (для фильтров UI) — из суточных сумм, без чтения всех строк."""
+        if column not in DIMENSIONS:
+            raise ValueError(f"Столбец '{column}' не поддерживается, доступны: {', '.join(DIMENSIONS)}")
+        rows = self._query(f"SELECT DISTINCT {column} AS value FROM judgments_daily WHERE {column} != '' ORDER BY value", [])
+        return [row["value"] for row in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"written": self.written, "batches": self.batches, "pending": len(self._pending)}
+
+
+_results_store: Optional[ResultsStore] = None
+_results_store_lock = threading.Lock()
+
+
+def get_results_store() -> ResultsStore:
+    global _results_store
+    with _results_store_lock:
+        if _results_store is None:
+            _results_store = ResultsStore(
+                os.getenv("GEMINIJUDGE_RESULTS_PATH") or os.path.join(upload_cache.get_cache_dir(), RESULTS_FILENAME)
+            )
+            # Недописанная пачка не теряется при обычном завершении процесса
+            atexit.register(_results_store.flush)
+        return _results_store
@@ -0,0 +1,214 @@
+# geminijudge/retrieval.py
+# Локальный режим контекста: текст документов извлекается на месте (PDF, DOCX, TXT), режется на фрагменты
+# и индексируется BM25. В промпт попадают только релевантные фрагменты, а не файлы целиком.
+import hashlib
+import heapq
+import math
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+
+import docx
+from PyPDF2 import PdfReader
+
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP_CHARS = 150
+TOP_K_DEFAULT = 8
+# Грубая оценка для сравнения режимов; точный подсчет токенов — через API
+CHARS_PER_TOKEN = 4
+# Столько токенов Gemini тратит на страницу прикрепленного PDF
+TOKENS_PER_PDF_PAGE = 258
+INDEX_CACHE_MAX_ENTRIES = 16
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+# Обрезка слов — простая замена стемминга для русских окончаний
+_STEM_CHARS = 7
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def tokenize(text: str) -> List[str]:
+    return [token[:_STEM_CHARS] for token in _TOKEN_RE.findall(text.lower()) if len(token) > 1]
+
+
+# --- Извлечение текста ---
+def extract_text(file_bytes: bytes, mime_type: Optional[str], name: str) -> Tuple[str, int]:
+    """Возвращает (текст, оценка токенов при прикреплении файла целиком). Неподдерживаемый формат -> ValueError."""
+    lower_name = name.lower()
+    if mime_type == "application/pdf" or lower_name.endswith(".pdf"):
+        reader = PdfReader(BytesIO(file_bytes))
+        text = "\n\n".join(page.extract_text() or "" for page in reader.pages)
+        return text, len(reader.pages) * TOKENS_PER_PDF_PAGE
+    if lower_name.endswith(".docx") or (mime_type or "").endswith("wordprocessingml.document"):
+        document = docx.Document(BytesIO(file_bytes))
+        text = "\n\n".join(paragraph.text for paragraph in document.paragraphs)
+        return text, estimate_tokens(text)
+    if (mime_type or "").startswith("text/") or lower_name.endswith((".txt", ".md", ".csv")):
+        text = file_bytes.decode("utf-8", errors="replace")
+        return text, estimate_tokens(text)
+    raise ValueError(f"Неподдерживаемый формат для локального извлечения: {name} ({mime_type})")
+
+
+def chunk_text(text: str, chunk_chars: int = CHUNK_CHARS, overlap_chars: int = CHUNK_OVERLAP_CHARS) -> List[str]:
+    """Собирает абзацы во фрагменты до chunk_chars символов; слишком длинные абзацы режутся с перекрытием."""
+    chunks = []
+    current = ""
+    for paragraph in (p.strip() for p in re.split(r"\n\s*\n", text)):
+        if not paragraph:
+            continue
+        while len(paragraph) > chunk_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:chunk_chars])
+            paragraph = paragraph[chunk_chars - overlap_chars:]
+        if current and len(current) + len(paragraph) + 2 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# --- Индекс ---
+class Bm25Index:
+    def __init__(self, texts: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_lengths: List[int] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for doc_id, text in enumerate(texts):
+            term_counts: Dict[str, int] = defaultdict(int)
+            tokens = tokenize(text)
+            for token in tokens:
+                term_counts[token] += 1
+            for term, count in term_counts.items():
+                self.postings[term].append((doc_id, count))
+            self.doc_lengths.append(len(tokens))
+        self.avg_doc_length = (sum(self.doc_lengths) / len(self.doc_lengths)) if self.doc_lengths else 0.0
+        num_docs = len(self.doc_lengths)
+        self.idf = {
+            term: math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+    def scores(self, query: str) -> Dict[int, float]:
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, tf in self.postings[term]:
+                length_norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / (self.avg_doc_length or 1)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+        return scores
+
+
+@dataclass
+class Chunk:
+    document_name: str
+    position: int
+    text: str
+
+
+class DocumentIndex:
+    """Фрагменты набора документов и BM25-индекс по ним. Неизменяем после построения, поэтому кэшируется."""
+
+    def __init__(self, chunks: List[Chunk], full_document_tokens: int, skipped_documents: List[str]):
+        self.chunks = chunks
+        self.full_document_tokens = full_document_tokens
+        self.skipped_documents = skipped_documents
+        self._bm25 = Bm25Index([chunk.text for chunk in chunks])
+
+    def search(self, queries: List[str], top_k: int = TOP_K_DEFAULT) -> List[Chunk]:
+        """Лучшие фрагменты по нескольким запросам (оценка фрагмента — максимум по запросам), в порядке документа."""
+        best_scores: Dict[int, float] = {}
+        for query in queries:
+            for chunk_id, score in self._bm25.scores(query).items():
+                if score > best_scores.get(chunk_id, 0.0):
+                    best_scores[chunk_id] = score
+        top_ids = heapq.nlargest(top_k, best_scores, key=best_scores.get)
+        return [self.chunks[chunk_id] for chunk_id in sorted(top_ids)]
+
+
+def _documents_key(documents: list) -> str:
+    digest = hashlib.sha256()
+    for doc in documents:
+        digest.update(doc.name.encode("utf-8"))
+        digest.update(hashlib.sha256(doc.getvalue()).digest())
+    return digest.hexdigest()
+
+
+def build_document_index(documents: list) -> DocumentIndex:
+    chunks: List[Chunk] = []
+    full_document_tokens = 0
+    skipped_documents = []
+    for doc in documents:
+        try:
+            text, attached_tokens = extract_text(doc.getvalue(), doc.type, doc.name)
+        except Exception:
+            skipped_documents.append(doc.name)
+            continue
+        full_document_tokens += attached_tokens
+        chunks.extend(Chunk(doc.name, i + 1, chunk) for i, chunk in enumerate(chunk_text(text)))
+    return DocumentIndex(chunks, full_document_tokens, skipped_documents)
+
+
+_INDEX_CACHE: "OrderedDict[str, DocumentIndex]" = OrderedDict()
+_INDEX_CACHE_LOCK = threading.Lock()
+
+
+def get_document_index(documents: list) -> Tuple[DocumentIndex, bool]:
+    """Индекс для набора документов из кэша процесса (ключ — хэш содержимого). Возвращает (индекс, был ли в кэше)."""
+    key = _documents_key(documents)
+    with _INDEX_CACHE_LOCK:
+        if key in _INDEX_CACHE:
+            _INDEX_CACHE.move_to_end(key)
+            return _INDEX_CACHE[key], True
+    index = build_document_index(documents)
+    with _INDEX_CACHE_LOCK:
+        _INDEX_CACHE[key] = index
+        while len(_INDEX_CACHE) > INDEX_CACHE_MAX_ENTRIES:
+            _INDEX_CACHE.popitem(last=False)
+    return index, False
+
+
+class RetrievalContext:
+    """Индекс документов плюс учет токенов одного запуска (индекс общий, счетчики — свои)."""
+
+    def __init__(self, index: DocumentIndex, top_k: int = TOP_K_DEFAULT):
+        self.index = index
+        self.top_k = top_k
+        self.calls = 0
+        self.context_tokens_sent = 0
+        self._lock = threading.Lock()
+
+    def build_context_block(self, queries: List[str]) -> str:
+        chunks = self.index.search([q for q in queries if q and q.strip()], self.top_k)
+        block = "\n\n".join(
+            f"[Документ: {chunk.document_name}, фрагмент {chunk.position}]\n{chunk.text}" for chunk in chunks
+        )
+        with self._lock:
+            self.calls += 1
+            self.context_tokens_sent += estimate_tokens(block)
+        return block
+
+    def savings_report(self) -> Dict[str, Any]:
+        with self._lock:
+            tokens_if_attached = self.index.full_document_tokens * self.calls
+            saved = tokens_if_attached - self.context_tokens_sent
+            return {
+                "calls": self.calls,
+                "chunks_indexed": len(self.index.chunks),
+                "full_document_tokens": self.index.full_document_tokens,
+                "tokens_if_attached": tokens_if_attached,
+                "context_tokens_sent": self.context_tokens_sent,
+                "tokens_saved": saved,
+                "savings_ratio": round(saved / tokens_if_attached, 3) if tokens_if_attached else 0.0,
+            }
@@ -0,0 +1,39 @@
+# geminijudge/tests/conftest.py
+# Общие фикстуры тестов: модули проекта импортируются из корня репозитория, кэши пишутся во временный каталог,
+# модели и File API подменяются заглушкой fake_gemini. Запуск: python -m pytest -q (из корня репозитория).
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_gemini  # noqa: E402
+import gemini_utils  # noqa: E402
+import rate_limiter  # noqa: E402
+import response_cache  # noqa: E402
+import upload_cache  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(tmp_path, monkeypatch):
+    """Каждый тест — со своим каталогом кэша и заново созданными синглтонами кэшей и планировщика."""
+    monkeypatch.setenv("GEMINIJUDGE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("GEMINIJUDGE_RESPONSE_CACHE", "0")
+    monkeypatch.setattr(upload_cache, "_upload_cache", None)
+    monkeypatch.setattr(response_cache, "_response_cache", None)
+    rate_limiter.reset_request_scheduler()
+    yield tmp_path / "cache"
+    rate_limiter.reset_request_scheduler()
+
+
+@pytest.fixture
+def fake_backend():
+    """Заглушка вместо Gemini API и отдельное состояние с ключом "fake". Возвращает хранилище файлов заглушки."""
+    store = fake_gemini.install()
+    gemini_utils.clear_model_pool()
+    with gemini_utils.using_state({}):
+        gemini_utils.configure_gemini_api(api_key="fake")
+        yield store
+    fake_gemini.uninstall()
+    gemini_utils.clear_model_pool()
@@ -0,0 +1,90 @@
+# geminijudge/tests/test_caches.py
+import io
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import gemini_utils
+import pipeline
+import response_cache
+import upload_cache
+
+
+class MemoryDocument:
+    """Документ в памяти с интерфейсом UploadedFile (name, type, getvalue, getbuffer)."""
+
+    def __init__(self, name, data):
+        self.name = name
+        self.type = "text/plain"
+        self._buffer = io.BytesIO(data)
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+    def getbuffer(self):
+        return self._buffer.getbuffer()
+
+
+def remote_file(name, expires_in):
+    return SimpleNamespace(name=name, expiration_time=datetime.now(timezone.utc) + expires_in)
+
+
+def test_response_cache_hit_miss_and_ttl(tmp_path):
+    cache = response_cache.ResponseCache(str(tmp_path / "responses.sqlite3"), max_bytes=1 << 20, ttl_s=60)
+    assert cache.get("k") is None
+    cache.put("k", "ответ")
+    assert cache.get("k") == "ответ"
+    cache.put("short", "ответ", ttl_s=0)
+    assert cache.get("short") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 1)
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    cache = response_cache.ResponseCache(str(tmp_path / "responses.sqlite3"), max_bytes=25, ttl_s=60)
+    cache.put("old", "a" * 10)
+    time.sleep(0.01)
+    cache.put("used", "b" * 10)
+    time.sleep(0.01)
+    assert cache.get("old") is not None # Теперь "used" давнее всех
+    time.sleep(0.01)
+    cache.put("new", "c" * 10)
+    assert cache.get("used") is None
+    assert cache.get("old") is not None and cache.get("new") is not None
+
+
+def test_upload_cache_persists_and_drops_expiring_files(tmp_path):
+    path = str(tmp_path / "uploads.json")
+    cache = upload_cache.UploadCache(path)
+    fresh_key = upload_cache.content_key("abc", "text/plain", "key-a")
+    expiring_key = upload_cache.content_key("def", "text/plain", "key-a")
+    cache.put(fresh_key, remote_file("files/fresh", timedelta(hours=47)))
+    cache.put(expiring_key, remote_file("files/expiring", timedelta(minutes=5)))
+
+    reloaded = upload_cache.UploadCache(path)
+    assert reloaded.get(fresh_key) == "files/fresh"
+    assert reloaded.content_digest("files/fresh") == "abc"
+    # Файл истечет раньше, чем закончится запуск, — его нет смысла отдавать
+    assert reloaded.get(expiring_key) is None
+    assert reloaded.stats()["stale"] == 1
+    # Файлы видны только проекту своего ключа
+    assert reloaded.get(upload_cache.content_key("abc", "text/plain", "key-b")) is None
+
+
+def test_repeated_upload_is_served_from_upload_cache(fake_backend):
+    document = MemoryDocument("a.txt", b"contract text " * 100)
+    first, ok = pipeline.upload_documents([document])
+    assert ok and len(fake_backend._files) == 1
+    second, ok = pipeline.upload_documents([document])
+    assert ok and [f.name for f in second] == [f.name for f in first]
+    assert len(fake_backend._files) == 1
+    assert upload_cache.get_upload_cache().stats()["hits"] == 1
+
+
+def test_repeated_request_is_served_from_response_cache(fake_backend, monkeypatch):
+    monkeypatch.setenv("GEMINIJUDGE_RESPONSE_CACHE", "1")
+    first = gemini_utils.generate_text_from_model("Вопрос для кэша", model_type="generation")
+    assert gemini_utils.generate_text_from_model("Вопрос для кэша", model_type="generation") == first
+    assert gemini_utils.generate_text_from_model("Вопрос для кэша", model_type="generation", bypass_cache=True) == first
+    stats = response_cache.get_response_cache().stats()
+    assert (stats["hits"], stats["misses"], stats["stores"]) == (1, 1, 1)
@@ -0,0 +1,60 @@
+# geminijudge/tests/test_distractor_parser.py
+import random
+
+import pytest
+
+import pipeline
+import prompts
+
+PREFIX = prompts.INCORRECT_ANSWER_PARSING_PREFIX
+
+
+def bulk_parse(text):
+    """Эталон: разбор всего текста построчно (str.splitlines), как до потокового парсера."""
+    answers, current = [], None
+    for line in text.splitlines():
+        if line.startswith(PREFIX):
+            if current is not None:
+                answers.append("\n".join(current).strip())
+            current = [line.replace(PREFIX, "", 1).strip()]
+        elif current is not None:
+            current.append(line.strip())
+    if current is not None:
+        answers.append("\n".join(current).strip())
+    return [answer for answer in answers if answer]
+
+
+def random_chunks(rng, text):
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 8))))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def test_sample_response():
+    text = f"Вступление\n{PREFIX} Первый\nпродолжение\r\n{PREFIX}  Второй  \n\n{PREFIX}\n{PREFIX} Третий"
+    assert pipeline.parse_incorrect_responses(text) == ["Первый\nпродолжение", "Второй", "Третий"]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_chunking_matches_bulk_parse(seed):
+    rng = random.Random(seed)
+    # Переводы строк всех видов, \r\n на границе фрагментов и оборванные префиксы
+    alphabet = ["a", "б", " ", "\n", "\r", "\r\n", "\x0b", " ", PREFIX, PREFIX[:3], "x" * 5]
+    for _ in range(2000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        parser = pipeline.IncrementalDistractorParser()
+        streamed = []
+        for chunk in random_chunks(rng, text):
+            streamed.extend(parser.feed(chunk))
+        streamed.extend(parser.finish())
+        assert streamed == bulk_parse(text), repr(text)
+        assert pipeline.parse_incorrect_responses(text) == streamed
+
+
+def test_answer_is_emitted_once_next_prefix_arrives():
+    parser = pipeline.IncrementalDistractorParser()
+    assert parser.feed(f"{PREFIX} Первый отв") == []
+    assert parser.feed("ет\n") == []
+    # Следующий ответ еще не дописан, но его префикс уже закрывает предыдущий
+    assert parser.feed(PREFIX[:4]) == []
+    assert parser.feed(f"{PREFIX[4:]} Вто") == ["Первый ответ"]
+    assert parser.finish() == ["Вто"]
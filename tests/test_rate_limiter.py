@@ -0,0 +1,91 @@
+# geminijudge/tests/test_rate_limiter.py
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import rate_limiter
+
+
+def test_token_bucket_burst_then_queue():
+    bucket = rate_limiter.TokenBucket(per_minute=60)
+    now = bucket.updated
+    for _ in range(60):
+        assert bucket.reserve(1, now) == 0.0
+    # Квота минуты израсходована: следующие встают в очередь с интервалом 1 / rate
+    assert bucket.reserve(1, now) == pytest.approx(1.0)
+    assert bucket.reserve(1, now) == pytest.approx(2.0)
+    assert bucket.wait_for(1, now + 2.0) == pytest.approx(1.0)
+
+
+def test_token_bucket_adjust_refunds_overestimate():
+    bucket = rate_limiter.TokenBucket(per_minute=600, burst=10)
+    now = bucket.updated
+    bucket.reserve(10, now)
+    assert bucket.wait_for(4, now) == pytest.approx(0.4)
+    bucket.adjust(-4, now) # Ответ оказался на 4 токена меньше оценки
+    assert bucket.wait_for(4, now) == 0.0
+
+
+def test_token_bucket_penalize_delays_next_request():
+    bucket = rate_limiter.TokenBucket(per_minute=60)
+    now = bucket.updated
+    bucket.penalize(5.0, now)
+    assert bucket.wait_for(1, now) >= 5.0
+    assert bucket.wait_for(1, now + 10.0) == 0.0
+
+
+def rate_limited(times, retry_s):
+    """func(api_key): первые times вызовов — 429 с подсказкой retry, дальше — ключ, с которым пришел вызов."""
+    calls = []
+
+    def func(api_key):
+        calls.append(api_key)
+        if len(calls) <= times:
+            raise google_exceptions.ResourceExhausted(f"Quota exceeded. Please retry in {retry_s}s.")
+        return api_key
+    return func, calls
+
+
+def test_rate_limit_retries_on_another_key_without_waiting():
+    scheduler = rate_limiter.RequestScheduler(base_delay_s=0.0)
+    func, calls = rate_limited(1, retry_s=30)
+    started = time.monotonic()
+    assert scheduler.call("models/test", func, candidates=["key-a", "key-b"]) == "key-b"
+    assert calls == ["key-a", "key-b"]
+    assert time.monotonic() - started < 1.0
+
+
+def test_rate_limit_on_single_key_waits_for_retry_hint():
+    scheduler = rate_limiter.RequestScheduler(base_delay_s=0.0)
+    func, calls = rate_limited(1, retry_s=0.2)
+    retries = []
+    started = time.monotonic()
+    scheduler.call("models/test", func, candidates=["key-a"], on_retry=lambda *args: retries.append(args))
+    assert calls == ["key-a", "key-a"]
+    assert time.monotonic() - started >= 0.2
+    assert len(retries) == 1 and retries[0][0] == 1
+
+
+def test_rate_limit_gives_up_after_max_attempts():
+    scheduler = rate_limiter.RequestScheduler(max_attempts=3, base_delay_s=0.0)
+    func, calls = rate_limited(10, retry_s=0)
+    with pytest.raises(google_exceptions.ResourceExhausted):
+        scheduler.call("models/test", func, candidates=["key-a", "key-b", "key-c"])
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize("error, can_retry", [
+    (ValueError("не повторяется"), None),
+    (google_exceptions.ServiceUnavailable("503"), lambda: False),
+])
+def test_error_is_raised_without_retry(error, can_retry):
+    scheduler = rate_limiter.RequestScheduler(base_delay_s=0.0)
+    calls = []
+
+    def func(api_key):
+        calls.append(api_key)
+        raise error
+    with pytest.raises(type(error)):
+        scheduler.call("models/test", func, candidates=["key-a"], can_retry=can_retry)
+    assert len(calls) == 1
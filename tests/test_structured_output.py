@@ -0,0 +1,43 @@
+# geminijudge/tests/test_structured_output.py
+import itertools
+
+import pytest
+
+import fake_gemini
+import metrics
+import pipeline
+import prompts
+
+
+@pytest.mark.parametrize("invalid_json, outcome", [
+    ([], "valid"),
+    ([True], "repaired"), # Оборван только исходный ответ, запрос исправления вернул валидный JSON
+    ([True, True], "failed"), # Оборван и ответ на запрос исправления
+])
+def test_structured_distractors_outcome(fake_backend, monkeypatch, invalid_json, outcome):
+    monkeypatch.setattr(fake_gemini.FakeGenerativeModel, "invalid_json_rate", 0.5)
+    # Решения заглушки "оборвать JSON" по очереди для каждого ответа: _random() < 0.5 — оборвать
+    decisions = itertools.chain((0.0 if cut else 1.0 for cut in invalid_json), itertools.repeat(1.0))
+    monkeypatch.setattr(fake_gemini, "_random", lambda: next(decisions))
+    with metrics.recording_run(metrics.RunRecorder()) as recorder:
+        responses = pipeline.generate_incorrect_responses("Вопрос?", "Ответ модели А.", 2, structured_output=True)
+    breakdown = recorder.breakdown()
+
+    assert breakdown["structured_outputs"][pipeline.STAGE_GENERATION][outcome] == 1
+    assert sum(breakdown["structured_outputs"][pipeline.STAGE_GENERATION].values()) == 1
+    # Исправление — отдельный небольшой запрос, полный запрос с документами не повторяется
+    assert len(breakdown["model_calls"]) == 1 + bool(invalid_json)
+    if outcome == "failed":
+        assert responses == []
+    else:
+        assert len(responses) == 2
+
+
+def test_structured_evaluation_repair_keeps_verdict(fake_backend, monkeypatch):
+    monkeypatch.setattr(fake_gemini.FakeGenerativeModel, "invalid_json_rate", 0.5)
+    decisions = iter([0.0, 1.0])
+    monkeypatch.setattr(fake_gemini, "_random", lambda: next(decisions))
+    with metrics.recording_run(metrics.RunRecorder()) as recorder:
+        result = pipeline.evaluate_responses("Вопрос?", "Ответ модели А.", ["Неверный ответ."], structured_output=True)
+    assert result.chosen_id == prompts.MODEL_A_ANSWER_ID
+    assert recorder.breakdown()["structured_outputs"][pipeline.STAGE_EVALUATION]["repaired"] == 1
@@ -0,0 +1,70 @@
+# geminijudge/tests/test_upload_memory_budget.py
+import threading
+
+import pytest
+
+import upload_stream
+
+
+def hold_in_thread(budget, nbytes):
+    """Резервирует nbytes в отдельном потоке и держит, пока не взведено возвращенное событие release."""
+    reserved, release = threading.Event(), threading.Event()
+
+    def hold():
+        with budget.reserve(nbytes):
+            reserved.set()
+            release.wait(5)
+    thread = threading.Thread(target=hold)
+    thread.start()
+    assert reserved.wait(5)
+    return release, thread
+
+
+def test_reservations_within_limit_do_not_queue():
+    budget = upload_stream.UploadMemoryBudget(100)
+    with budget.reserve(60), budget.reserve(40):
+        assert budget.in_use == 100
+    assert budget.in_use == 0
+    assert budget.peak == 100
+    assert budget.queued == 0
+
+
+def test_upload_waits_until_memory_is_released():
+    budget = upload_stream.UploadMemoryBudget(100)
+    release, thread = hold_in_thread(budget, 80)
+    queued = []
+    threading.Timer(0.1, release.set).start()
+    with budget.reserve(50, on_queued=lambda: queued.append(budget.in_use)):
+        assert budget.in_use == 50
+    thread.join()
+    assert queued == [80]
+    assert budget.queued == 1
+    assert budget.peak == 80
+
+
+def test_upload_larger_than_budget_runs_alone():
+    budget = upload_stream.UploadMemoryBudget(100)
+    with budget.reserve(500):
+        assert budget.in_use == 100
+    assert budget.peak == 100
+
+
+def test_cancelled_upload_leaves_queue_without_reserving(monkeypatch):
+    monkeypatch.setattr(upload_stream, "QUEUE_POLL_S", 0.01)
+    budget = upload_stream.UploadMemoryBudget(100)
+    release, thread = hold_in_thread(budget, 80)
+    polls = []
+
+    def check_cancelled():
+        polls.append(1)
+        if len(polls) >= 3:
+            raise RuntimeError("отменено")
+    try:
+        with pytest.raises(RuntimeError):
+            with budget.reserve(50, check_cancelled=check_cancelled):
+                pytest.fail("отмененная загрузка не должна получить память")
+        assert budget.in_use == 80
+    finally:
+        release.set()
+        thread.join()
+    assert budget.in_use == 0
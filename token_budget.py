@@ -0,0 +1,209 @@
+# geminijudge/token_budget.py
+# Предварительная проверка запроса до отправки: токены промпта и прикрепленных файлов, лимиты модели и бюджет ответа.
+# Запрос, который не поместится в контекст модели, не отправляется; бюджет ответа (max_output_tokens) поднимается
+# под ожидаемый размер ответа, чтобы он не обрывался на MAX_TOKENS. Токены файла считаются один раз (count_tokens)
+# и хранятся на диске по хэшу содержимого.
+#
+# Лимиты моделей можно переопределить: GEMINIJUDGE_TOKEN_LIMITS={"gemini-2.0-flash-lite": {"input": 1048576, "output": 8192}}
+import functools
+import json
+import logging
+import math
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import upload_cache
+import response_cache
+import rate_limiter
+
+MODEL_TOKEN_LIMITS = {
+    "gemini-2.0-flash-lite": {"input": 1048576, "output": 8192},
+    "gemini-2.5-flash-preview-04-17": {"input": 1048576, "output": 65536},
+}
+MODEL_TOKEN_LIMITS_FALLBACK = {"input": 1048576, "output": 8192}
+# У моделей с "размышлением" токены размышления расходуют тот же max_output_tokens, что и сам ответ
+THINKING_MODEL_PREFIXES = ("gemini-2.5",)
+THINKING_TOKENS_RESERVE = 4096
+# Запас к ожидаемому размеру ответа
+OUTPUT_HEADROOM = 1.25
+# Ожидаемый размер ответа по типу модели, если вызывающий его не указал (обоснование судьи)
+EXPECTED_OUTPUT_TOKENS_DEFAULT = {"evaluation": 1024, "screening": 1024}
+# 'Неправильный' ответ бывает длиннее ответа модели А; плюс разметка (префикс или JSON)
+DISTRACTOR_LENGTH_FACTOR = 2
+DISTRACTOR_OVERHEAD_TOKENS = 64
+# Кандидат длиннее этого в промпте судьи сокращается локально (0 — не сокращать)
+CANDIDATE_MAX_TOKENS_DEFAULT = 2000
+TRIM_MARKER = "… [сокращено: {kept} из {total} симв.]"
+TOKEN_COUNTS_FILENAME = "token_counts.json"
+
+logger = logging.getLogger("geminijudge")
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_limit_overrides(raw: str) -> Dict[str, Dict[str, int]]:
+    """GEMINIJUDGE_TOKEN_LIMITS разбирается один раз на значение; ошибка в JSON — встроенные лимиты, а не сбой запросов."""
+    try:
+        overrides = json.loads(raw or "{}")
+    except ValueError as e:
+        logger.warning("GEMINIJUDGE_TOKEN_LIMITS: невалидный JSON (%s), используются встроенные лимиты.", e)
+        return {}
+    if not isinstance(overrides, dict) or not all(isinstance(limits, dict) for limits in overrides.values()):
+        logger.warning("GEMINIJUDGE_TOKEN_LIMITS: ожидается объект {модель: {\"input\": ..., \"output\": ...}}, "
+                       "используются встроенные лимиты.")
+        return {}
+    return overrides
+
+
+def get_model_limits(model_name: str) -> Dict[str, int]:
+    name = model_name[len("models/"):] if model_name.startswith("models/") else model_name
+    overrides = _parse_limit_overrides(os.getenv("GEMINIJUDGE_TOKEN_LIMITS", ""))
+    return {**MODEL_TOKEN_LIMITS_FALLBACK, **MODEL_TOKEN_LIMITS.get(name, {}), **overrides.get(name, {})}
+
+
+def is_thinking_model(model_name: str) -> bool:
+    name = model_name[len("models/"):] if model_name.startswith("models/") else model_name
+    return name.startswith(THINKING_MODEL_PREFIXES)
+
+
+def estimate_text_tokens(text: str) -> int:
+    return len(text) // rate_limiter.CHARS_PER_TOKEN + 1
+
+
+def estimate_distractors_tokens(model_a_response: str, num_samples: int) -> int:
+    """Ожидаемый размер ответа генерации: num_samples 'неправильных' ответов по образцу ответа модели А."""
+    return num_samples * (estimate_text_tokens(model_a_response) * DISTRACTOR_LENGTH_FACTOR + DISTRACTOR_OVERHEAD_TOKENS)
+
+
+def get_candidate_max_tokens() -> int:
+    return int(os.getenv("GEMINIJUDGE_CANDIDATE_MAX_TOKENS", CANDIDATE_MAX_TOKENS_DEFAULT))
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Сокращает текст до max_tokens (оценка по символам): по границе предложения или строки, с пометкой о сокращении."""
+    if max_tokens <= 0 or estimate_text_tokens(text) <= max_tokens:
+        return text
+    limit = max_tokens * rate_limiter.CHARS_PER_TOKEN
+    cut = max(text.rfind(". ", 0, limit), text.rfind("\n", 0, limit))
+    # Граница предложения слишком далеко от лимита — режем по пробелу
+    if cut < limit // 2:
+        cut = text.rfind(" ", 0, limit)
+    if cut < limit // 2:
+        cut = limit
+    kept = text[:cut + 1].rstrip()
+    return f"{kept} {TRIM_MARKER.format(kept=len(kept), total=len(text))}"
+
+
+class TokenCountCache:
+    """Токены прикрепленного файла по (модель, хэш содержимого): count_tokens для одного файла вызывается один раз."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = self._load()
+
+    def _load(self) -> Dict[str, int]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._counts, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key: str) -> Optional[int]:
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return tokens
+
+    def put(self, key: str, tokens: int):
+        with self._lock:
+            self._counts[key] = tokens
+            self._save()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._counts)}
+
+
+_token_count_cache: Optional[TokenCountCache] = None
+_token_count_cache_lock = threading.Lock()
+
+
+def get_token_count_cache() -> TokenCountCache:
+    global _token_count_cache
+    with _token_count_cache_lock:
+        if _token_count_cache is None:
+            _token_count_cache = TokenCountCache(os.path.join(upload_cache.get_cache_dir(), TOKEN_COUNTS_FILENAME))
+        return _token_count_cache
+
+
+def count_file_tokens(model: Any, gemini_file: Any, api_call: Optional[Callable[[Callable[[str], Any]], Any]] = None) -> int:
+    """
+    Токены файла для модели: из кэша по хэшу содержимого, иначе count_tokens. Если подсчитать не удалось
+    (сеть, режим воспроизведения), возвращается грубая оценка, и она не кэшируется.
+    api_call(func): через что отправить count_tokens (планировщик с лимитами и повторами, вызывает func(api_key));
+    по умолчанию — напрямую. Ключ запроса задает клиент модели.
+    """
+    cache = get_token_count_cache()
+    key = f"{model.model_name}:{response_cache.file_identity(gemini_file)}"
+    tokens = cache.get(key)
+    if tokens is not None:
+        return tokens
+    try:
+        count = lambda api_key=None: model.count_tokens([gemini_file])
+        tokens = int((api_call(count) if api_call else count()).total_tokens)
+    except Exception:
+        return rate_limiter.TOKENS_PER_FILE_ESTIMATE
+    cache.put(key, tokens)
+    return tokens
+
+
+@dataclass
+class RequestBudget:
+    input_tokens: int
+    input_limit: int
+    max_output_tokens: int
+
+    @property
+    def fits(self) -> bool:
+        return self.input_tokens <= self.input_limit
+
+
+def plan_output_tokens(model_name: str, default_max_output_tokens: int, expected_output_tokens: Optional[int] = None) -> int:
+    """
+    Бюджет ответа: не меньше default_max_output_tokens, под ожидаемый ответ с запасом. Считается без запросов
+    к API и не зависит от подсчета файлов, поэтому ключи кэша и записи replay стабильны.
+    """
+    if not expected_output_tokens:
+        return default_max_output_tokens
+    needed = expected_output_tokens + (THINKING_TOKENS_RESERVE if is_thinking_model(model_name) else 0)
+    return min(get_model_limits(model_name)["output"], max(default_max_output_tokens, math.ceil(needed * OUTPUT_HEADROOM)))
+
+
+def plan_request(
+    model: Any,
+    prompt_text: str,
+    files: List[Any],
+    default_max_output_tokens: int,
+    expected_output_tokens: Optional[int] = None,
+    api_call: Optional[Callable[[Callable[[str], Any]], Any]] = None
+) -> RequestBudget:
+    """Размер запроса (промпт и файлы, см. count_file_tokens) и бюджет ответа (plan_output_tokens)."""
+    input_tokens = estimate_text_tokens(prompt_text) + sum(count_file_tokens(model, f, api_call) for f in files)
+    return RequestBudget(
+        input_tokens, get_model_limits(model.model_name)["input"],
+        plan_output_tokens(model.model_name, default_max_output_tokens, expected_output_tokens)
+    )
@@ -0,0 +1,123 @@
+# geminijudge/upload_cache.py
+# Кэш загруженных в Gemini File API документов: хэш содержимого + MIME -> удаленный файл и срок его жизни.
+# Один экземпляр на процесс (общий для всех сессий Streamlit и потоков batch_judge.py), хранится на диске.
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+CACHE_DIR_DEFAULT = ".geminijudge_cache"
+UPLOAD_CACHE_FILENAME = "uploads.json"
+# Файлы в Gemini живут 48 часов; если срок определить не удалось, считаем с запасом
+DEFAULT_FILE_TTL_SECONDS = 47 * 3600
+# Не отдаем файл, который истечет раньше, чем успеет закончиться запуск
+EXPIRY_SAFETY_MARGIN_SECONDS = 15 * 60
+
+
+def get_cache_dir() -> str:
+    return os.getenv("GEMINIJUDGE_CACHE_DIR", CACHE_DIR_DEFAULT)
+
+
+def api_key_fingerprint(api_key: Optional[str]) -> str:
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:8]
+
+
+def content_key(digest: str, mime_type: Optional[str], api_key: Optional[str] = None) -> str:
+    """Ключ кэша: sha256 содержимого (hex) + MIME. Отпечаток API ключа нужен, т.к. файлы видны только своему проекту."""
+    return f"{digest}:{mime_type or ''}:{api_key_fingerprint(api_key)}"
+
+
+def expiry_timestamp(gemini_file: Any) -> float:
+    expiration_time = getattr(gemini_file, "expiration_time", None)
+    if isinstance(expiration_time, datetime):
+        return expiration_time.timestamp()
+    return time.time() + DEFAULT_FILE_TTL_SECONDS
+
+
+class UploadCache:
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = self._load()
+        self._digest_by_name: Dict[str, str] = {entry["name"]: key.split(":", 1)[0] for key, entry in self._entries.items()}
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        now = time.time()
+        return {key: entry for key, entry in entries.items() if entry.get("expires_at", 0) > now}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key: str) -> Optional[str]:
+        """Имя удаленного файла, если запись есть и не истекает в ближайшее время."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["expires_at"] - EXPIRY_SAFETY_MARGIN_SECONDS > time.time():
+                return entry["name"]
+            if entry:
+                del self._entries[key]
+                self.stale += 1
+            return None
+
+    def put(self, key: str, gemini_file: Any):
+        with self._lock:
+            self._entries[key] = {"name": gemini_file.name, "expires_at": expiry_timestamp(gemini_file)}
+            self._digest_by_name[gemini_file.name] = key.split(":", 1)[0]
+            self._save()
+
+    def invalidate(self, key: str):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.stale += 1
+                self._save()
+
+    def content_digest(self, name: str) -> Optional[str]:
+        """sha256 содержимого по имени удаленного файла (для ключей кэша ответов)."""
+        with self._lock:
+            return self._digest_by_name.get(name)
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "entries": len(self._entries),
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+_upload_cache: Optional[UploadCache] = None
+_upload_cache_lock = threading.Lock()
+
+
+def get_upload_cache() -> UploadCache:
+    global _upload_cache
+    with _upload_cache_lock:
+        if _upload_cache is None:
+            _upload_cache = UploadCache(os.path.join(get_cache_dir(), UPLOAD_CACHE_FILENAME))
+        return _upload_cache
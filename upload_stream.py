@@ -0,0 +1,220 @@
+# geminijudge/upload_stream.py
+# Загрузка больших документов без лишних копий в памяти. Содержимое UploadedFile читается прямо из его буфера
+# (memoryview): по кускам без копирования считается хэш, а в File API уходит файловый объект поверх того же буфера,
+# из которого клиент читает кусками по googleapiclient.http.DEFAULT_CHUNK_SIZE. Локальные файлы (batch_judge)
+# отдаются клиенту открытыми и тоже не копируются целиком.
+# Память, которую загрузки держат одновременно, ограничена бюджетом на процесс: загрузка, которой не хватает
+# бюджета, ждет в очереди.
+#
+#   GEMINIJUDGE_UPLOAD_MEMORY_MB — бюджет памяти загрузок на процесс (0 — без ограничения)
+#   GEMINIJUDGE_UPLOAD_CHUNK_MB  — размер куска при хэшировании
+import hashlib
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from googleapiclient.http import DEFAULT_CHUNK_SIZE
+
+import metrics
+
+UPLOAD_CHUNK_MB_DEFAULT = 8
+UPLOAD_MEMORY_MB_DEFAULT = 256
+# Как часто ожидающая загрузка проверяет отмену запуска, с
+QUEUE_POLL_S = 0.5
+MB = 1024 * 1024
+
+
+def get_chunk_bytes() -> int:
+    return max(1, int(float(os.getenv("GEMINIJUDGE_UPLOAD_CHUNK_MB", UPLOAD_CHUNK_MB_DEFAULT)) * MB))
+
+
+def _local_path(doc: Any) -> Optional[str]:
+    path = getattr(doc, "path", None)
+    return path if isinstance(path, str) and os.path.isfile(path) else None
+
+
+def document_size(doc: Any) -> int:
+    path = _local_path(doc)
+    if path:
+        return os.path.getsize(path)
+    if hasattr(doc, "getbuffer"):
+        with doc.getbuffer() as view:
+            return view.nbytes
+    size = getattr(doc, "size", None)
+    return size if isinstance(size, int) else len(doc.getvalue())
+
+
+def is_streamable(doc: Any) -> bool:
+    """Документ читается кусками без копии всего содержимого (локальный файл или буфер BytesIO/UploadedFile)."""
+    return _local_path(doc) is not None or hasattr(doc, "getbuffer")
+
+
+def iter_chunks(doc: Any, chunk_bytes: Optional[int] = None) -> Iterator[Any]:
+    """Содержимое документа кусками: из файла — блоками, из буфера UploadedFile — срезами memoryview без копирования."""
+    chunk_bytes = chunk_bytes or get_chunk_bytes()
+    path = _local_path(doc)
+    if path:
+        with open(path, "rb") as f:
+            while True:
+                block = f.read(chunk_bytes)
+                if not block:
+                    return
+                yield block
+    elif hasattr(doc, "getbuffer"):
+        with doc.getbuffer() as view:
+            for start in range(0, view.nbytes, chunk_bytes):
+                yield view[start:start + chunk_bytes]
+    else:
+        view = memoryview(doc.getvalue())
+        for start in range(0, view.nbytes, chunk_bytes):
+            yield view[start:start + chunk_bytes]
+
+
+def content_digest(doc: Any) -> str:
+    """sha256 содержимого документа, посчитанный по кускам."""
+    digest = hashlib.sha256()
+    for chunk in iter_chunks(doc):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def memory_bytes(doc: Any) -> int:
+    """
+    Сколько памяти загрузка документа занимает сверх самого документа: кусок, который клиент File API читает
+    за раз (MediaIoBaseUpload, DEFAULT_CHUNK_SIZE), при потоковой передаче, иначе — копия целиком.
+    """
+    size = document_size(doc)
+    return min(size, DEFAULT_CHUNK_SIZE) if is_streamable(doc) else size
+
+
+class BufferReader(io.RawIOBase):
+    """Файловый объект только для чтения поверх memoryview: read() копирует лишь запрошенный кусок."""
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._view.nbytes}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        end = self._view.nbytes if size is None or size < 0 else min(self._pos + size, self._view.nbytes)
+        data = self._view[self._pos:end].tobytes() if end > self._pos else b""
+        self._pos += len(data)
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, buffer: Any) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        # Без ссылки на срез буфер документа можно освободить (memoryview.release)
+        self._view = memoryview(b"")
+        super().close()
+
+
+@contextmanager
+def open_stream(doc: Any) -> Iterator[io.IOBase]:
+    """
+    Содержимое документа как файловый объект для File API на время блока with: локальный файл открывается,
+    буфер UploadedFile читается через BufferReader без копии, остальное копируется в BytesIO целиком.
+    """
+    path = _local_path(doc)
+    if path:
+        with open(path, "rb") as stream:
+            yield stream
+    elif hasattr(doc, "getbuffer"):
+        with doc.getbuffer() as view, BufferReader(view) as stream:
+            yield stream
+    else:
+        yield io.BytesIO(doc.getvalue())
+
+
+class UploadMemoryBudget:
+    """
+    Бюджет памяти загрузок на процесс (общий для всех сессий Streamlit и потоков batch_judge.py).
+    Загрузка, которой не хватает бюджета, ждет, пока другие не освободят память. Загрузка больше всего бюджета
+    ждет, пока не освободится весь бюджет, и идет одна.
+    """
+
+    def __init__(self, limit_bytes: int):
+        self.limit_bytes = limit_bytes
+        self.in_use = 0
+        self.peak = 0
+        self.queued = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(
+        self,
+        nbytes: int,
+        on_queued: Optional[Callable[[], None]] = None,
+        check_cancelled: Optional[Callable[[], None]] = None
+    ) -> Iterator[None]:
+        """
+        on_queued вызывается один раз, если загрузке пришлось ждать; check_cancelled — периодически во время
+        ожидания (бросает исключение, чтобы отмененный запуск не ждал своей очереди).
+        """
+        if self.limit_bytes > 0:
+            nbytes = min(nbytes, self.limit_bytes)
+        with self._cond:
+            if self.limit_bytes > 0 and self.in_use + nbytes > self.limit_bytes:
+                self.queued += 1
+                if on_queued:
+                    on_queued()
+                wait_started = time.perf_counter()
+                while self.in_use + nbytes > self.limit_bytes:
+                    self._cond.wait(QUEUE_POLL_S)
+                    if check_cancelled:
+                        check_cancelled()
+                metrics.REGISTRY.observe(metrics.UPLOAD_QUEUE_WAIT, time.perf_counter() - wait_started)
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= nbytes
+                self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "limit_mb": round(self.limit_bytes / MB, 1),
+                "in_use_mb": round(self.in_use / MB, 1),
+                "peak_mb": round(self.peak / MB, 1),
+                "queued": self.queued,
+            }
+
+
+_upload_memory_budget: Optional[UploadMemoryBudget] = None
+_upload_memory_budget_lock = threading.Lock()
+
+
+def get_upload_memory_budget() -> UploadMemoryBudget:
+    global _upload_memory_budget
+    with _upload_memory_budget_lock:
+        if _upload_memory_budget is None:
+            limit_mb = float(os.getenv("GEMINIJUDGE_UPLOAD_MEMORY_MB", UPLOAD_MEMORY_MB_DEFAULT))
+            _upload_memory_budget = UploadMemoryBudget(int(limit_mb * MB))
+        return _upload_memory_budget
+